@@ -6,10 +6,12 @@
 AMP command definitions for the Q2Q protocol spoken by Vertex.
 """
 
+import struct
+
 # Twisted
 from twisted.protocols.amp import (
     AmpBox, String, Unicode, ListOf, Command,
-    Integer, _objectsToStrings
+    Integer, Boolean, _objectsToStrings
     )
 
 # Vertex
@@ -49,6 +51,57 @@ class ConnectionStartBox(AmpBox):
 
 
 
+# A DataFrame looks to the AMP parser like the start of a box: the length of a
+# first key, which is a NUL and the id of the virtual connection, and then the
+# length of its value, which is the data.  No AMP key starts with a NUL.
+_frameKey = struct.Struct('!Bi')
+_frameHeader = struct.Struct('!H' + _frameKey.format[1:] + 'H')
+
+
+
+def parseFrameKey(key):
+    """
+    Recognize the first key of a L{DataFrame}.
+
+    @param key: the first key of what may be an L{AmpBox}.
+
+    @return: the id of the virtual connection the frame is for, or C{None}
+        if this is an ordinary box.
+    """
+    if len(key) == _frameKey.size and key[0] == '\x00':
+        return _frameKey.unpack(key)[1]
+    return None
+
+
+
+class DataFrame(object):
+    """
+    Data for a multiplexed virtual connection, sent more compactly than in a
+    L{Write} box, to peers which have agreed to receive it so (see
+    L{Virtual}).
+
+    It is sent with C{sendBox}, like a box, so that it keeps its place among
+    any boxes held back while TLS is started.
+
+    @ivar id: the id of the virtual connection.
+
+    @ivar data: the data, of no more than C{MAX_VALUE_LENGTH} octets.
+    """
+
+    def __init__(self, id, data):
+        self.id = id
+        self.data = data
+
+
+    def serialize(self):
+        """
+        @return: the frame, as it is written to the wire.
+        """
+        return _frameHeader.pack(
+            _frameKey.size, 0, self.id, len(self.data)) + self.data
+
+
+
 class Listen(Command):
     """
     A simple command for registering interest with an active Q2Q connection
@@ -81,11 +134,23 @@ class Listen(Command):
 class Virtual(Command):
     """
     Initiate a virtual multiplexed connection over this TCP connection.
+
+    Each side may give the number of octets it will accept before it sends a
+    L{WindowUpdate}, as C{window}.  If both do, the connection is flow
+    controlled with credit windows; otherwise, by L{Choke} and L{Unchoke}.
+
+    Likewise, if both sides set C{frames}, the data for the connection may be
+    sent in L{DataFrame}s rather than L{Write} boxes.
     """
     commandName = 'virtual'
     result = []
 
-    arguments = [('id', Integer())]
+    arguments = [('id', Integer()),
+                 ('window', Integer(optional=True)),
+                 ('frames', Boolean(optional=True))]
+
+    response = [('window', Integer(optional=True)),
+                ('frames', Boolean(optional=True))]
 
     def makeResponse(cls, objects, proto):
         """
@@ -234,6 +299,18 @@ class Unchoke(Command):
 
 
 
+class WindowUpdate(Command):
+    """
+    Flow control: allow the peer to send this many more octets over this
+    virtual channel.
+    """
+    commandName = 'window-update'
+    arguments = [('id', Integer()),
+                 ('credit', Integer())]
+    requiresAnswer = False
+
+
+
 class WhoAmI(Command):
     """
     Send a response identifying TCP host and port of the sender.  This is used
@@ -0,0 +1,272 @@
+# -*- test-case-name: vertex.test.test_congestion -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Congestion control algorithms for L{vertex.ptcp}.
+
+A congestion controller owns the congestion window (C{cwnd}) and slow start
+threshold (C{ssthresh}) of a single L{vertex.ptcp.PTCPConnection}.  The
+connection is responsible for detecting acknowledgements, duplicate
+acknowledgements and retransmission timeouts; the controller only decides
+what those events do to the window.  All window values are in octets.
+"""
+
+# The slow start threshold before any loss has been seen; effectively
+# infinite.
+_INITIAL_SSTHRESH = 2 ** 31
+
+
+
+def initialWindow(mss):
+    """
+    Compute the initial congestion window for a connection, as per RFC 3390.
+
+    @param mss: The maximum segment size of the connection, in octets.
+    @type mss: L{int}
+
+    @return: The initial congestion window, in octets.
+    @rtype: L{int}
+    """
+    return min(4 * mss, max(2 * mss, 4380))
+
+
+
+class NewReno(object):
+    """
+    The NewReno congestion control algorithm: slow start, additive increase
+    and multiplicative decrease, as described by RFC 5681 and RFC 6582.
+
+    @ivar mss: The maximum segment size of the connection.
+    @type mss: L{int}
+
+    @ivar cwnd: The congestion window; the number of octets which may be
+        outstanding in the network.
+    @type cwnd: L{int}
+
+    @ivar ssthresh: The slow start threshold.  While C{cwnd} is below this
+        value, the window grows exponentially.
+    @type ssthresh: L{int}
+    """
+
+    name = 'newreno'
+
+    def __init__(self, mss):
+        """
+        @param mss: The maximum segment size of the connection.
+        @type mss: L{int}
+        """
+        self.mss = mss
+        self.cwnd = initialWindow(mss)
+        self.ssthresh = _INITIAL_SSTHRESH
+        self._avoidanceCredit = 0
+
+
+    def __repr__(self):
+        return '<%s cwnd=%d ssthresh=%d>' % (
+            self.__class__.__name__, self.cwnd, self.ssthresh)
+
+
+    def setMSS(self, mss):
+        """
+        The maximum segment size of the connection has changed, as a result of
+        a path MTU change.  Keep the window the same number of segments large.
+
+        @param mss: The new maximum segment size.
+        @type mss: L{int}
+        """
+        segments = max(1, self.cwnd // self.mss)
+        self.mss = mss
+        self.cwnd = segments * mss
+
+
+    def inSlowStart(self):
+        """
+        @return: L{True} if the window is currently growing exponentially.
+        """
+        return self.cwnd < self.ssthresh
+
+
+    def _reduce(self, flight):
+        """
+        Compute a new slow start threshold following a loss.
+
+        @param flight: The number of octets that were outstanding when the loss
+            was detected.
+        @type flight: L{int}
+        """
+        self.ssthresh = max(flight // 2, 2 * self.mss)
+
+
+    def acked(self, ackedBytes, now):
+        """
+        New data has been cumulatively acknowledged outside of loss recovery;
+        grow the window.
+
+        @param ackedBytes: The number of newly acknowledged octets.
+        @type ackedBytes: L{int}
+
+        @param now: The current time, in seconds.
+        @type now: L{float}
+        """
+        if self.inSlowStart():
+            # RFC 3465: appropriate byte counting, limited to one segment per
+            # acknowledgement.
+            self.cwnd += min(ackedBytes, self.mss)
+        else:
+            self._avoidanceCredit += ackedBytes
+            if self._avoidanceCredit >= self.cwnd:
+                self._avoidanceCredit -= self.cwnd
+                self.cwnd += self.mss
+
+
+    def lossDetected(self, flight, now):
+        """
+        Three duplicate acknowledgements have arrived; a segment has been
+        lost and is about to be fast-retransmitted.  Enter fast recovery.
+
+        @param flight: The number of octets outstanding when the loss was
+            detected.
+        @type flight: L{int}
+
+        @param now: The current time, in seconds.
+        @type now: L{float}
+        """
+        self._reduce(flight)
+        self.cwnd = self.ssthresh + 3 * self.mss
+        self._avoidanceCredit = 0
+
+
+    def duplicateAck(self):
+        """
+        An additional duplicate acknowledgement arrived during fast recovery,
+        meaning another segment has left the network; inflate the window.
+        """
+        self.cwnd += self.mss
+
+
+    def partialAck(self, ackedBytes):
+        """
+        An acknowledgement arrived during fast recovery which covered some,
+        but not all, of the data outstanding when recovery began.  Deflate the
+        window by the amount acknowledged, as per RFC 6582 section 3.2.
+
+        @param ackedBytes: The number of newly acknowledged octets.
+        @type ackedBytes: L{int}
+        """
+        self.cwnd = max(self.cwnd - ackedBytes, 0)
+        if ackedBytes >= self.mss:
+            self.cwnd += self.mss
+        self.cwnd = max(self.cwnd, self.mss)
+
+
+    def recoveryComplete(self, flight, now):
+        """
+        All of the data outstanding when fast recovery began has been
+        acknowledged; deflate the window.
+
+        @param flight: The number of octets still outstanding.
+        @type flight: L{int}
+
+        @param now: The current time, in seconds.
+        @type now: L{float}
+        """
+        self.cwnd = min(self.ssthresh, max(flight, self.mss) + self.mss)
+
+
+    def timeout(self, flight, now):
+        """
+        The retransmission timer expired.  Collapse the window to a single
+        segment and start over in slow start.
+
+        @param flight: The number of octets outstanding when the timer fired.
+        @type flight: L{int}
+
+        @param now: The current time, in seconds.
+        @type now: L{float}
+        """
+        self._reduce(flight)
+        self.cwnd = self.mss
+        self._avoidanceCredit = 0
+
+
+
+class Cubic(NewReno):
+    """
+    The CUBIC congestion control algorithm, as described by RFC 8312.
+
+    CUBIC shares NewReno's slow start and fast recovery, but grows the window
+    in congestion avoidance as a cubic function of the time since the last
+    loss rather than linearly per round trip, so that long, fat paths are
+    filled quickly.
+
+    @ivar wMax: The window, in segments, just before the last reduction.
+    @type wMax: L{float}
+
+    @ivar epochStart: The time at which the current congestion avoidance
+        epoch began, or L{None} if it has not yet begun.
+    @type epochStart: L{float} or L{None}
+    """
+
+    name = 'cubic'
+
+    # Multiplicative decrease factor and scaling constant, from RFC 8312.
+    beta = 0.7
+    C = 0.4
+
+    def __init__(self, mss):
+        NewReno.__init__(self, mss)
+        self.wMax = 0.0
+        self.epochStart = None
+        self._k = 0.0
+        self._renoWindow = 0.0
+
+
+    def _reduce(self, flight):
+        segments = float(self.cwnd) / self.mss
+        if segments < self.wMax:
+            # Fast convergence: release bandwidth for newer flows.
+            self.wMax = segments * (1.0 + self.beta) / 2.0
+        else:
+            self.wMax = segments
+        self.ssthresh = max(int(flight * self.beta), 2 * self.mss)
+        self.epochStart = None
+
+
+    def acked(self, ackedBytes, now):
+        if self.inSlowStart():
+            NewReno.acked(self, ackedBytes, now)
+            return
+        mss = float(self.mss)
+        segments = self.cwnd / mss
+        if self.epochStart is None:
+            self.epochStart = now
+            if segments < self.wMax:
+                self._k = ((self.wMax - segments) / self.C) ** (1.0 / 3.0)
+            else:
+                self._k = 0.0
+                self.wMax = segments
+            self._renoWindow = segments
+        t = now - self.epochStart
+        target = self.C * (t - self._k) ** 3 + self.wMax
+        # The TCP-friendly region: never grow more slowly than NewReno would.
+        self._renoWindow += (
+            (3.0 * (1.0 - self.beta) / (1.0 + self.beta))
+            * (ackedBytes / mss) / segments)
+        target = max(target, self._renoWindow)
+        if target > segments:
+            # Approach the target over (roughly) one round trip, but never
+            # more than one segment per acknowledged segment.
+            increase = (target - segments) * (ackedBytes / mss) / segments
+            self._avoidanceCredit += min(increase, ackedBytes / mss) * mss
+        else:
+            # Grow very slowly while we are at or above the target.
+            self._avoidanceCredit += ackedBytes / 100.0
+        if self._avoidanceCredit >= 1:
+            grow = int(self._avoidanceCredit)
+            self._avoidanceCredit -= grow
+            self.cwnd += grow
+
+
+
+controllers = {NewReno.name: NewReno, Cubic.name: Cubic}
@@ -27,6 +27,13 @@ class NoAttemptsMade(ConnectionError):
 
 
 
+class FlowControlError(Exception):
+    """
+    The peer on a virtual connection sent more data than it was allowed to.
+    """
+
+
+
 class VerifyError(Exception):
     """
     An error occurred while verifying or authenticating a certificate.
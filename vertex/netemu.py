@@ -0,0 +1,229 @@
+# -*- test-case-name: vertex.test.test_netemu -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+An in-process emulation of an imperfect network path, for measuring
+datagram protocols such as L{vertex.ptcp.PTCP} under controlled conditions.
+
+An L{EmulatedLink} joins two datagram protocols.  Each direction of the link
+delays, jitters, drops, reorders, duplicates and rate-limits the datagrams
+sent over it as described by its L{LinkConditions}, using its own seeded
+random number generator, so that a run with the same seed on the same clock
+always sees the same network.
+"""
+
+import random
+
+import attr
+
+from twisted.internet import address, defer
+
+
+
+@attr.s
+class LinkConditions(object):
+    """
+    The behaviour of one direction of an L{EmulatedLink}.
+
+    @ivar delay: the one-way propagation delay, in seconds.
+    @type delay: L{float}
+
+    @ivar jitter: the most, in seconds, by which a datagram's delay varies
+        from C{delay}, either way.  Jitter of more than the gap between two
+        datagrams reorders them.
+    @type jitter: L{float}
+
+    @ivar loss: the probability that a datagram is dropped.
+    @type loss: L{float}
+
+    @ivar reorder: the probability that a datagram is held back for an extra
+        C{delay}, so that those sent after it overtake it.
+    @type reorder: L{float}
+
+    @ivar duplicate: the probability that a datagram is delivered twice.
+    @type duplicate: L{float}
+
+    @ivar bandwidth: the rate, in octets per second, at which datagrams are
+        put onto the link, or L{None} for no limit.
+    @type bandwidth: L{float} or L{None}
+
+    @ivar queueSize: the most octets which may wait to be put onto the link
+        before newly sent datagrams are dropped, or L{None} for no limit.
+        Only meaningful with a C{bandwidth}.
+    @type queueSize: L{int} or L{None}
+    """
+
+    delay = attr.ib(default=0.0)
+    jitter = attr.ib(default=0.0)
+    loss = attr.ib(default=0.0)
+    reorder = attr.ib(default=0.0)
+    duplicate = attr.ib(default=0.0)
+    bandwidth = attr.ib(default=None)
+    queueSize = attr.ib(default=None)
+
+
+
+class _Direction(object):
+    """
+    One direction of an L{EmulatedLink}.
+
+    @ivar conditions: the L{LinkConditions} datagrams are sent under.
+
+    @ivar sent: the number of datagrams sent in this direction.
+
+    @ivar dropped: the number of datagrams dropped, either at random or
+        because the queue was full.
+
+    @ivar delivered: the number of datagrams delivered, counting duplicates.
+
+    @ivar _busyUntil: the time at which the last datagram queued will have
+        been put onto the link.
+    """
+
+    def __init__(self, clock, conditions, random, receiver):
+        self.clock = clock
+        self.conditions = conditions
+        self.random = random
+        self.receiver = receiver
+        self.sent = 0
+        self.dropped = 0
+        self.delivered = 0
+        self._busyUntil = 0.0
+
+
+    def send(self, datagram, source):
+        """
+        Send a datagram to the other end of the link, subject to its
+        conditions.
+
+        @param source: the address the datagram appears to come from.
+        """
+        conditions = self.conditions
+        self.sent += 1
+        now = self.clock.seconds()
+        departure = now
+        if conditions.bandwidth is not None:
+            start = max(now, self._busyUntil)
+            if (conditions.queueSize is not None and
+                (start - now) * conditions.bandwidth > conditions.queueSize):
+                self.dropped += 1
+                return
+            departure = self._busyUntil = (
+                start + len(datagram) / float(conditions.bandwidth))
+        if self.random.random() < conditions.loss:
+            self.dropped += 1
+            return
+        copies = 1
+        if self.random.random() < conditions.duplicate:
+            copies = 2
+        for i in range(copies):
+            delay = conditions.delay
+            if conditions.jitter:
+                delay = max(0.0, delay + self.random.uniform(
+                        -conditions.jitter, conditions.jitter))
+            if self.random.random() < conditions.reorder:
+                delay += conditions.delay
+            self.clock.callLater(departure - now + delay,
+                                 self._deliver, datagram, source)
+
+
+    def _deliver(self, datagram, source):
+        self.delivered += 1
+        if self.receiver.protocol is not None:
+            self.receiver.protocol.datagramReceived(datagram, source)
+
+
+
+class _LinkEnd(object):
+    """
+    One end of an L{EmulatedLink}: a datagram transport, like a listening
+    UDP port, for the protocol at that end.
+
+    @ivar protocol: the protocol at this end, or L{None} once it has
+        stopped.
+    """
+
+    protocol = None
+    _direction = None
+
+    def __init__(self, host, port):
+        self._address = address.IPv4Address('UDP', host, port)
+
+
+    def write(self, datagram, addr=None):
+        """
+        Send a datagram to the other end of the link.  Whatever address it is
+        sent to, it arrives at the other end.
+        """
+        if self.protocol is not None:
+            self._direction.send(
+                datagram, (self._address.host, self._address.port))
+
+
+    def getHost(self):
+        return self._address
+
+
+    def stopListening(self):
+        """
+        Stop the protocol at this end.  Datagrams which arrive afterwards are
+        thrown away.
+        """
+        if self.protocol is not None:
+            protocol, self.protocol = self.protocol, None
+            protocol.doStop()
+        return defer.succeed(None)
+
+
+
+class EmulatedLink(object):
+    """
+    A point-to-point link between two datagram protocols, each of which sees
+    the other end as a peer at a fixed address.
+
+    @ivar forward: the direction from C{a} to C{b}; its C{conditions},
+        C{sent}, C{dropped} and C{delivered} describe it.
+    @ivar backward: the direction from C{b} to C{a}.
+
+    @ivar a: the transport of the first protocol.
+    @ivar b: the transport of the second protocol.
+    """
+
+    addressA = ('10.0.0.1', 4321)
+    addressB = ('10.0.0.2', 1234)
+
+    def __init__(self, clock, forward=None, backward=None, seed=0):
+        """
+        @param clock: an C{IReactorTime} provider, such as a
+            L{twisted.internet.task.Clock}, on which to schedule deliveries.
+
+        @param forward: the L{LinkConditions} from C{a} to C{b}; a perfect
+            link by default.
+
+        @param backward: the L{LinkConditions} from C{b} to C{a}; the same as
+            C{forward} by default.
+
+        @param seed: the seed for the link's random number generators.
+        """
+        if forward is None:
+            forward = LinkConditions()
+        if backward is None:
+            backward = forward
+        self.a = _LinkEnd(*self.addressA)
+        self.b = _LinkEnd(*self.addressB)
+        self.forward = _Direction(
+            clock, forward, random.Random(seed), self.b)
+        self.backward = _Direction(
+            clock, backward, random.Random(seed + 1), self.a)
+        self.a._direction = self.forward
+        self.b._direction = self.backward
+
+
+    def connect(self, protocolA, protocolB):
+        """
+        Start two datagram protocols at either end of the link.
+        """
+        for end, protocol in [(self.a, protocolA), (self.b, protocolB)]:
+            end.protocol = protocol
+            protocol.makeConnection(end)
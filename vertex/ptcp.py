@@ -2,25 +2,35 @@
 
 from __future__ import print_function
 
+import os
+import random
 import struct
+import bisect
+import heapq
 
-from binascii import crc32  # used to use zlib.crc32 - but that gives different
-                            # results on 64-bit platforms!!
+# zlib.crc32 once gave different results on 64-bit platforms; it no longer
+# does, and is faster than binascii.crc32, but its results are still signed,
+# so they are masked before use.
+from zlib import crc32
 
-import itertools
+from collections import deque, OrderedDict
 
 from tcpdfa import TCP
+from vertex import congestion
 
 from twisted.python.failure import Failure
 from twisted.internet.defer import Deferred
 from twisted.internet import protocol, error, reactor, defer
 from twisted.internet.main import CONNECTION_DONE
+from twisted.internet.interfaces import IHalfCloseableProtocol
 from twisted.python import log, util
 
-genConnID = itertools.count(8).next
-
 MAX_PSEUDO_PORT = (2 ** 16)
 
+# Pseudo-port 1 is the one PTCP ports listen on; connections we open use the
+# ones from here up.
+MIN_CLIENT_PSEUDO_PORT = 8
+
 _packetFormat = ('!' # WTF did you think
                  'H' # sourcePseudoPort
                  'H' # destPseudoPort
@@ -28,16 +38,71 @@ _packetFormat = ('!' # WTF did you think
                  'L' # acknowledgementNumber
                  'L' # window
                  'B' # flags
-                 'l' # checksum
-                     # (signed because of binascii.crc32)
+                 'L' # checksum
                  'H' # dlen
                  )
-_fixedSize = struct.calcsize(_packetFormat)
+_packetStruct = struct.Struct(_packetFormat)
+_fixedSize = _packetStruct.size
+
+# Just the destination pseudo-port, for deciding which process should handle
+# a datagram without decoding all of it; see vertex.ptcpshard.
+_destPortStruct = struct.Struct('!H')
+_destPortOffset = struct.calcsize('!H')
 
 SEND_DELAY = 0.00001
-ACK_DELAY = 0.00001
+# How long to hold back an acknowledgement, in the hope that it can ride
+# along with data, or cover another segment; RFC 1122 section 4.2.3.2.
+ACK_DELAY = 0.1
+
+_SYN, _ACK, _FIN, _RST, _STB, _SACK, _PROBE, _HCRC = [
+    1 << n for n in range(8)]
+
+# Originally the checksum covered only the data of a packet (and later its
+# SACK blocks), leaving the header unprotected.  On a SYN packet, the HCRC
+# flag means that the sender understands checksums which cover the header
+# too.  On any other packet, it means that the checksum covers the header,
+# taken with the checksum field zeroed, after the options and data; as for
+# UDP, a checksum of zero then means that the sender did not compute one, and
+# one which comes out as zero is sent as all ones instead.  SYN packets
+# themselves always carry the original sort of checksum, so that peers which
+# predate the flag can still be connected to.
+_checksumMask = 0xffffffff
+
+# On a SYN packet, the PROBE flag means that the sender can answer path MTU
+# probes.  On any other packet, it marks a probe: a segment whose data is
+# padding, which takes up no sequence space, and which the receiver answers
+# with a packet with both the STB and PROBE flags set, giving the length of
+# the padding which arrived.  (A packet with only the STB flag says that a
+# segment arrived truncated to the given length.)
+
+# On a SYN packet, the SACK flag means that the sender understands selective
+# acknowledgements.  On any other packet, it means that the fixed header is
+# followed by a one-octet count of SACK blocks and then the blocks themselves,
+# each a pair of wire sequence numbers giving the left edge and right edge
+# (one past the end) of a run of data held out of order by the receiver.  The
+# payload comes after the blocks.
+_sackCountStruct = struct.Struct('!B')
+_sackCountSize = _sackCountStruct.size
+_sackBlockStruct = struct.Struct('!LL')
+_sackBlockSize = _sackBlockStruct.size
+
+# Compiled formats for a block count followed by that many blocks, keyed by
+# the number of blocks.
+_sackStructs = {}
+
+def _encodeSackBlocks(sackBlocks):
+    """
+    Encode some SACK blocks for the wire.
 
-_SYN, _ACK, _FIN, _RST, _STB = [1 << n for n in range(5)]
+    @param sackBlocks: a sequence of (left edge, right edge) pairs of wire
+    sequence numbers.
+    """
+    count = len(sackBlocks)
+    packer = _sackStructs.get(count)
+    if packer is None:
+        packer = _sackStructs[count] = struct.Struct('!B' + 'LL' * count)
+    return packer.pack(count, *[edge for block in sackBlocks
+                                for edge in block])
 
 def _flagprop(flag):
     def setter(self, value):
@@ -60,7 +125,54 @@ def relativeSequence(wireSequence, initialSequence, lapNumber):
     """
     return (wireSequence + (lapNumber * (2**32))) - initialSequence
 
-class PTCPPacket(util.FancyStrMixin, object):
+
+def sequenceLap(wireSequence, initialSequence, reference):
+    """
+    Work out how many times a sequence number received on the wire has
+    wrapped around 2**32, on the assumption that it is the one nearest to a
+    relative sequence number we already know, such as the next one we expect.
+    This holds for as long as no segment strays more than 2**31 from it.
+
+    @param wireSequence: the sequence number received on the wire.
+
+    @param initialSequence: the ISN for this sequence, negotiated at SYN time.
+
+    @param reference: a relative sequence number close to the one sent.
+
+    @return: a lap number to pass to C{relativeSequence}.
+    """
+    delta = (wireSequence - initialSequence - reference) % (2**32)
+    if delta >= 2**31:
+        delta -= 2**32
+    return (reference + delta + initialSequence - wireSequence) // (2**32)
+
+class PTCPPacket(object):
+    """
+    A single PTCP segment.
+
+    Instances are slotted, since a busy connection keeps a great many of them
+    alive in its retransmission and reassembly queues.
+
+    @ivar checksum: The checksum of this packet as it was last encoded or
+    decoded.
+
+    @ivar _payloadChecksum: The checksum of the options and data of this
+    packet, or C{None} if it has not been needed yet.  It is computed at most
+    once and reused each time the packet is encoded, so the payload must not
+    be changed afterwards; the header may be, as it is for retransmissions.
+
+    @ivar retransmitsLeft: The number of retransmit attempts left for this
+    segment, starting from L{retransmitCount}.  When it reaches zero, this
+    segment is dead.
+    """
+
+    __slots__ = (
+        'sourcePseudoPort', 'destPseudoPort', 'seqNum', 'ackNum', 'window',
+        'flags', 'checksum', 'dlen', 'data', 'peerAddressTuple', 'sackBlocks',
+        'seqOffset', 'ackOffset', 'seqLaps', 'ackLaps', 'destination',
+        'retransmitsLeft', 'sentAt', 'retransmitted', 'lost', 'sacked',
+        'sendIndex', '_options', '_payloadChecksum')
+
     showAttributes = (
         ('sourcePseudoPort', 'sourcePseudoPort', '%d'),
         ('destPseudoPort', 'destPseudoPort', '%d'),
@@ -71,18 +183,27 @@ class PTCPPacket(util.FancyStrMixin, object):
         ('ackNum', 'ack', '%d'),
         ('checksum', 'checksum', '%x'),
         ('peerAddressTuple', 'peerAddress', '%r'),
-        ('retransmitCount', 'retransmitCount', '%d'),
+        ('retransmitsLeft', 'retransmitsLeft', '%d'),
+        ('sackBlocks', 'sackBlocks', '%r'),
         )
 
+    # FancyStrMixin itself has no __slots__, so inheriting from it would give
+    # every packet a __dict__ after all; borrow its implementation instead.
+    __str__ = __repr__ = util.FancyStrMixin.__dict__['__str__']
+
     syn = _flagprop(_SYN)
     ack = _flagprop(_ACK)
     fin = _flagprop(_FIN)
     rst = _flagprop(_RST)
     stb = _flagprop(_STB)
+    sack = _flagprop(_SACK)
+    probe = _flagprop(_PROBE)
+    hcrc = _flagprop(_HCRC)
 
-    # Number of retransmit attempts left for this segment.  When it reaches
-    # zero, this segment is dead.
-    retransmitCount = 50
+    # Number of retransmit attempts a new segment gets.  Since the
+    # retransmission timeout backs off exponentially, this is considerably
+    # fewer attempts than it would take at a fixed interval.
+    retransmitCount = 15
 
     def shortdata():
         def get(self):
@@ -98,7 +219,8 @@ class PTCPPacket(util.FancyStrMixin, object):
             res = []
             for (f, v) in [
                 (self.syn, 'S'), (self.ack, 'A'), (self.fin, 'F'),
-                (self.rst, 'R'), (self.stb, 'T')]:
+                (self.rst, 'R'), (self.stb, 'T'), (self.sack, 'K'),
+                (self.probe, 'P'), (self.hcrc, 'H')]:
                 res.append(f and v or '.')
             return ''.join(res)
         return get,
@@ -109,17 +231,28 @@ class PTCPPacket(util.FancyStrMixin, object):
                seqNum, ackNum, data,
                window=(1 << 15),
                syn=False, ack=False, fin=False,
-               rst=False, stb=False,
-               destination=None):
+               rst=False, stb=False, sack=False, sackBlocks=(),
+               probe=False, hcrc=False, destination=None):
+        flags = 0
+        if syn:
+            flags |= _SYN
+        if ack:
+            flags |= _ACK
+        if fin:
+            flags |= _FIN
+        if rst:
+            flags |= _RST
+        if stb:
+            flags |= _STB
+        if sack or sackBlocks:
+            flags |= _SACK
+        if probe:
+            flags |= _PROBE
+        if hcrc:
+            flags |= _HCRC
         i = cls(sourcePseudoPort, destPseudoPort,
                 seqNum, ackNum, window,
-                0, 0, len(data), data)
-        i.syn = syn
-        i.ack = ack
-        i.fin = fin
-        i.rst = rst
-        i.stb = stb
-        i.checksum = i.computeChecksum()
+                flags, 0, len(data), data, sackBlocks=sackBlocks)
         i.destination = destination
         return i
     create = classmethod(create)
@@ -130,7 +263,8 @@ class PTCPPacket(util.FancyStrMixin, object):
                  destPseudoPort,
                  seqNum, ackNum, window, flags,
                  checksum, dlen, data, peerAddressTuple=None,
-                 seqOffset=0, ackOffset=0, seqLaps=0, ackLaps=0):
+                 seqOffset=0, ackOffset=0, seqLaps=0, ackLaps=0,
+                 sackBlocks=()):
         self.sourcePseudoPort = sourcePseudoPort
         self.destPseudoPort = destPseudoPort
         self.seqNum = seqNum
@@ -141,16 +275,49 @@ class PTCPPacket(util.FancyStrMixin, object):
         self.dlen = dlen
         self.data = data
         self.peerAddressTuple = peerAddressTuple # None if local
+        self.sackBlocks = sackBlocks
+        self.destination = None
 
         self.seqOffset = seqOffset
         self.ackOffset = ackOffset
         self.seqLaps = seqLaps
         self.ackLaps = ackLaps
 
+        self.retransmitsLeft = self.retransmitCount
+
+        # The time, according to the reactor, at which this segment was most
+        # recently sent, or None if it has not been sent yet.
+        self.sentAt = None
+
+        # Whether this segment has been sent more than once.  Per Karn's
+        # algorithm, acknowledgements of retransmitted segments are ambiguous
+        # and must not be used to measure the round trip time.
+        self.retransmitted = False
+
+        # Whether this segment is believed to have left the network without
+        # being received, and so needs to be retransmitted.
+        self.lost = False
+
+        # Whether the receiver has selectively acknowledged this segment, and
+        # so it need not be retransmitted.
+        self.sacked = False
+
+        # The value of the sending connection's transmission counter when
+        # this segment was most recently sent; used to tell which segments
+        # were sent before which others.
+        self.sendIndex = 0
+
+        # The encoded SACK blocks, if any, filled in on first use.
+        self._options = None
+        self._payloadChecksum = None
+
     def segmentLength(self):
         """RFC page 26: 'The segment length (SEG.LEN) includes both data and sequence
         space occupying controls'
         """
+        if self.flags & _PROBE and not self.flags & _SYN:
+            # The data of a probe is only padding.
+            return self.syn + self.fin
         return self.dlen + self.syn + self.fin
 
     def relativeSeq(self):
@@ -160,26 +327,99 @@ class PTCPPacket(util.FancyStrMixin, object):
         return relativeSequence(self.ackNum, self.ackOffset, self.ackLaps)
 
 
-    def verifyChecksum(self):
+    def verifyLength(self):
+        """
+        Check that all of the data of a received packet arrived, and nothing
+        more.
+        """
         if len(self.data) != self.dlen:
             if len(self.data) > self.dlen:
                 raise GarbageDataError(self)
             else:
                 raise TruncatedDataError(self)
-        expected = self.computeChecksum()
+
+    def verifyChecksum(self):
+        """
+        Check the length and the checksum of a received packet.
+        """
+        self.verifyLength()
         received = self.checksum
+        if not received and self.flags & (_HCRC | _SYN) == _HCRC:
+            # Our peer left it to the layers above to notice corruption.
+            return
+        expected = self.computeChecksum()
         if expected != received:
             raise ChecksumMismatchError(expected, received)
 
+    def encodedOptions(self):
+        """
+        @return: the SACK blocks of this packet as they appear on the wire,
+        or the empty string if there are none.
+        """
+        if self._options is None:
+            if self.sackBlocks:
+                self._options = _encodeSackBlocks(self.sackBlocks)
+            else:
+                self._options = ''
+        return self._options
+
+    def _wireFlags(self):
+        """
+        @return: the flags of this packet as they appear on the wire, where the
+        SACK flag on anything but a SYN says whether there are SACK blocks.
+        """
+        flags = self.flags
+        if not flags & _SYN:
+            if self.sackBlocks:
+                flags |= _SACK
+            else:
+                flags &= ~_SACK
+        return flags
+
     def computeChecksum(self):
-        return crc32(self.data)
+        """
+        @return: the checksum this packet should carry, given its flags.
+        """
+        payload = self._payloadChecksum
+        if payload is None:
+            if self.sackBlocks:
+                payload = crc32(self.data, crc32(self.encodedOptions()))
+            else:
+                payload = crc32(self.data)
+            self._payloadChecksum = payload
+        flags = self._wireFlags()
+        if flags & (_HCRC | _SYN) != _HCRC:
+            return payload & _checksumMask
+        header = _packetStruct.pack(
+            self.sourcePseudoPort, self.destPseudoPort,
+            self.seqNum, self.ackNum, self.window,
+            flags, 0, len(self.data))
+        return (crc32(header, payload) & _checksumMask) or _checksumMask
 
     def decode(cls, bytes, hostPortPair):
-        fields = struct.unpack(_packetFormat, bytes[:_fixedSize])
-        sourcePseudoPort, destPseudoPort, seq, ack, window, flags, checksum, dlen = fields
-        data = bytes[_fixedSize:]
+        (sourcePseudoPort, destPseudoPort, seq, ack, window, flags, checksum,
+         dlen) = _packetStruct.unpack_from(bytes)
+        sackBlocks = ()
+        options = ''
+        if (flags & (_SACK | _SYN) == _SACK
+            and len(bytes) > _fixedSize):
+            [count] = _sackCountStruct.unpack_from(bytes, _fixedSize)
+            start = _fixedSize + _sackCountSize
+            end = start + count * _sackBlockSize
+            if len(bytes) >= end:
+                sackBlocks = tuple([
+                    _sackBlockStruct.unpack_from(bytes, offset)
+                    for offset in xrange(start, end, _sackBlockSize)])
+                options = bytes[_fixedSize:end]
+            # If the blocks were truncated, so was the data after them, and
+            # verifyChecksum will notice.
+            data = bytes[end:]
+        else:
+            data = bytes[_fixedSize:]
         pkt = cls(sourcePseudoPort, destPseudoPort, seq, ack, window, flags,
-                  checksum, dlen, data, hostPortPair)
+                  checksum, dlen, data, hostPortPair, sackBlocks=sackBlocks)
+        if sackBlocks:
+            pkt._options = options
         return pkt
     decode = classmethod(decode)
 
@@ -191,18 +431,29 @@ class PTCPPacket(util.FancyStrMixin, object):
         Packets which contain a connection-state changing flag (SYN or FIN) or
         a non-zero amount of data can be retransmitted.
         """
-        if self.syn or self.fin or self.dlen:
+        if self.syn or self.fin or self.segmentLength():
             return True
         return False
 
-    def encode(self):
-        dlen = len(self.data)
-        checksum = self.computeChecksum()
-        return struct.pack(
-            _packetFormat,
+    def encode(self, checksum=True):
+        """
+        @param checksum: whether to compute a checksum, if this packet's flags
+            allow it to be left out.
+
+        @return: this packet as it appears on the wire.
+        """
+        flags = self._wireFlags()
+        options = ''
+        if flags & _SACK and not flags & _SYN:
+            options = self.encodedOptions()
+        if checksum or flags & (_HCRC | _SYN) != _HCRC:
+            self.checksum = self.computeChecksum()
+        else:
+            self.checksum = 0
+        return _packetStruct.pack(
             self.sourcePseudoPort, self.destPseudoPort,
             self.seqNum, self.ackNum, self.window,
-            self.flags, checksum, dlen) + self.data
+            flags, self.checksum, len(self.data)) + options + self.data
 
     def fragment(self, mtu):
         if self.dlen < mtu:
@@ -210,21 +461,26 @@ class PTCPPacket(util.FancyStrMixin, object):
         assert not self.syn, "should not be originating syn packets w/ data"
         seqOfft = 0
         L = []
-        # XXX TODO: need to take seqLaps into account, etc.
         for chunk in iterchunks(self.data, mtu):
+            laps, seqNum = divmod(
+                self.seqNum + self.seqLaps * (2**32) + seqOfft, 2**32)
             last = self.create(self.sourcePseudoPort,
                                self.destPseudoPort,
-                               self.seqNum + seqOfft,
+                               seqNum,
                                self.ackNum,
                                chunk,
                                self.window,
                                destination=self.destination,
-                               ack=self.ack)
+                               ack=self.ack,
+                               hcrc=self.hcrc)
+            last.seqOffset = self.seqOffset
+            last.seqLaps = laps
             L.append(last)
             seqOfft += len(chunk)
         if self.fin:
+            # Checksums which cover the flags are computed as the packet is
+            # encoded, so this does not invalidate one.
             last.fin = self.fin
-            last.checksum = last.computeChecksum()
         return L
 
 
@@ -240,9 +496,13 @@ def iterchunks(data, chunksize):
 def ISN():
     """
     Initial Sequence Number generator.
+
+    Sequence numbers are chosen at random, so that an off-path attacker
+    cannot guess which will be acceptable to a connection, and so that
+    segments left over from an earlier connection between the same pseudo
+    ports are unlikely to be; RFC 6528.
     """
-    # return int((time.time() * 1000000) / 4) % 2**32
-    return 0
+    return struct.unpack('!L', os.urandom(4))[0]
 
 
 
@@ -273,6 +533,514 @@ def ackAcceptable(SND_UNA, SEG_ACK, SND_NXT):
 
 
 
+class _SendBuffer(object):
+    """
+    The data written to a connection which has not been put into segments
+    yet.
+
+    Written strings are queued as they are, and segments are cut from the
+    front of the queue, so that taking a segment's worth of data only copies
+    that much, no matter how much is buffered behind it.
+
+    @ivar _chunks: a L{deque} of the strings written, oldest first.
+
+    @ivar _offset: the number of octets at the start of C{_chunks[0]} which
+    have already been taken.
+
+    @ivar _size: the number of octets buffered.
+    """
+
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0
+        self._size = 0
+
+
+    def __len__(self):
+        return self._size
+
+
+    def append(self, data):
+        """
+        Add a string to the end of the buffer.
+        """
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+
+    def extend(self, seq):
+        """
+        Add each of a sequence of strings to the end of the buffer, without
+        joining them together.
+        """
+        for data in seq:
+            self.append(data)
+
+
+    def read(self, amount):
+        """
+        Remove and return up to C{amount} octets from the front of the buffer.
+        """
+        pieces = []
+        chunks = self._chunks
+        while amount and chunks:
+            chunk = chunks[0]
+            end = self._offset + amount
+            if self._offset or end < len(chunk):
+                piece = chunk[self._offset:end]
+            else:
+                piece = chunk
+            pieces.append(piece)
+            amount -= len(piece)
+            self._size -= len(piece)
+            if end >= len(chunk):
+                chunks.popleft()
+                self._offset = 0
+            else:
+                self._offset = end
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+
+
+class _RetransmissionQueue(object):
+    """
+    The segments which have been sent but not yet cumulatively acknowledged,
+    oldest first, indexed by relative sequence number.
+
+    Acknowledged segments are trimmed from the front by moving C{_head} past
+    them rather than by deleting them from the list, which is only compacted
+    once they make up half of it, so that trimming costs nothing per segment
+    left in the queue.  Since segments are queued in sequence order,
+    C{_sequences} is sorted, and the segments covering any range of the
+    sequence space can be found by bisecting it.
+
+    @ivar _sequences: the relative sequence number of each segment in
+    C{_packets}.
+
+    @ivar _packets: the L{PTCPPacket}s queued, including any already trimmed
+    from the front and not yet compacted away.
+
+    @ivar _head: the index in C{_packets} of the oldest segment still queued.
+    """
+
+    # The fewest trimmed segments worth compacting away.
+    _compactThreshold = 64
+
+    def __init__(self):
+        self._sequences = []
+        self._packets = []
+        self._head = 0
+
+
+    def __len__(self):
+        return len(self._packets) - self._head
+
+
+    def __iter__(self):
+        # Indexed afresh each time around, so that segments may be split by
+        # L{fragment} while the queue is being walked.
+        index = self._head
+        while index < len(self._packets):
+            yield self._packets[index]
+            index += 1
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._packets[self._head + index]
+
+
+    def append(self, seq, packet):
+        """
+        Queue a segment sent after all of those already queued.
+
+        @param seq: the segment's relative sequence number.
+        """
+        self._sequences.append(seq)
+        self._packets.append(packet)
+
+
+    def trim(self, ack):
+        """
+        Remove the segments which a cumulative acknowledgement covers.
+
+        @param ack: the relative sequence number acknowledged.
+
+        @return: a L{list} of the L{PTCPPacket}s removed, oldest first.
+        """
+        start = index = self._head
+        sequences, packets = self._sequences, self._packets
+        while (index < len(packets) and
+               sequences[index] + packets[index].segmentLength() <= ack):
+            index += 1
+        acked = packets[start:index]
+        self._head = index
+        if index >= self._compactThreshold and index * 2 >= len(packets):
+            del sequences[:index]
+            del packets[:index]
+            self._head = 0
+        return acked
+
+
+    def segmentAt(self, seq):
+        """
+        Find the segment which starts at a given relative sequence number.
+
+        @return: a L{PTCPPacket}, or C{None} if no segment still queued
+        starts there.
+        """
+        index = bisect.bisect_left(self._sequences, seq, self._head)
+        if index < len(self._packets) and self._sequences[index] == seq:
+            return self._packets[index]
+        return None
+
+
+    def covered(self, left, right):
+        """
+        Find the segments which lie entirely within a range of the sequence
+        space, such as a SACK block.
+
+        @param left: the relative sequence number of the start of the range.
+
+        @param right: the relative sequence number just after its end.
+
+        @return: a L{list} of L{PTCPPacket}s, oldest first.
+        """
+        sequences, packets = self._sequences, self._packets
+        index = bisect.bisect_left(sequences, left, self._head)
+        found = []
+        while (index < len(packets) and
+               sequences[index] + packets[index].segmentLength() <= right):
+            found.append(packets[index])
+            index += 1
+        return found
+
+
+    def fragment(self, seq, mtu):
+        """
+        Split the queued segment at the given position into segments no
+        larger than C{mtu}, which take its place in the queue, and its
+        C{lost}, C{sacked} and C{sendIndex} with them.
+
+        @param seq: the relative sequence number of the segment.
+
+        @return: a L{list} of the new segments.
+        """
+        index = bisect.bisect_left(self._sequences, seq, self._head)
+        packet = self._packets[index]
+        fragments = packet.fragment(mtu)
+        offset = seq
+        sequences = []
+        for fragment in fragments:
+            fragment.lost = packet.lost
+            fragment.sacked = packet.sacked
+            fragment.sendIndex = packet.sendIndex
+            sequences.append(offset)
+            offset += fragment.dlen
+        self._sequences[index:index + 1] = sequences
+        self._packets[index:index + 1] = fragments
+        return fragments
+
+
+
+class _ReassemblyQueue(object):
+    """
+    A buffer for segments which arrived ahead of the next one expected, kept
+    sorted by relative sequence number so that contiguous runs of them can be
+    delivered as soon as the gap before them is filled.
+
+    @ivar limit: the maximum number of octets of segment data to hold.
+
+    @ivar size: the number of octets of segment data currently held.
+
+    @ivar _latest: the segment most recently buffered, or C{None}.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self._sequences = []
+        self._segments = []
+        self._latest = None
+
+
+    def __len__(self):
+        return len(self._segments)
+
+
+    def insert(self, packet):
+        """
+        Hold on to a segment until everything before it has arrived.
+
+        @param packet: a L{PTCPPacket} with a non-zero segment length.
+
+        @return: C{True} if the segment was buffered, C{False} if it was
+        discarded because it duplicates one already held or there is no room
+        for it.
+        """
+        seq = packet.relativeSeq()
+        index = bisect.bisect_left(self._sequences, seq)
+        if (index < len(self._sequences) and self._sequences[index] == seq
+            and (self._segments[index].segmentLength() >=
+                 packet.segmentLength())):
+            return False
+        if self.size + packet.dlen > self.limit:
+            return False
+        if index < len(self._sequences) and self._sequences[index] == seq:
+            # A longer segment at the same position, such as one re-sent
+            # after the peer's segment size grew, replaces the shorter one.
+            self.size -= self._segments[index].dlen
+            self._segments[index] = packet
+        else:
+            self._sequences.insert(index, seq)
+            self._segments.insert(index, packet)
+        self.size += packet.dlen
+        self._latest = packet
+        return True
+
+
+    def blocks(self, limit):
+        """
+        Describe the runs of contiguous data held, for reporting to the peer
+        in SACK blocks.  As per RFC 2018 section 4, the first run is the one
+        containing the segment most recently buffered.
+
+        @param limit: the maximum number of runs to describe.
+
+        @return: a L{list} of up to C{limit} (left edge, right edge) pairs of
+        relative sequence numbers.
+        """
+        runs = []
+        for packet in self._segments:
+            seq = packet.relativeSeq()
+            end = seq + packet.segmentLength()
+            if runs and seq <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([seq, end])
+        if self._latest is not None:
+            latest = self._latest.relativeSeq()
+            for index, (left, right) in enumerate(runs):
+                if left <= latest < right:
+                    runs.insert(0, runs.pop(index))
+                    break
+        return [tuple(run) for run in runs[:limit]]
+
+
+    def pop(self, nextSeq):
+        """
+        Remove and return the held segment which continues the stream at
+        C{nextSeq}, discarding any which lie entirely before it.
+
+        @param nextSeq: the relative sequence number of the next octet
+        expected.
+
+        @return: a L{PTCPPacket} whose relative sequence number is at most
+        C{nextSeq} and which extends beyond it, or C{None} if the next segment
+        has not arrived yet.
+        """
+        while self._sequences and self._sequences[0] <= nextSeq:
+            del self._sequences[0]
+            packet = self._segments.pop(0)
+            self.size -= packet.dlen
+            if packet.relativeSeq() + packet.segmentLength() > nextSeq:
+                return packet
+        return None
+
+
+    def clear(self):
+        """
+        Discard all held segments.
+        """
+        del self._sequences[:]
+        del self._segments[:]
+        self.size = 0
+        self._latest = None
+
+
+
+class _WheelTimer(object):
+    """
+    A call scheduled on a L{_TimerWheel}.  Like L{IDelayedCall}, it can be
+    cancelled and reset until it has been called.
+
+    @ivar deadline: the time at which the call is due.
+
+    @ivar called: whether the call has been made.
+
+    @ivar cancelled: whether the call has been cancelled.
+    """
+
+    __slots__ = ('wheel', 'deadline', 'func', 'args', 'kw', 'called',
+                 'cancelled', '_tick')
+
+    def __init__(self, wheel, deadline, func, args, kw):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.called = False
+        self.cancelled = False
+        self._tick = None
+
+
+    def getTime(self):
+        return self.deadline
+
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+
+    def cancel(self):
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+        self.cancelled = True
+        self.wheel._remove(self)
+
+
+    def reset(self, secondsFromNow):
+        if self.cancelled:
+            raise error.AlreadyCancelled()
+        if self.called:
+            raise error.AlreadyCalled()
+        self.wheel._remove(self)
+        self.deadline = reactor.seconds() + secondsFromNow
+        self.wheel._add(self)
+
+
+
+class _TimerWheel(object):
+    """
+    A hashed timer wheel, which multiplexes the timers of all the connections
+    on one L{PTCP} onto a single reactor call.
+
+    Timers are hashed into C{slots} buckets by the C{tick}-long interval of
+    time their deadline falls into, so scheduling and cancelling a timer does
+    not depend on how many others there are.  The reactor call is always
+    scheduled for the earliest deadline, and makes every call that is due by
+    the time it runs.
+
+    @ivar tick: the length of time covered by each bucket, in seconds.
+    """
+
+    def __init__(self, tick=0.005, slots=256):
+        self.tick = tick
+        self._slots = [set() for i in xrange(slots)]
+        self._count = 0
+        # The earliest tick which might still hold due timers.
+        self._cursor = None
+        self._wake = None
+        # Whether _expire is making calls, and so will wake itself up again
+        # once they are done.
+        self._expiring = False
+
+
+    def __len__(self):
+        return self._count
+
+
+    def callLater(self, delay, func, *args, **kw):
+        """
+        Like L{IReactorTime.callLater}.
+
+        @return: a L{_WheelTimer}.
+        """
+        timer = _WheelTimer(self, reactor.seconds() + delay, func, args, kw)
+        self._add(timer)
+        return timer
+
+
+    def _add(self, timer):
+        timer._tick = int(timer.deadline / self.tick)
+        if not self._count:
+            self._cursor = int(reactor.seconds() / self.tick)
+        self._cursor = min(self._cursor, timer._tick)
+        self._slots[timer._tick % len(self._slots)].add(timer)
+        self._count += 1
+        if self._expiring:
+            pass
+        elif self._wake is None:
+            self._wake = reactor.callLater(
+                max(0, timer.deadline - reactor.seconds()), self._expire)
+        elif timer.deadline < self._wake.getTime():
+            self._wake.reset(max(0, timer.deadline - reactor.seconds()))
+
+
+    def _remove(self, timer):
+        if timer._tick is None:
+            # It is due, and about to be called by _expire.
+            return
+        self._slots[timer._tick % len(self._slots)].remove(timer)
+        timer._tick = None
+        self._count -= 1
+        if not self._count and self._wake is not None:
+            self._wake.cancel()
+            self._wake = None
+
+
+    def _expire(self):
+        """
+        Make every call which is due, then wait for the next one.
+        """
+        self._wake = None
+        now = reactor.seconds()
+        last = int(now / self.tick)
+        slots = self._slots
+        if last - self._cursor >= len(slots):
+            ticks = xrange(len(slots))
+        else:
+            ticks = xrange(self._cursor, last + 1)
+        due = []
+        for tick in ticks:
+            slot = slots[tick % len(slots)]
+            for timer in [timer for timer in slot if timer.deadline <= now]:
+                slot.remove(timer)
+                timer._tick = None
+                due.append(timer)
+        self._count -= len(due)
+        self._cursor = last
+        due.sort(key=lambda timer: timer.deadline)
+        self._expiring = True
+        for timer in due:
+            # An earlier call may have cancelled or reset this one.
+            if not timer.cancelled and timer._tick is None:
+                timer.called = True
+                try:
+                    timer.func(*timer.args, **timer.kw)
+                except:
+                    log.err()
+        self._expiring = False
+        if self._count:
+            self._wake = reactor.callLater(
+                max(0, self._nextDeadline() - reactor.seconds()),
+                self._expire)
+
+
+    def _nextDeadline(self):
+        """
+        @return: the earliest deadline of any timer on the wheel.
+        """
+        slots = self._slots
+        for tick in xrange(self._cursor, self._cursor + len(slots)):
+            deadlines = [timer.deadline for timer in slots[tick % len(slots)]
+                         if timer._tick == tick]
+            if deadlines:
+                return min(deadlines)
+        # Everything is more than a revolution away.
+        return min([timer.deadline for slot in slots for timer in slot])
+
+
+
 class BadPacketError(Exception):
     """
     A packet was bad for some reason.
@@ -295,6 +1063,173 @@ class GarbageDataError(Exception):
 
 
 
+class PTCPStatistics(object):
+    """
+    Counters describing the traffic carried by one L{PTCPConnection}, or, when
+    merged, by several.  Keeping them up to date costs an addition or two per
+    segment.
+
+    @ivar connections: the number of connections counted.
+
+    @ivar segmentsSent: the number of segments sent, including
+    retransmissions.
+
+    @ivar bytesSent: the number of octets of data sent, including
+    retransmissions.
+
+    @ivar segmentsReceived: the number of segments received.
+
+    @ivar bytesReceived: the number of octets of data received, including
+    duplicates.
+
+    @ivar retransmits: the number of segments sent more than once.
+
+    @ivar bytesRetransmitted: the number of octets of data sent more than
+    once.
+
+    @ivar timeouts: the number of times the retransmission timer expired.
+
+    @ivar duplicateSegments: the number of segments received which carried
+    nothing we had not already received.
+
+    @ivar outOfOrderSegments: the number of segments received after a gap.
+
+    @ivar rttSamples: the number of round trip times measured.
+
+    @ivar rttTotal: the sum of the round trip times measured, in seconds.
+
+    @ivar minRTT: the shortest round trip time measured, or C{None}.
+
+    @ivar maxRTT: the longest round trip time measured, or C{None}.
+
+    @ivar pacedSegments: the number of times the pacer has held back a
+    segment which the windows would have let us send.
+
+    @ivar pacingDelay: the total time, in seconds, for which the pacer has
+    held back segments.
+
+    @ivar stateTime: a mapping of the names of L{TCP} states to the number of
+    seconds spent in each.
+
+    @ivar congestionWindow: the congestion window, in octets, when the
+    statistics were taken.
+
+    @ivar sendWindow: the window our peer advertised, in octets, when the
+    statistics were taken.
+
+    @ivar receiveWindow: the window we advertised, in octets, when the
+    statistics were taken.
+
+    @ivar smoothedRTT: the smoothed round trip time when the statistics were
+    taken, or C{None}.
+
+    @ivar openConnections: the number of connections counted which were
+    still open when the statistics were taken.
+
+    @ivar halfOpenConnections: the number of those which were waiting for
+    the last step of a handshake which our peer began.
+
+    @ivar timeWaitConnections: the number of those which were in TIME-WAIT.
+
+    @ivar synsDropped: the number of SYNs a L{PTCP} port ignored because its
+    connection table was full.
+
+    @ivar halfOpenEvicted: the number of half-open connections a L{PTCP} port
+    threw away to make room for newer ones.
+
+    @ivar keepAliveProbes: the number of keepalive probes sent.
+
+    @ivar deadPeers: the number of connections abandoned because the peer
+    stopped answering; see L{PTCP.keepAlive}.
+
+    The window sizes and counts of open connections are summed when
+    statistics are merged, and C{smoothedRTT} is only given for a single
+    connection.
+    """
+
+    _counters = ('connections', 'segmentsSent', 'bytesSent',
+                 'segmentsReceived', 'bytesReceived', 'retransmits',
+                 'bytesRetransmitted', 'timeouts', 'duplicateSegments',
+                 'outOfOrderSegments', 'rttSamples', 'rttTotal',
+                 'pacedSegments', 'pacingDelay', 'congestionWindow',
+                 'sendWindow', 'receiveWindow', 'openConnections',
+                 'halfOpenConnections', 'timeWaitConnections', 'synsDropped',
+                 'halfOpenEvicted', 'keepAliveProbes', 'deadPeers')
+
+    smoothedRTT = None
+
+    def __init__(self):
+        for name in self._counters:
+            setattr(self, name, 0)
+        self.rttTotal = self.pacingDelay = 0.0
+        self.minRTT = self.maxRTT = None
+        self.stateTime = {}
+
+
+    def __repr__(self):
+        return '<%s connections=%d sent=%d/%d received=%d/%d retransmits=%d>' % (
+            self.__class__.__name__, self.connections, self.segmentsSent,
+            self.bytesSent, self.segmentsReceived, self.bytesReceived,
+            self.retransmits)
+
+
+    def meanRTT():
+        doc = """
+        The mean of the round trip times measured, or C{None} if there have
+        not been any.
+        """
+        def get(self):
+            if not self.rttSamples:
+                return None
+            return self.rttTotal / self.rttSamples
+        return get, None, None, doc
+    meanRTT = property(*meanRTT())
+
+
+    def measuredRTT(self, sample):
+        """
+        Record a round trip time measurement.
+
+        @param sample: the round trip time, in seconds.
+        """
+        self.rttSamples += 1
+        self.rttTotal += sample
+        if self.minRTT is None or sample < self.minRTT:
+            self.minRTT = sample
+        if self.maxRTT is None or sample > self.maxRTT:
+            self.maxRTT = sample
+
+
+    def copy(self):
+        """
+        @return: a new L{PTCPStatistics} with the same values as this one.
+        """
+        other = PTCPStatistics()
+        other.merge(self)
+        other.smoothedRTT = self.smoothedRTT
+        return other
+
+
+    def merge(self, other):
+        """
+        Add the values of another L{PTCPStatistics} to this one.
+
+        @param other: a L{PTCPStatistics}.
+        """
+        for name in self._counters:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if other.minRTT is not None and (self.minRTT is None or
+                                         other.minRTT < self.minRTT):
+            self.minRTT = other.minRTT
+        if other.maxRTT is not None and (self.maxRTT is None or
+                                         other.maxRTT > self.maxRTT):
+            self.maxRTT = other.maxRTT
+        for state, seconds in other.stateTime.iteritems():
+            self.stateTime[state] = self.stateTime.get(state, 0.0) + seconds
+        self.smoothedRTT = None
+
+
+
 class PTCPConnection(object):
     """
     Implementation of RFC 793 state machine.
@@ -311,37 +1246,231 @@ class PTCPConnection(object):
     not-yet-extant octet in the stream at
     self._outgoingBytes[len(self._outgoingBytes)].
 
-    @ivar nextRecvSeqNum: (TCP RFC: RCV.NXT) The next (relative) sequence
-    number that the peer should send to us if they want to send more data;
-    their first unacknowledged sequence number as far as we are concerned; the
-    left or lower edge of the receive window; the sequence number of the first
-    octet that has not been delivered to the application.  changed whenever we
-    receive an appropriate ACK.
+    @ivar nextRecvSeqNum: (TCP RFC: RCV.NXT) The next (relative) sequence
+    number that the peer should send to us if they want to send more data;
+    their first unacknowledged sequence number as far as we are concerned; the
+    left or lower edge of the receive window; the sequence number of the first
+    octet that has not been delivered to the application.  changed whenever we
+    receive an appropriate ACK.
+
+    @ivar peerSendISN: the initial sequence number that the peer sent us during
+    the negotiation phase.  All peer-relative sequence numbers are computed
+    using this.  (see C{relativeSequence}).
+
+    @ivar hostSendISN: the initial sequence number that the we sent during the
+    negotiation phase.  All host-relative sequence numbers are computed using
+    this.  (see C{relativeSequence})
+
+    @ivar retransmissionQueue: a L{_RetransmissionQueue} of packets to be
+    re-sent until their acknowledgements come through.
+
+    @ivar _outgoingBytes: a L{_SendBuffer} of data written by the application
+    which has not been sent yet.
+
+    @ivar _reassemblyQueue: a L{_ReassemblyQueue} of segments which arrived
+    within the receive window but after a gap, waiting for the gap to be
+    filled.
+
+    @ivar recvWindow: the size [in octets] of our receive buffer: the most
+    data we will hold on behalf of the application, counting both data which
+    has arrived but not been delivered (see C{_undelivered}) and the window
+    (TCP RFC: RCV.WND) we advertise to our peer.
+
+    @ivar sendWindow: (TCP RFC: SND.WND) - the size [in octets] of the current
+    window allowed by our peer, to be in transit from us; the most recent
+    value of the C{window} field of its packets.
+
+    @ivar _undelivered: a list of strings which have arrived in order but
+    have not been delivered to the application because the transport is
+    paused (see L{pauseProducing}).
+
+    @ivar _undeliveredSize: the total length of C{_undelivered}.
+
+    @ivar _finReceived: whether our peer's FIN has arrived but not yet been
+    acted upon, because there is still data in C{_undelivered}.
+
+    @ivar _advertisedEdge: the relative sequence number one past the end of
+    the window we most recently advertised.  We never advertise a window
+    which ends before this, and only move it forward in large steps, so as to
+    avoid the silly window syndrome (RFC 1122 section 4.2.3.3).
+
+    @ivar _windowUpdateSeq: (TCP RFC: SND.WL1) the relative sequence number of
+    the packet used to last update C{sendWindow}.
+
+    @ivar _windowUpdateAck: (TCP RFC: SND.WL2) the relative acknowledgement
+    number of the packet used to last update C{sendWindow}.
+
+    @ivar congestion: the congestion controller (see L{vertex.congestion})
+    which decides how many octets may be in flight at once.
+
+    @ivar smoothedRTT: (RFC 6298: SRTT) the smoothed round trip time to our
+    peer, in seconds, or None if it has not been measured yet.
+
+    @ivar rttVariation: (RFC 6298: RTTVAR) the smoothed mean deviation of the
+    round trip time to our peer, in seconds, or None if it has not been
+    measured yet.
+
+    @ivar _retransmitTimeout: (RFC 6298: RTO) the number of seconds to wait for
+    an acknowledgement before retransmitting, computed from C{smoothedRTT} and
+    C{rttVariation}.
+
+    @ivar _backoff: the number of times the retransmission timer has expired
+    since an acknowledgement last made progress.  The timer is set for
+    C{_retransmitTimeout} doubled this many times.
+
+    @ivar _pipe: the number of octets which we have sent and believe are still
+    in the network; that is, those in the retransmission queue which are
+    neither acknowledged nor known to be lost.
+
+    @ivar _lostSegments: the number of segments in the retransmission queue
+    which are believed to be lost and have not yet been retransmitted.
+
+    @ivar _lostSequences: a heap of the relative sequence numbers of those
+    segments, so that the oldest can be retransmitted first without walking
+    the queue.  Segments may have been acknowledged or retransmitted since
+    they were added; they are skipped once they reach the top.
+
+    @ivar _sackedIndices: the C{sendIndex} of each segment in the
+    retransmission queue which is C{sacked}, in order.
+
+    @ivar _sendLog: C{(sendIndex, left, right)} for each transmission of a
+    segment in the retransmission queue, in the order they were sent, which
+    might yet have to be marked lost; see L{_markSackedLosses}.
+
+    @ivar _dupAcks: the number of consecutive duplicate acknowledgements
+    received for C{oldestUnackedSendSeqNum}.
+
+    @ivar _inRecovery: whether we are currently in fast recovery, having
+    fast-retransmitted a segment in response to duplicate acknowledgements.
+
+    @ivar _recover: (RFC 6582: recover) the value of C{nextSendSeqNum} when
+    the most recent loss recovery began.  Fast recovery ends once everything
+    up to this point has been acknowledged, and duplicate acknowledgements
+    below it do not start a new recovery.
+
+    @ivar sackPermitted: whether both we and our peer asked to use selective
+    acknowledgements (RFC 2018) in our SYN packets.  If so, our
+    acknowledgements describe what is in C{_reassemblyQueue}, and the
+    acknowledgements we receive mark segments in C{retransmissionQueue} as
+    C{sacked}, so that only the holes between them are retransmitted.
+
+    @ivar headerChecksums: whether both we and our peer offered, in our SYN
+    packets, to use checksums which cover the packet header as well as its
+    payload.  If so, all of our later packets carry them, and may leave them
+    out altogether if the port's C{checksums} says to.
+
+    @ivar _transmissions: the number of segments we have sent, including
+    retransmissions; see L{PTCPPacket.sendIndex}.
+
+    @ivar _recoveryIndex: the value of C{_transmissions} when the most recent
+    loss recovery began.
+
+    @ivar mtu: the largest amount of data to put in one segment.  It starts
+    out small enough for any path, and is raised by path MTU discovery.
+
+    @ivar pathMTUProbing: whether both we and our peer offered to answer path
+    MTU probes in our SYN packets.  If so, we look for the largest segment
+    which gets through to our peer by sending it probes (RFC 4821), starting
+    with the largest size we are willing to use, C{maxMTU}, and then
+    searching between the largest size known to work and the smallest known
+    not to.
+
+    @ivar _probeSize: the size of the outstanding probe, or C{None}.
+
+    @ivar _probeHigh: the size above which we will not probe, because a
+    probe of that size was lost C{maxProbes} times.
+
+    @ivar _probeAttempts: the number of probes of C{_probeSize} sent so far.
+
+    @ivar _probeTimer: the timer for the outstanding probe, or for the next
+    search once one has finished, or C{None}.
+
+    @ivar _paceTokens: the number of octets the pacer will let us send right
+    away.  Segments are only sent while there are enough tokens for them;
+    tokens accumulate at C{pacingRate}, up to C{_paceBurst} segments' worth.
 
-    @ivar peerSendISN: the initial sequence number that the peer sent us during
-    the negotiation phase.  All peer-relative sequence numbers are computed
-    using this.  (see C{relativeSequence}).
+    @ivar _paceStamp: the time at which C{_paceTokens} was last brought up to
+    date.
 
-    @ivar hostSendISN: the initial sequence number that the we sent during the
-    negotiation phase.  All host-relative sequence numbers are computed using
-    this.  (see C{relativeSequence})
+    @ivar _paceTimer: the timer which will send more segments once the pacer
+    has accumulated enough tokens for them, or C{None}.
 
-    @ivar retransmissionQueue: a list of packets to be re-sent until their
-    acknowledgements come through.
+    @ivar stats: the L{PTCPStatistics} counting this connection's traffic; see
+    also L{statistics}.
 
-    @ivar recvWindow: (TCP RFC: RCV.WND) - the size [in octets] of the current
-    window allowed by this host, to be in transit from the other host.
+    @ivar _state: the name of the state machine's current state.
 
-    @ivar sendWindow: (TCP RFC: SND.WND) - the size [in octets] of the current
-    window allowed by our peer, to be in transit from us.
+    @ivar _stateEntered: the time at which the state machine entered its
+    current state.
+
+    @ivar _segmentsUnacked: the number of in-order data segments received
+    since we last sent an acknowledgement.
+
+    @ivar _lastHeard: the time at which our peer last sent us anything.
+
+    @ivar _keepAliveTimer: the timer which checks whether we have heard from
+    our peer lately, if keepalives are enabled, or C{None}.
 
+    @ivar _keepAlivesUnanswered: the number of keepalive probes sent since we
+    last heard from our peer.
+
+    @ivar _disconnectReason: the exception the application is given when the
+    connection ends.
     """
 
+    # The segment size to use until path MTU discovery finds a larger one:
+    # small enough that it will get through practically any path.
     mtu = 512 - _fixedSize
 
-    recvWindow = mtu
+    # The largest segment size to probe for: a full Ethernet frame, less the
+    # IPv4 and UDP headers.
+    maxMTU = 1500 - 20 - 8 - _fixedSize
+
+    # The smallest segment size a report of a truncated segment can shrink
+    # the segment size to: what fits in the smallest datagram every IPv4
+    # link must carry whole, 68 octets (RFC 791), after the IPv4 and UDP
+    # headers.  No real path truncates segments to less.
+    minMTU = 68 - 20 - 8 - _fixedSize
+
+    # The number of times a probe of one size may be lost before deciding it
+    # is too big; RFC 4821 section 7.6.1.
+    maxProbes = 3
+
+    # Stop searching once the largest size known to work and the smallest
+    # known not to are this close together.
+    _probeGranularity = 32
+
+    # How long to wait before searching for a larger segment size again, once
+    # a search has finished short of maxMTU; RFC 4821 section 7.7.
+    _probeRaiseInterval = 600.0
+
+    # The pacer spreads a window of segments over a round trip, sending
+    # faster than cwnd / SRTT so that the window can still grow: twice as
+    # fast in slow start, and a little faster afterwards.
+    _slowStartPacingGain = 2.0
+    _pacingGain = 1.25
+
+    # The most segments the pacer will send back to back.
+    _paceBurst = 2
+
+    # Unlike TCP's, the window field of the PTCP header is 32 bits wide, so
+    # windows of more than 64k can be advertised without a window scale
+    # option.
+    recvWindow = 1 << 18
     sendWindow = mtu
-    sendWindowRemaining = mtu * 2
+
+    # The number of duplicate acknowledgements which trigger a fast
+    # retransmit; RFC 5681 section 3.2.
+    dupAckThreshold = 3
+
+    # The most SACK blocks to put in one acknowledgement.
+    maxSackBlocks = 4
+
+    # Acknowledge at least every this many in-order data segments, rather
+    # than waiting for the delayed acknowledgement timer; RFC 5681 section
+    # 4.2.
+    delayedAckSegments = 2
+    _segmentsUnacked = 0
 
     protocol = None
 
@@ -352,16 +1481,56 @@ class PTCPConnection(object):
         self.peerPseudoPort = peerPseudoPort
         self.ptcp = ptcp
         self.factory = factory
-        self._receiveBuffer = []
-        self.retransmissionQueue = []
+        self._outgoingBytes = _SendBuffer()
+        self._reassemblyQueue = _ReassemblyQueue(self.recvWindow)
+        self.retransmissionQueue = _RetransmissionQueue()
         self.peerAddressTuple = peerAddressTuple
 
         self.oldestUnackedSendSeqNum = 0
         self.nextSendSeqNum = 0
-        self.hostSendISN = 0
+        self.hostSendISN = ISN()
         self.nextRecvSeqNum = 0
         self.peerSendISN = 0
         self.setPeerISN = False
+        self.congestion = ptcp.congestionControl(self.mtu)
+        self._pipe = 0
+        self._lostSegments = 0
+        self._lostSequences = []
+        self._sackedIndices = []
+        self._sendLog = deque()
+        self._dupAcks = 0
+        self._inRecovery = False
+        self._recover = 0
+        self.smoothedRTT = None
+        self.rttVariation = None
+        self._backoff = 0
+        self.sackPermitted = False
+        self.headerChecksums = False
+        self._transmissions = 0
+        self._recoveryIndex = 0
+        self._undelivered = []
+        self._undeliveredSize = 0
+        self._finReceived = False
+        self._advertisedEdge = 0
+        self._windowUpdateSeq = -1
+        self._windowUpdateAck = 0
+        self.pathMTUProbing = False
+        self._probeSize = None
+        self._probeHigh = self.maxMTU
+        self._probeAttempts = 0
+        self._probeTimer = None
+        self._paceTokens = self._paceBurst * self.mtu
+        self._paceStamp = reactor.seconds()
+        self._paceTimer = None
+        self.stats = PTCPStatistics()
+        self.stats.connections = 1
+        self._state = 'closed'
+        self._stateEntered = reactor.seconds()
+        self._lastHeard = self._stateEntered
+        self._keepAliveTimer = None
+        self._keepAlivesUnanswered = 0
+        if peerAddressTuple is not None:
+            self._useCachedPathMTU()
         self.machine = TCP(self)
 
     peerSendISN = None
@@ -370,18 +1539,39 @@ class PTCPConnection(object):
         # XXX TODO: probably have to do something to the packet here to
         # identify its relative sequence number.
 
-        # print 'received', self, packet
+        self.stats.segmentsReceived += 1
+        self.stats.bytesReceived += packet.dlen
+        self._lastHeard = reactor.seconds()
+        self._keepAlivesUnanswered = 0
+        if self.ptcp.tracer is not None:
+            self.ptcp.tracer(self, 'receive', packet)
 
         if packet.stb:
-            # Shrink the MTU
-            [self.mtu] = struct.unpack('!H', packet.data)
-            rq = []
-            for pkt in self.retransmissionQueue:
-                rq.extend(pkt.fragment(self.mtu))
-            self.retransmissionQueue = rq
+            [mtu] = struct.unpack('!H', packet.data)
+            if packet.probe:
+                self._probeSucceeded(mtu)
+                return
+            # Shrink the MTU, but not so far that there is no room for data.
+            mtu = max(mtu, self.minMTU)
+            self._probeHigh = min(self._probeHigh, mtu)
+            if mtu >= self.mtu:
+                # We already shrank it for an earlier truncated segment.
+                return
+            self._shrinkMTU(mtu)
             return
 
-        if self._paused:
+        if packet.probe and not packet.syn:
+            # Tell the peer how much of its probe arrived.
+            self.ptcp.sendPacket(PTCPPacket.create(
+                    self.hostPseudoPort, self.peerPseudoPort, 0, 0,
+                    struct.pack('!H', packet.dlen), stb=True, probe=True,
+                    destination=self.peerAddressTuple))
+            return
+
+        if self._state == 'synSent' and not packet.syn:
+            # Until our peer's SYN arrives we cannot make sense of anything
+            # else it sends; it must have overtaken the SYN, which will be
+            # along shortly.  RFC 793, page 68.
             return
 
         if packet.syn and packet.dlen:
@@ -410,6 +1600,13 @@ class PTCPConnection(object):
                 return
             self.setPeerISN = True
             self.peerSendISN = packet.seqNum
+            self.sackPermitted = packet.sack and self.ptcp.sack
+            self.headerChecksums = (packet.hcrc
+                                    and self.ptcp.headerChecksums)
+            self.pathMTUProbing = (packet.probe
+                                   and self.ptcp.pathMTUDiscovery)
+            if self.peerAddressTuple is not None and not packet.ack:
+                self._useCachedPathMTU()
             # syn, fin, and data are mutually exclusive, so this relative
             # sequence-number increment is done both here, and below in the
             # data/fin processing block.
@@ -419,25 +1616,72 @@ class PTCPConnection(object):
                 # 'synAck' below once we've ensured the ack is acceptable.
                 self.machine.syn()
 
+        # From here on, sequence numbers are relative to the ISNs, and count
+        # on past 2**32, so that they can be compared directly.
+        packet.seqOffset = self.peerSendISN
+        packet.seqLaps = sequenceLap(packet.seqNum, self.peerSendISN,
+                                     self.nextRecvSeqNum)
+        packet.ackOffset = self.hostSendISN
+        packet.ackLaps = sequenceLap(packet.ackNum, self.hostSendISN,
+                                     self.nextSendSeqNum)
+
+        if packet.sackBlocks and self.sackPermitted:
+            self._receivedSack(packet.sackBlocks)
+
+        windowChanged = self._updateSendWindow(packet)
+
         if packet.ack and ackAcceptable(self.oldestUnackedSendSeqNum,
                                         packet.relativeAck(),
                                         self.nextSendSeqNum):
             rq = self.retransmissionQueue
-            while rq and ((rq[0].relativeSeq() + rq[0].segmentLength())
-                          <= packet.relativeAck()):
-                # fully acknowledged, as per RFC!
-                self.sendWindowRemaining += rq.pop(0).segmentLength()
-                # print 'inc send window', self, self.sendWindowRemaining
+            timed = None
+            ambiguous = False
+            # fully acknowledged, as per RFC!
+            for acked in rq.trim(packet.relativeAck()):
+                if acked.lost:
+                    self._lostSegments -= 1
+                elif acked.sacked:
+                    self._forgetSacked(acked)
+                else:
+                    self._pipe -= acked.segmentLength()
+                if acked.retransmitted or acked.sentAt is None:
+                    # This acknowledgement may have been sent in response to
+                    # a retransmission, so we can't tell how long it took.
+                    ambiguous = True
+                else:
+                    timed = acked
+            if timed is not None and not ambiguous:
+                self._measureRTT(reactor.seconds() - timed.sentAt)
+            ackedBytes = packet.relativeAck() - self.oldestUnackedSendSeqNum
+            if not self.oldestUnackedSendSeqNum:
+                # The SYN occupies sequence space, but it isn't data, and its
+                # acknowledgement shouldn't open up the window.
+                ackedBytes -= 1
             self.oldestUnackedSendSeqNum = packet.relativeAck()
+            sendLog = self._sendLog
+            while sendLog and sendLog[0][2] <= self.oldestUnackedSendSeqNum:
+                sendLog.popleft()
+            self._newAck(ackedBytes)
 
             self.machine.maybeReceiveAck(packet)
 
             if not rq:
                 # write buffer is empty; alert the application layer.
                 self._writeBufferEmpty()
+            elif (self._outgoingBytes or self._lostSegments or
+                  self._inRecovery):
+                # The window may have opened up.
+                self._writeLater()
+        elif (packet.ack and not packet.segmentLength()
+              and self.retransmissionQueue
+              and packet.relativeAck() == self.oldestUnackedSendSeqNum
+              and not windowChanged and self.sendWindow):
+            # Acknowledgements which update the window, or which answer
+            # probes of a closed one, are not duplicates; RFC 5681 section 2.
+            self._duplicateAck()
+        elif windowChanged and self._outgoingBytes:
+            self._writeLater()
 
-
-        # XXX TODO: examine 'window' field and adjust sendWindowRemaining
         # is it 'occupying a portion of valid receive sequence space'?  I think
         # this means 'packet which might acceptably contain useful data'
         if not packet.segmentLength():
@@ -445,46 +1689,273 @@ class PTCPConnection(object):
             return
 
         if not segmentAcceptable(self.nextRecvSeqNum,
-                                 self.recvWindow,
+                                 self._receiveSpace(),
                                  packet.relativeSeq(),
                                  packet.segmentLength()):
-            self.ackSoon()
+            # Either something before this segment went missing, or the
+            # peer is retransmitting something it has already told us about,
+            # because our acknowledgement of it went missing.  Either way, let
+            # the peer know where we are right away; RFC 5681 section 4.2.
+            if (not packet.syn and packet.relativeSeq() +
+                packet.segmentLength() <= self.nextRecvSeqNum):
+                self.stats.duplicateSegments += 1
+            self.originate(ack=True)
             return
 
         if packet.relativeSeq() > self.nextRecvSeqNum:
-            # XXX: Here's what's going on.  Data can be 'in the window', but
-            # still in the future.  For example, if I have a window of length 3
-            # and I send segments DATA1(len 1) DATA2(len 1) FIN and you receive
-            # them in the order FIN DATA1 DATA2, you don't actually want to
-            # process the FIN until you've processed the data.
-
-            # For the moment we are just dropping anything that isn't exactly
-            # the next thing we want to process.  This is perfectly valid;
-            # these packets might have been dropped, so the other end will have
-            # to retransmit them anyway.
+            # Data can be 'in the window', but still in the future.  For
+            # example, if I have a window of length 3 and I send segments
+            # DATA1(len 1) DATA2(len 1) FIN and you receive them in the order
+            # FIN DATA1 DATA2, you don't actually want to process the FIN until
+            # you've processed the data.  Hold on to it until then, and send a
+            # duplicate acknowledgement immediately so that the peer knows
+            # something went missing.
+            self.stats.outOfOrderSegments += 1
+            self._reassemblyQueue.insert(packet)
+            self.originate(ack=True)
             return
 
-        # OK!  It's acceptable!  Let's process the various bits of data.
-        # Where is the useful data in the packet?
-        if packet.dlen:
-            usefulData = packet.data[self.nextRecvSeqNum - packet.relativeSeq():]
-            # DONT check/slice the window size here, the acceptability code
-            # checked it, we can over-ack if the other side is buggy (???)
-
+        # OK!  It's acceptable!  Let's process the various bits of data,
+        # along with any segments it allows us to take out of the reassembly
+        # queue.
+        usefulData = []
+        fin = False
+        reassembled = False
+        while packet is not None:
+            # Where is the useful data in the packet?
+            offset = self.nextRecvSeqNum - packet.relativeSeq()
+            if offset < packet.dlen:
+                # DONT check/slice the window size here, the acceptability code
+                # checked it, we can over-ack if the other side is buggy (???)
+                usefulData.append(packet.data[offset:])
+            # Account for the segment before delivering it, so that anything
+            # the application sends in response acknowledges it.
+            self.nextRecvSeqNum = packet.relativeSeq() + packet.segmentLength()
+            if packet.fin:
+                fin = True
+                break
+            packet = self._reassemblyQueue.pop(self.nextRecvSeqNum)
+            if packet is not None:
+                reassembled = True
+
+        if usefulData:
             self.machine.segmentReceived()
+            self._undelivered.extend(usefulData)
+            for data in usefulData:
+                self._undeliveredSize += len(data)
+
+        if fin:
+            self._reassemblyQueue.clear()
+            self._finReceived = True
+        elif not reassembled:
+            # Anything the application sends in response will acknowledge
+            # this, and reset the count.
+            self._segmentsUnacked += 1
+        self._deliver()
+
+        if fin:
+            if self._finReceived:
+                # The application is paused; acknowledge the FIN, even though
+                # we can't act on it yet.
+                self.ackSoon()
+        elif reassembled:
+            # A gap was just filled; tell the peer right away, so that it can
+            # stop recovering from the loss.
+            self.originate(ack=True)
+        elif self._segmentsUnacked >= self.delayedAckSegments:
+            self._acknowledge()
+        elif self._segmentsUnacked:
+            self.ackSoon()
+
+
+    def _deliver(self):
+        """
+        Deliver any data which has arrived in order to the application, and
+        then act on our peer's FIN if it has arrived, unless the transport is
+        paused.
+        """
+        if self._paused:
+            return
+        if self._undelivered:
+            data = ''.join(self._undelivered)
+            self._undelivered = []
+            self._undeliveredSize = 0
             if self.protocol is not None:
                 try:
-                    self.protocol.dataReceived(usefulData)
+                    self.protocol.dataReceived(data)
                 except:
                     log.err()
                     self.loseConnection()
+        if self._finReceived and not self._paused:
+            self._finReceived = False
+            self.machine.fin()
 
-        self.nextRecvSeqNum += packet.segmentLength()
 
-        if packet.fin:
-            self.machine.fin()
-        elif packet.segmentLength() > 0:
-            self.ackSoon()
+    def _receiveSpace(self):
+        """
+        The number of octets of new data we have room to accept.
+        """
+        return max(0, self.recvWindow - self._undeliveredSize)
+
+
+    def _windowUpdateDue(self):
+        """
+        Would we advertise a larger window than we last did, by enough that
+        it is worth telling our peer about?
+        """
+        current = max(0, self._advertisedEdge - self.nextRecvSeqNum)
+        return (self._receiveSpace() - current
+                >= min(self.mtu, self.recvWindow // 2))
+
+
+    def _advertiseWindow(self):
+        """
+        Compute the window to advertise in a packet we are about to send.
+        """
+        window = max(0, self._advertisedEdge - self.nextRecvSeqNum)
+        if self._windowUpdateDue():
+            window = self._receiveSpace()
+        self._advertisedEdge = self.nextRecvSeqNum + window
+        return window
+
+
+    def _updateSendWindow(self, packet):
+        """
+        Take note of the window advertised in a packet from our peer, unless
+        it is older than the one we already know about; RFC 793 page 72.
+
+        @return: C{True} if the window changed.
+        """
+        if packet.ack:
+            ack = packet.relativeAck()
+            if not (self.oldestUnackedSendSeqNum <= ack
+                    <= self.nextSendSeqNum):
+                return False
+        elif packet.syn:
+            ack = 0
+        else:
+            return False
+        seq = packet.relativeSeq()
+        if (seq > self._windowUpdateSeq
+            or (seq == self._windowUpdateSeq
+                and ack >= self._windowUpdateAck)):
+            self._windowUpdateSeq = seq
+            self._windowUpdateAck = ack
+            if packet.window != self.sendWindow:
+                self.sendWindow = packet.window
+                return True
+        return False
+
+
+    def _useCachedPathMTU(self):
+        """
+        Start out with the segment size which an earlier connection found
+        would get through to our peer's host, if there was one.
+        """
+        mtu = self.ptcp.pathMTUs.get(self.peerAddressTuple[0])
+        if mtu is not None and mtu != self.mtu:
+            self.mtu = mtu
+            self.congestion.setMSS(mtu)
+
+
+    def _shrinkMTU(self, mtu):
+        """
+        Segments of the current size are not getting through; send
+        everything which is in flight again, in smaller pieces.
+        """
+        self.mtu = mtu
+        self.congestion.setMSS(mtu)
+        # Everything that was in flight, except what the peer told us it
+        # has, was too big to arrive; send it all again.  Each segment is
+        # split into smaller pieces when it is retransmitted.
+        self._markAllLost()
+        self._writeLater()
+
+
+    def _searchPathMTU(self):
+        """
+        Probe for the next segment size to try, or if the search is over,
+        schedule the next one.
+        """
+        self._probeTimer = None
+        if self.disconnecting or self.disconnected:
+            return
+        if self._probeHigh - self.mtu < self._probeGranularity:
+            self._probeSize = None
+            if self.mtu < self.maxMTU:
+                def raiseMTU():
+                    self._probeHigh = self.maxMTU
+                    self._searchPathMTU()
+                self._probeTimer = self.ptcp.timers.callLater(
+                    self._probeRaiseInterval, raiseMTU)
+            return
+        if self._probeHigh == self.maxMTU and self._probeSize is None:
+            # Most paths will take a full-sized segment; try that first.
+            self._probeSize = self.maxMTU
+        else:
+            self._probeSize = (self.mtu + self._probeHigh + 1) // 2
+        self._probeAttempts = 0
+        self._sendProbe()
+
+
+    def _sendProbe(self):
+        self._probeAttempts += 1
+        self.ptcp.sendPacket(PTCPPacket.create(
+                self.hostPseudoPort, self.peerPseudoPort,
+                seqNum=(self.nextSendSeqNum + self.hostSendISN) % (2**32),
+                ackNum=self.currentAckNum(),
+                data='\0' * self._probeSize,
+                window=self._advertiseWindow(),
+                ack=True, probe=True,
+                destination=self.peerAddressTuple))
+        self._probeTimer = self.ptcp.timers.callLater(
+            self._retransmitTimeout * 2, self._probeLost)
+
+
+    def _probeLost(self):
+        """
+        No answer came to a probe.  Try again, or if this size has been tried
+        enough times, search below it.
+        """
+        self._probeTimer = None
+        if self.disconnecting or self.disconnected:
+            return
+        if self._probeAttempts < self.maxProbes:
+            self._sendProbe()
+        else:
+            self._probeHigh = self._probeSize - 1
+            self._searchPathMTU()
+
+
+    def _probeSucceeded(self, size):
+        """
+        A probe of the given size arrived; use segments that large.
+        """
+        if size <= self.mtu or size > self._probeHigh:
+            return
+        if self._probeTimer is not None:
+            self._probeTimer.cancel()
+            self._probeTimer = None
+        self.mtu = size
+        self.congestion.setMSS(size)
+        self.ptcp.pathMTUs[self.peerAddressTuple[0]] = size
+        self._searchPathMTU()
+        if self._outgoingBytes:
+            self._writeLater()
+
+
+    def _pathMTUBlackHole(self):
+        """
+        Segments larger than the original size seem to be disappearing
+        without a trace; go back to that size, and search again later.
+        """
+        self.ptcp.pathMTUs.pop(self.peerAddressTuple[0], None)
+        self._probeHigh = self.mtu - 1
+        if self._probeTimer is not None:
+            self._probeTimer.cancel()
+        self._probeSize = None
+        self._shrinkMTU(PTCPConnection.mtu)
+        self._searchPathMTU()
 
 
     def getHost(self):
@@ -496,46 +1967,416 @@ class PTCPConnection(object):
         return PTCPAddress(self.peerAddressTuple,
                            self.pseudoPortPair)
 
-    _outgoingBytes = ''
     _nagle = None
 
     def write(self, bytes):
         assert not self.disconnected, 'Writing to a transport that was already disconnected.'
-        self._outgoingBytes += bytes
+        if self._writeDisconnecting:
+            return
+        self._outgoingBytes.append(bytes)
         self._writeLater()
 
 
     def writeSequence(self, seq):
-        self.write(''.join(seq))
+        assert not self.disconnected, 'Writing to a transport that was already disconnected.'
+        if self._writeDisconnecting:
+            return
+        self._outgoingBytes.extend(seq)
+        self._writeLater()
 
 
     def _writeLater(self):
         if self._nagle is None:
-            self._nagle = reactor.callLater(SEND_DELAY, self._reallyWrite)
+            self._nagle = self.ptcp.timers.callLater(
+                SEND_DELAY, self._reallyWrite)
+
+    def sendWindowRemaining():
+        def get(self):
+            return max(0, min(
+                    self.congestion.cwnd - self._pipe,
+                    (self.oldestUnackedSendSeqNum + self.sendWindow
+                     - self.nextSendSeqNum)))
+        return get,
+    sendWindowRemaining = property(*sendWindowRemaining())
+
+    def pacingRate():
+        doc = """
+        The rate, in octets per second, at which the pacer lets us send, or
+        C{None} if segments are not being paced.  Until the round trip time
+        has been measured, only the port's C{maxPacingRate} applies.
+        """
+        def get(self):
+            if not self.ptcp.pacing:
+                return None
+            rate = None
+            if self.smoothedRTT:
+                if self.congestion.inSlowStart():
+                    gain = self._slowStartPacingGain
+                else:
+                    gain = self._pacingGain
+                rate = gain * self.congestion.cwnd / self.smoothedRTT
+            cap = self.ptcp.maxPacingRate
+            if cap is not None and (rate is None or rate > cap):
+                rate = cap
+            return rate
+        return get, None, None, doc
+    pacingRate = property(*pacingRate())
+
+    def _paceAllows(self, size):
+        """
+        Take tokens for a segment from the pacer, if it has enough of them.
+        If it does not, arrange for L{_reallyWrite} to be called again once
+        it will.
+
+        @param size: the length of the segment's data.
+
+        @return: whether the segment may be sent now.
+        """
+        rate = self.pacingRate
+        if rate is None:
+            return True
+        now = reactor.seconds()
+        burst = self._paceBurst * self.mtu
+        self._paceTokens = min(
+            burst, self._paceTokens + (now - self._paceStamp) * rate)
+        self._paceStamp = now
+        size = min(size, burst)
+        # Less than an octet short is only rounding error; waiting for it
+        # might mean waiting for a time the clock cannot tell from now.
+        if self._paceTokens + 1 > size:
+            self._paceTokens = max(0, self._paceTokens - size)
+            return True
+        if self._paceTimer is None:
+            delay = (size - self._paceTokens) / rate
+            self.stats.pacedSegments += 1
+            self.stats.pacingDelay += delay
+            self._paceTimer = self.ptcp.timers.callLater(
+                delay, self._paceResume)
+        return False
+
+    def _paceResume(self):
+        self._paceTimer = None
+        self._reallyWrite()
+
+    def _congestionWindowRemaining(self):
+        """
+        The number of octets which the congestion window allows us to
+        retransmit.  Unlike new data, retransmissions are already within our
+        peer's window.
+        """
+        return max(0, self.congestion.cwnd - self._pipe)
+
+    def _flight(self):
+        """
+        The number of octets which have been sent but not yet acknowledged.
+        """
+        return self.nextSendSeqNum - self.oldestUnackedSendSeqNum
 
     def _originateOneData(self):
         amount = min(self.sendWindowRemaining, self.mtu)
-        sendOut = self._outgoingBytes[:amount]
-        # print 'originating data packet', len(sendOut)
-        self._outgoingBytes = self._outgoingBytes[amount:]
-        self.sendWindowRemaining -= len(sendOut)
+        sendOut = self._outgoingBytes.read(amount)
         self.originate(ack=True, data=sendOut)
 
     def _reallyWrite(self):
-        # print self, 'really writing', self._paused
         self._nagle = None
+        if self._paceTimer is not None:
+            # The pacer will call us back when it is ready.
+            return
+        self._retransmitLost()
         if self._outgoingBytes:
-            # print 'window and bytes', self.sendWindowRemaining, len(self._outgoingBytes)
-            while self.sendWindowRemaining and self._outgoingBytes:
+            # Don't send a runt segment just because the window has a little
+            # room in it; wait for a full segment's worth.
+            while (self._outgoingBytes and self.sendWindowRemaining >=
+                   min(self.mtu, len(self._outgoingBytes))):
+                if not self._paceAllows(min(self.mtu,
+                                            len(self._outgoingBytes))):
+                    return
                 self._originateOneData()
+            if self._outgoingBytes and not self.retransmissionQueue:
+                # Our peer's window is too small for what we have to send,
+                # and with nothing in flight no acknowledgement is coming to
+                # open it up.  Send what fits, or if nothing does, probe the
+                # closed window with a single octet; the retransmission timer
+                # will keep probing until the peer opens it.
+                if self.sendWindowRemaining:
+                    self._originateOneData()
+                else:
+                    self.originate(ack=True,
+                                   data=self._outgoingBytes.read(1))
+
+    def _retransmitLost(self):
+        """
+        Retransmit as many of the segments we believe were lost as the
+        congestion window allows, oldest first.
+        """
+        lost = self._lostSequences
+        if not self._lostSegments:
+            # Anything left refers to segments acknowledged since.
+            del lost[:]
+            return
+        rq = self.retransmissionQueue
+        while lost:
+            packet = rq.segmentAt(lost[0])
+            if packet is None or not packet.lost:
+                # Acknowledged, or retransmitted, since it was lost.
+                heapq.heappop(lost)
+                continue
+            # A segment bigger than the current segment size goes out in
+            # pieces, so only room for the first of them is needed.
+            if (self._congestionWindowRemaining() <
+                min(packet.segmentLength(), self.mtu)):
+                break
+            if not self._paceAllows(min(packet.dlen, self.mtu)):
+                break
+            heapq.heappop(lost)
+            self._retransmitPacket(packet)
+
+    def _retransmitPacket(self, packet):
+        """
+        Send a segment from the retransmission queue again, splitting it up
+        first if it is bigger than the current segment size.
+        """
+        if packet.dlen > self.mtu:
+            fragments = self.retransmissionQueue.fragment(
+                packet.relativeSeq(), self.mtu)
+            for fragment in fragments[1:]:
+                if fragment.lost:
+                    self._lostSegments += 1
+                    heapq.heappush(self._lostSequences,
+                                   fragment.relativeSeq())
+                elif fragment.sacked:
+                    bisect.insort(self._sackedIndices, fragment.sendIndex)
+            packet = fragments[0]
+        if packet.lost:
+            packet.lost = False
+            self._lostSegments -= 1
+            self._pipe += packet.segmentLength()
+        elif packet.sacked:
+            self._forgetSacked(packet)
+        packet.ackNum = self.currentAckNum()
+        packet.window = self._advertiseWindow()
+        packet.retransmitted = True
+        packet.sentAt = reactor.seconds()
+        self._transmissions += 1
+        packet.sendIndex = self._transmissions
+        if packet.sacked:
+            bisect.insort(self._sackedIndices, packet.sendIndex)
+        seq = packet.relativeSeq()
+        self._sendLog.append(
+            (packet.sendIndex, seq, seq + packet.segmentLength()))
+        self.stats.segmentsSent += 1
+        self.stats.bytesSent += packet.dlen
+        self.stats.retransmits += 1
+        self.stats.bytesRetransmitted += packet.dlen
+        if self.ptcp.tracer is not None:
+            self.ptcp.tracer(self, 'retransmit', packet)
+        self.ptcp.sendPacket(packet)
+
+    def _markLost(self, packet):
+        """
+        Note that a segment in the retransmission queue has left the network
+        without arriving, so that it will be retransmitted when the congestion
+        window allows.
+        """
+        if not (packet.lost or packet.sacked):
+            packet.lost = True
+            self._lostSegments += 1
+            self._pipe -= packet.segmentLength()
+            heapq.heappush(self._lostSequences, packet.relativeSeq())
+
+    def _markAllLost(self):
+        """
+        Assume that every segment in the retransmission queue has left the
+        network without arriving, except those our peer has selectively
+        acknowledged.
+        """
+        self._lostSegments = 0
+        # In sequence order, and so already a heap.
+        self._lostSequences = lost = []
+        for packet in self.retransmissionQueue:
+            if not packet.sacked:
+                packet.lost = True
+                self._lostSegments += 1
+                lost.append(packet.relativeSeq())
+        self._pipe = 0
+
+    def _forgetSacked(self, packet):
+        """
+        Stop counting a selectively acknowledged segment in
+        C{_sackedIndices}, because it has been cumulatively acknowledged or
+        is about to be sent again.
+        """
+        sacked = self._sackedIndices
+        index = bisect.bisect_left(sacked, packet.sendIndex)
+        if index < len(sacked) and sacked[index] == packet.sendIndex:
+            del sacked[index]
+
+    def _receivedSack(self, sackBlocks):
+        """
+        Our peer told us which runs of data it is holding out of order; mark
+        the segments it has as such, so that they are not retransmitted.
+
+        @param sackBlocks: a sequence of (left edge, right edge) pairs of wire
+        sequence numbers.
+        """
+        reference = self.oldestUnackedSendSeqNum
+        for (left, right) in sackBlocks:
+            left = relativeSequence(
+                left, self.hostSendISN,
+                sequenceLap(left, self.hostSendISN, reference))
+            right = relativeSequence(
+                right, self.hostSendISN,
+                sequenceLap(right, self.hostSendISN, reference))
+            for packet in self.retransmissionQueue.covered(left, right):
+                if packet.sacked:
+                    continue
+                packet.sacked = True
+                bisect.insort(self._sackedIndices, packet.sendIndex)
+                if packet.lost:
+                    packet.lost = False
+                    self._lostSegments -= 1
+                else:
+                    self._pipe -= packet.segmentLength()
+        if self._inRecovery:
+            self._markSackedLosses()
+
+    def _markSackedLosses(self):
+        """
+        Mark as lost every segment which was sent before at least
+        C{dupAckThreshold} of the segments which have since been selectively
+        acknowledged, as per RFC 6675 section 4.  Since the comparison is by
+        transmission order, a retransmitted segment is only considered lost
+        again once enough segments sent after the retransmission have arrived.
+
+        Each transmission is only considered once, as the threshold passes it
+        in C{_sendLog}: any segment sent before the threshold which is not
+        marked lost then has been selectively acknowledged, or will have
+        been sent again, and so logged again, by the time it could be.
+        """
+        sacked = self._sackedIndices
+        if len(sacked) < self.dupAckThreshold:
+            return
+        threshold = sacked[-self.dupAckThreshold]
+        sendLog = self._sendLog
+        rq = self.retransmissionQueue
+        while sendLog and sendLog[0][0] < threshold:
+            sendIndex, left, right = sendLog.popleft()
+            # The segment may have been split up since; its pieces which
+            # have not been sent again still have its sendIndex.
+            for packet in rq.covered(left, right):
+                if packet.sendIndex == sendIndex:
+                    self._markLost(packet)
+
+    def _measureRTT(self, sample):
+        """
+        Update the round trip time estimate and the retransmission timeout
+        with a new measurement, as per RFC 6298 section 2.
+
+        @param sample: the time, in seconds, between sending a segment and
+        receiving its acknowledgement.
+        """
+        self.stats.measuredRTT(sample)
+        if self.smoothedRTT is None:
+            self.smoothedRTT = sample
+            self.rttVariation = sample / 2.0
+        else:
+            self.rttVariation = (
+                (1 - self._rttBeta) * self.rttVariation +
+                self._rttBeta * abs(self.smoothedRTT - sample))
+            self.smoothedRTT = (
+                (1 - self._rttAlpha) * self.smoothedRTT +
+                self._rttAlpha * sample)
+        self._retransmitTimeout = min(
+            max(self.smoothedRTT + 4 * self.rttVariation,
+                self._minRetransmitTimeout),
+            self._maxRetransmitTimeout)
+
+    def _newAck(self, ackedBytes):
+        """
+        Some new data was acknowledged; grow the congestion window, or make
+        progress through fast recovery, and restart the retransmission timer.
+
+        @param ackedBytes: the number of octets newly acknowledged.
+        """
+        self._dupAcks = 0
+        # The peer is evidently still there, so stop backing off.  Unlike RFC
+        # 6298 section 5.7, don't wait for an unambiguous measurement first:
+        # on a lossy path every segment in flight after a timeout is a
+        # retransmission, and the timer would back off without bound.
+        self._backoff = 0
+        now = reactor.seconds()
+        if self._inRecovery:
+            if self.oldestUnackedSendSeqNum >= self._recover:
+                self._inRecovery = False
+                self.congestion.recoveryComplete(self._flight(), now)
+            else:
+                # RFC 6582: a partial acknowledgement means the next segment
+                # was lost too.
+                self.congestion.partialAck(ackedBytes)
+                if self.sackPermitted:
+                    # Only retransmit the next hole if that hasn't been done
+                    # already during this recovery; selective
+                    # acknowledgements will tell us about the rest.
+                    rq = self.retransmissionQueue
+                    if rq and rq[0].sendIndex <= self._recoveryIndex:
+                        self._retransmitPacket(rq[0])
+                    self._markSackedLosses()
+                elif self.retransmissionQueue:
+                    self._retransmitPacket(self.retransmissionQueue[0])
+        elif ackedBytes:
+            self.congestion.acked(ackedBytes, now)
+        self._cancelRetransmitTimer()
+        if self.retransmissionQueue:
+            self._retransmitLater()
+
+    def _duplicateAck(self):
+        """
+        Our peer acknowledged the same sequence number again, which means a
+        segment after it arrived but something before that went missing.
+        """
+        self._dupAcks += 1
+        if self._inRecovery:
+            if not self.sackPermitted:
+                # Without selective acknowledgements, all we know is that
+                # another segment has left the network.  With them, _pipe
+                # already accounts for it.
+                self.congestion.duplicateAck()
+            self._writeLater()
+        elif (self._dupAcks == self.dupAckThreshold and
+              self.oldestUnackedSendSeqNum > self._recover):
+            self._inRecovery = True
+            self._recover = self.nextSendSeqNum
+            self._recoveryIndex = self._transmissions
+            self.congestion.lossDetected(self._flight(), reactor.seconds())
+            self._retransmitPacket(self.retransmissionQueue[0])
+            if self.sackPermitted:
+                self._markSackedLosses()
+                self._writeLater()
 
     _retransmitter = None
+
+    # The retransmission timeout to use until the round trip time has been
+    # measured, and the bounds on it after that.
     _retransmitTimeout = 0.5
+    _minRetransmitTimeout = 0.2
+    _maxRetransmitTimeout = 60.0
+
+    # Gains for the smoothed round trip time and its variation; RFC 6298
+    # section 2.3.
+    _rttAlpha = 1 / 8.0
+    _rttBeta = 1 / 4.0
 
     def _retransmitLater(self):
         if self._retransmitter is None:
-            self._retransmitter = reactor.callLater(self._retransmitTimeout,
-                                                    self._reallyRetransmit)
+            self._retransmitter = self.ptcp.timers.callLater(
+                min(self._retransmitTimeout * 2 ** self._backoff,
+                    self._maxRetransmitTimeout),
+                self._reallyRetransmit)
+
+    def _cancelRetransmitTimer(self):
+        if self._retransmitter is not None:
+            self._retransmitter.cancel()
+            self._retransmitter = None
 
     def _stopRetransmitting(self):
         # used both as a quick-and-dirty test shutdown hack and a way to shut
@@ -549,28 +2390,135 @@ class PTCPConnection(object):
         if self._closeWaitLoseConnection is not None:
             self._closeWaitLoseConnection.cancel()
             self._closeWaitLoseConnection = None
+        if self._probeTimer is not None:
+            self._probeTimer.cancel()
+            self._probeTimer = None
+        if self._paceTimer is not None:
+            self._paceTimer.cancel()
+            self._paceTimer = None
+        if self._keepAliveTimer is not None:
+            self._keepAliveTimer.cancel()
+            self._keepAliveTimer = None
 
     def _reallyRetransmit(self):
         # XXX TODO: packet fragmentation & coalescing.
-        # print 'Wee a retransmit!  What I got?', self.retransmissionQueue
         self._retransmitter = None
-        if self.retransmissionQueue:
-            for packet in self.retransmissionQueue:
-                packet.retransmitCount -= 1
-                if packet.retransmitCount:
-                    packet.ackNum = self.currentAckNum()
-                    self.ptcp.sendPacket(packet)
-                else:
-                    self.machine.timeout()
-                    return
+        self.stats.timeouts += 1
+        rq = self.retransmissionQueue
+        if rq and not self.sendWindow:
+            # Our peer's window is closed and this is a probe of it, not a
+            # lost segment; keep probing for as long as it takes.
+            self._backoff += 1
+            self._retransmitPacket(rq[0])
+            self._retransmitLater()
+        elif rq:
+            rq[0].retransmitsLeft -= 1
+            if not rq[0].retransmitsLeft:
+                self.machine.timeout()
+                return
+            if (self._backoff and self.mtu > PTCPConnection.mtu
+                and rq[0].dlen > PTCPConnection.mtu):
+                # The second timeout in a row for a segment that would not
+                # have been this big without path MTU discovery.
+                self._pathMTUBlackHole()
+                rq = self.retransmissionQueue
+            # Nothing has been acknowledged for a whole timeout, so assume
+            # everything in flight is gone.  Collapse the window, and go back
+            # to the oldest segment; acknowledgements for it will clock out
+            # the rest of the queue through _reallyWrite.
+            self.congestion.timeout(self._flight(), reactor.seconds())
+            # Back off until the peer acknowledges something; RFC 6298 section
+            # 5.5.
+            self._backoff += 1
+            self._dupAcks = 0
+            self._inRecovery = False
+            self._recover = self.nextSendSeqNum
+            self._markAllLost()
+            self._retransmitPacket(rq[0])
             self._retransmitLater()
 
+    def _keepAliveLater(self, delay):
+        self._keepAliveTimer = self.ptcp.timers.callLater(
+            delay, self._keepAlive)
+
+    def _keepAlive(self):
+        """
+        Check whether our peer has been quiet for long enough to probe, or to
+        give up on.
+
+        Rather than resetting a timer for every packet which arrives, the
+        timer checks when we last heard from our peer and goes back to sleep
+        for however much of the idle time is left.
+        """
+        self._keepAliveTimer = None
+        ptcp = self.ptcp
+        idle = reactor.seconds() - self._lastHeard
+        if not self._keepAlivesUnanswered and idle < ptcp.keepAlive:
+            self._keepAliveLater(ptcp.keepAlive - idle)
+            return
+        if self._keepAlivesUnanswered >= ptcp.keepAliveProbes:
+            self.stats.deadPeers += 1
+            self._disconnectReason = error.ConnectionLost(
+                "PTCP peer stopped responding")
+            self.machine.timeout()
+            return
+        self._keepAlivesUnanswered += 1
+        if not self.retransmissionQueue:
+            # While there is data in flight its retransmissions ask for an
+            # answer already; only count the probe against our peer.
+            self._sendKeepAlive()
+        self._keepAliveLater(ptcp.keepAliveInterval)
+
+    def _sendKeepAlive(self):
+        """
+        Send a keepalive probe: an octet which our peer has already
+        acknowledged, which it answers with an acknowledgement of its own, as
+        for a TCP keepalive (RFC 1122 section 4.2.3.6).  Both refresh any
+        NAT mapping between us.
+        """
+        laps, seqNum = divmod(
+            self.nextSendSeqNum - 1 + self.hostSendISN, 2**32)
+        p = PTCPPacket.create(self.hostPseudoPort,
+                              self.peerPseudoPort,
+                              seqNum=seqNum,
+                              ackNum=self.currentAckNum(),
+                              data='\0',
+                              window=self._advertiseWindow(),
+                              ack=True,
+                              hcrc=self.headerChecksums,
+                              destination=self.peerAddressTuple)
+        p.seqOffset = self.hostSendISN
+        p.seqLaps = laps
+        self.stats.segmentsSent += 1
+        self.stats.keepAliveProbes += 1
+        if self.ptcp.tracer is not None:
+            self.ptcp.tracer(self, 'keepalive', p)
+        self.ptcp.sendPacket(p)
+
     disconnecting = False       # This is *TWISTED* level state-machine stuff,
                                 # not TCP-level.
+    _writeDisconnecting = False
+    _writeDisconnected = False
 
     def loseConnection(self):
         if not self.disconnecting:
             self.disconnecting = True
+            if self._writeDisconnected:
+                # Our FIN is already on its way; all that is left is to stop
+                # listening to our peer.
+                self.connectionJustEnded()
+            elif not self._outgoingBytes:
+                self._writeBufferEmpty()
+
+
+    def loseWriteConnection(self):
+        """
+        Send a FIN once everything written so far has been sent, but carry on
+        receiving data until our peer closes its half of the connection too.
+        Anything written afterwards is thrown away.
+        """
+        if not (self._writeDisconnecting or self.disconnecting):
+            self._writeDisconnecting = True
             if not self._outgoingBytes:
                 self._writeBufferEmpty()
 
@@ -584,6 +2532,15 @@ class PTCPConnection(object):
                 self.producer.resumeProducing()
         elif self.disconnecting and not self.disconnected:
             self.machine.appClose()
+        elif self._writeDisconnecting and not self._writeDisconnected:
+            self._writeDisconnected = True
+            self.machine.appHalfClose()
+            if IHalfCloseableProtocol.providedBy(self.protocol):
+                try:
+                    self.protocol.writeConnectionLost()
+                except:
+                    log.err()
+                    self.loseConnection()
 
 
     def _writeBufferFull(self):
@@ -630,6 +2587,10 @@ class PTCPConnection(object):
 
     def resumeProducing(self):
         self._paused = False
+        self._deliver()
+        if self.protocol is not None and self._windowUpdateDue():
+            # Tell our peer that there is room again.
+            self.originate(ack=True)
 
     def currentAckNum(self):
         return (self.nextRecvSeqNum + self.peerSendISN) % (2**32)
@@ -637,64 +2598,130 @@ class PTCPConnection(object):
     _ackTimer = None
     def ackSoon(self):
         """
-        Emit an acknowledgement packet soon.
+        Make sure that an acknowledgement is sent within C{ACK_DELAY}, unless
+        one goes out sooner on another packet.
         """
         if self._ackTimer is None:
-            def originateAck():
-                self._ackTimer = None
-                self.originate(ack=True)
-            self._ackTimer = reactor.callLater(0.1, originateAck)
-        else:
-            self._ackTimer.reset(ACK_DELAY)
+            self._ackTimer = self.ptcp.timers.callLater(
+                ACK_DELAY, self._acknowledge)
+
+    def _acknowledge(self):
+        """
+        Acknowledge everything received so far: on the next data segment, if
+        the application has written something we can send now, or else on a
+        packet by itself.
+        """
+        if self._outgoingBytes:
+            if self._nagle is not None:
+                self._nagle.cancel()
+            self._reallyWrite()
+        # Sending anything at all clears both of these.
+        if self._segmentsUnacked or self._ackTimer is not None:
+            self.originate(ack=True)
 
     def originate(self, data='', syn=False, ack=False, fin=False, rst=False):
         """
         Create a packet, enqueue it to be sent, and return it.
         """
         if self._ackTimer is not None:
-            self._ackTimer.cancel()
+            if self._ackTimer.active():
+                self._ackTimer.cancel()
             self._ackTimer = None
+        self._segmentsUnacked = 0
         if syn:
-            # We really should be randomizing the ISN but until we finish the
-            # implementations of the various bits of wraparound logic that were
-            # started with relativeSequence
             assert self.nextSendSeqNum == 0, (
                 "NSSN = " + repr(self.nextSendSeqNum))
-            assert self.hostSendISN == 0
+        sackBlocks = ()
+        if (self.sackPermitted and self._reassemblyQueue
+            and not (data or syn or fin)):
+            sackBlocks = tuple([
+                ((left + self.peerSendISN) % (2**32),
+                 (right + self.peerSendISN) % (2**32))
+                for (left, right) in self._reassemblyQueue.blocks(
+                    self.maxSackBlocks)])
+        laps, seqNum = divmod(self.nextSendSeqNum + self.hostSendISN, 2**32)
         p = PTCPPacket.create(self.hostPseudoPort,
                               self.peerPseudoPort,
-                              seqNum=(self.nextSendSeqNum +
-                                      self.hostSendISN) % (2**32),
+                              seqNum=seqNum,
                               ackNum=self.currentAckNum(),
                               data=data,
-                              window=self.recvWindow,
+                              window=self._advertiseWindow(),
                               syn=syn, ack=ack, fin=fin, rst=rst,
+                              sack=syn and self.ptcp.sack,
+                              probe=syn and self.ptcp.pathMTUDiscovery,
+                              hcrc=(self.ptcp.headerChecksums if syn
+                                    else self.headerChecksums),
+                              sackBlocks=sackBlocks,
                               destination=self.peerAddressTuple)
+        p.seqOffset = self.hostSendISN
+        p.seqLaps = laps
         # do we want to enqueue this packet for retransmission?
         sl = p.segmentLength()
         self.nextSendSeqNum += sl
 
-        if p.mustRetransmit():
-            # print self, 'originating retransmittable packet', len(self.retransmissionQueue)
+        queued = p.mustRetransmit()
+        if queued:
             if self.retransmissionQueue:
                 if self.retransmissionQueue[-1].fin:
                     raise AssertionError("Sending %r after FIN??!" % (p,))
-            # print 'putting it on the queue'
-            self.retransmissionQueue.append(p)
-            # print 'and sending it later'
+            self.retransmissionQueue.append(self.nextSendSeqNum - sl, p)
+            self._pipe += sl
             self._retransmitLater()
-            if not self.sendWindowRemaining: # len(self.retransmissionQueue) > 5:
-                # print 'oh no my queue is too big'
-                # This is a random number (5) because I ought to be summing the
-                # packet lengths or something.
+            if self.sendWindowRemaining < self.mtu:
+                # There is no room in the window for another full segment.
                 self._writeBufferFull()
-            else:
-                # print 'my queue is still small enough', len(self.retransmissionQueue), self, self.sendWindowRemaining
-                pass
+        p.sentAt = reactor.seconds()
+        self._transmissions += 1
+        p.sendIndex = self._transmissions
+        if queued:
+            self._sendLog.append(
+                (p.sendIndex, self.nextSendSeqNum - sl, self.nextSendSeqNum))
+        self.stats.segmentsSent += 1
+        self.stats.bytesSent += p.dlen
+        if self.ptcp.tracer is not None:
+            self.ptcp.tracer(self, 'send', p)
         self.ptcp.sendPacket(p)
         return p
 
 
+    def stateEntered(self, newState):
+        """
+        Account for the time spent in a state of the state machine when it
+        leaves it for another.  The machine calls this before it produces the
+        rest of the transition's outputs.
+        """
+        oldState = self._state
+        if newState != oldState:
+            now = reactor.seconds()
+            stateTime = self.stats.stateTime
+            stateTime[oldState] = (stateTime.get(oldState, 0.0)
+                                   + now - self._stateEntered)
+            self._state = newState
+            self._stateEntered = now
+            if self.ptcp.tracer is not None:
+                self.ptcp.tracer(self, 'state', newState)
+
+
+    def statistics(self):
+        """
+        @return: a L{PTCPStatistics} describing this connection's traffic so
+            far, including the time spent in its current state, and its
+            current windows.
+        """
+        stats = self.stats.copy()
+        state = self._state
+        stats.stateTime[state] = (stats.stateTime.get(state, 0.0)
+                                  + reactor.seconds() - self._stateEntered)
+        stats.congestionWindow = self.congestion.cwnd
+        stats.sendWindow = self.sendWindow
+        stats.receiveWindow = max(0, self._advertisedEdge - self.nextRecvSeqNum)
+        stats.smoothedRTT = self.smoothedRTT
+        stats.openConnections = 1
+        stats.halfOpenConnections = int(state == 'synRcvd')
+        stats.timeWaitConnections = int(state == 'timeWait')
+        return stats
+
+
     # State machine transition definitions, hooray.
     def outgoingConnectionFailed(self):
         """
@@ -714,6 +2741,9 @@ class PTCPConnection(object):
     def releaseConnectionResources(self):
         self.ptcp.connectionClosed(self)
         self._stopRetransmitting()
+        self._reassemblyQueue.clear()
+        self._undelivered = []
+        self._undeliveredSize = 0
         if self._timeWaitCall is not None:
             self._timeWaitCall.cancel()
             self._timeWaitCall = None
@@ -722,12 +2752,15 @@ class PTCPConnection(object):
             self._ackTimer = None
 
     _timeWaitCall = None
-    _timeWaitTimeout = 0.01     # REALLY fast timeout, right now this is for
-                                # the tests...
 
     def scheduleTimeWaitTimeout(self):
         self._stopRetransmitting()
-        self._timeWaitCall = reactor.callLater(self._timeWaitTimeout, self._do2mslTimeout)
+        # However short TIME_WAIT is, stay long enough that if our last
+        # acknowledgement is lost, the retransmitted FIN that follows is
+        # acknowledged again rather than left to time out.
+        self._timeWaitCall = self.ptcp.timers.callLater(
+            max(self.ptcp.timeWait, 2 * self._retransmitTimeout),
+            self._do2mslTimeout)
 
     def _do2mslTimeout(self):
         self._timeWaitCall = None
@@ -759,12 +2792,19 @@ class PTCPConnection(object):
             self.loseConnection()
         else:
             self.protocol = p
+            if self.pathMTUProbing:
+                self._searchPathMTU()
+            if self.ptcp.keepAlive is not None:
+                self._keepAliveLater(self.ptcp.keepAlive)
 
     def connectionJustEnded(self):
-        assert not self.disconnected
+        if self.disconnected:
+            # The application closed the connection itself, and has already
+            # been told.
+            return
         self.disconnected = True
         try:
-            self.protocol.connectionLost(Failure(CONNECTION_DONE))
+            self.protocol.connectionLost(Failure(self._disconnectReason))
         except:
             log.err()
         self.protocol = None
@@ -777,14 +2817,28 @@ class PTCPConnection(object):
             self.producer = None
 
 
+    _disconnectReason = CONNECTION_DONE
+
     _closeWaitLoseConnection = None
 
     def nowHalfClosed(self):
-        # TODO: look for IHalfCloseableProtocol, call the appropriate methods
+        """
+        Our peer has finished sending.  An application which can carry on
+        with only half a connection is told so, and closes its half when it
+        is ready; any other is disconnected.
+        """
+        if IHalfCloseableProtocol.providedBy(self.protocol):
+            try:
+                self.protocol.readConnectionLost()
+            except:
+                log.err()
+                self.loseConnection()
+            return
         def appCloseNow():
             self._closeWaitLoseConnection = None
             self.loseConnection()
-        self._closeWaitLoseConnection = reactor.callLater(0.01, appCloseNow)
+        self._closeWaitLoseConnection = self.ptcp.timers.callLater(
+            0.01, appCloseNow)
 
 
 
@@ -860,12 +2914,195 @@ class PTCP(protocol.DatagramProtocol):
         instances.
     @type _connections: C{dict}
 
+    @ivar pathMTUs: A mapping of peer host addresses to the largest segment
+        size which path MTU discovery found would get through to them, so
+        that later connections to the same host can start out using it.
+    @type pathMTUs: C{dict}
+
+    @ivar pacing: Whether connections over this port pace their segments;
+        see L{PTCPConnection.pacingRate}.
+    @type pacing: C{bool}
+
+    @ivar headerChecksums: Whether to offer peers checksums which cover the
+        headers of packets as well as their payloads.  They are used on a
+        connection if both ends offer them; otherwise only payloads are
+        protected.
+    @type headerChecksums: C{bool}
+
+    @ivar checksums: Whether to compute and check checksums at all.  A port
+        which does not checks only that packets arrived whole, and leaves
+        checksums out of the packets it sends on connections which use header
+        checksums (its peer accepts them without, as for UDP); peers which
+        predate header checksums are still sent them.  Only turn this off
+        when the streams carried are protected from corruption already, for
+        example by TLS, as Q2Q's are.
+    @type checksums: C{bool}
+
+    @ivar maxPacingRate: The fastest, in octets per second, that any one
+        connection over this port will send, or C{None} for no limit beyond
+        the one congestion control imposes.
+    @type maxPacingRate: C{float} or C{NoneType}
+
+    @ivar timeWait: How long, in seconds, a connection which we closed first
+        lingers in the TIME-WAIT state, so that it can acknowledge our peer's
+        FIN again if our first acknowledgement was lost, and so that segments
+        from it still in the network are not taken for part of a new
+        connection between the same pseudo-ports.  A new connection may take
+        over the pseudo-ports of one in TIME-WAIT all the same; see
+        L{PTCP.packetReceived}.
+    @type timeWait: C{float}
+
+    @ivar keepAlive: How long, in seconds, a connection over this port may
+        hear nothing from its peer before probing it to see whether it is
+        still there, or C{None} to never probe.  Probes and their answers
+        also keep alive the mappings of any NATs between the two ends, which
+        would otherwise forget an idle connection; see
+        L{vertex.q2q.PTCPDispatcher.seedNAT}.
+    @type keepAlive: C{float} or C{NoneType}
+
+    @ivar keepAliveInterval: How long, in seconds, to wait for an answer to
+        one keepalive probe before sending the next.
+    @type keepAliveInterval: C{float}
+
+    @ivar keepAliveProbes: How many keepalive probes may go unanswered before
+        the peer is declared dead and the connection is lost.  A peer which
+        has not been heard from for C{keepAlive + keepAliveInterval *
+        keepAliveProbes} seconds is given up on, even if there is data in
+        flight that would otherwise be retransmitted for far longer.
+    @type keepAliveProbes: C{int}
+
+    @ivar maxConnections: The most connections, in any state, there may be
+        over this port at once.  Once there are this many, SYNs are ignored
+        unless there is a half-open connection to throw away instead.
+    @type maxConnections: C{int}
+
+    @ivar maxHalfOpen: The most connections there may be over this port
+        which a peer has begun with a SYN and has not yet acknowledged our
+        SYN-ACK for.  A SYN which arrives once there are this many throws
+        away the oldest of them, so that a flood of SYNs from forged
+        addresses can neither fill up the connection table nor lock out
+        genuine peers for long; RFC 4987 section 3.4.
+    @type maxHalfOpen: C{int}
+
+    @ivar _halfOpen: The half-open connections, by endpoint address as for
+        C{_connections}, oldest first.
+    @type _halfOpen: L{OrderedDict}
+
+    @ivar _nextPseudoPort: The pseudo-port from which to start looking for
+        a free one for the next connection we open.
+    @type _nextPseudoPort: C{int}
+
+    @ivar timers: The L{_TimerWheel} on which all of the connections over
+        this port schedule their timers, so that the reactor only has to
+        keep track of one.
+    @type timers: L{_TimerWheel}
+
+    @ivar _outgoing: Encoded datagrams, with their destinations, waiting to
+        be written to the transport.  If the transport has a C{writeBatch}
+        method (see L{vertex.udpbatch.BatchedPort}), packets sent during one
+        reactor iteration are written together, in a single batch, at the
+        start of the next; otherwise each is written as it is sent.
+    @type _outgoing: C{list}
+
+    @ivar tracer: A callable, or C{None}.  If set, it is called with each
+        L{PTCPConnection} over this port, a description of what happened on
+        it, and the details: C{'send'}, C{'retransmit'}, C{'keepalive'} or
+        C{'receive'} with a L{PTCPPacket}, or C{'state'} with the name of the
+        state the connection just entered.
+    @type tracer: C{callable} or C{NoneType}
+
+    @ivar shard: The L{vertex.ptcpshard.ShardBus} joining this port to the
+        others in different processes which share its UDP port, or C{None}
+        if it has the UDP port to itself.  A sharded port only opens
+        connections from the pseudo-ports its shard owns, and passes
+        datagrams for connections from other shards' pseudo-ports on to
+        them.
+    @type shard: L{vertex.ptcpshard.ShardBus} or C{NoneType}
+
+    @ivar _closedStatistics: A L{PTCPStatistics} of the traffic on the
+        connections over this port which have since closed, and of the SYNs
+        this port dropped.
+    @type _closedStatistics: L{PTCPStatistics}
+
     """
     # External API
 
-    def __init__(self, factory):
+    tracer = None
+    shard = None
+
+    def __init__(self, factory, congestionControl=congestion.NewReno,
+                 sack=True, pathMTUDiscovery=True, pacing=True,
+                 maxPacingRate=None, timeWait=60.0, maxConnections=2 ** 16,
+                 maxHalfOpen=1024, keepAlive=None, keepAliveInterval=5.0,
+                 keepAliveProbes=5, headerChecksums=True, checksums=True):
+        """
+        @param factory: see L{PTCP.factory}.
+
+        @param congestionControl: a callable taking a maximum segment size and
+            returning a congestion controller, such as
+            L{vertex.congestion.NewReno} or L{vertex.congestion.Cubic}, which
+            will be used for each connection over this port.
+
+        @param sack: whether to offer selective acknowledgements to peers.
+            They are used on a connection if both ends offer them.
+
+        @param pathMTUDiscovery: whether to offer to answer path MTU probes
+            from peers.  Connections probe for a larger segment size if both
+            ends offer to.
+
+        @param pacing: see L{PTCP.pacing}.
+
+        @param maxPacingRate: see L{PTCP.maxPacingRate}.
+
+        @param timeWait: see L{PTCP.timeWait}.  RFC 793 calls for four
+            minutes, but the default is one, as for most TCP implementations.
+
+        @param maxConnections: see L{PTCP.maxConnections}.
+
+        @param maxHalfOpen: see L{PTCP.maxHalfOpen}.
+
+        @param keepAlive: see L{PTCP.keepAlive}.  Like TCP's, keepalives are
+            off by default.
+
+        @param keepAliveInterval: see L{PTCP.keepAliveInterval}.
+
+        @param keepAliveProbes: see L{PTCP.keepAliveProbes}.
+
+        @param headerChecksums: see L{PTCP.headerChecksums}.
+
+        @param checksums: see L{PTCP.checksums}.
+        """
         self.factory = factory
+        self.congestionControl = congestionControl
+        self.sack = sack
+        self.pathMTUDiscovery = pathMTUDiscovery
+        self.pacing = pacing
+        self.maxPacingRate = maxPacingRate
+        self.timeWait = timeWait
+        self.maxConnections = maxConnections
+        self.maxHalfOpen = maxHalfOpen
+        self.keepAlive = keepAlive
+        self.keepAliveInterval = keepAliveInterval
+        self.keepAliveProbes = keepAliveProbes
+        self.headerChecksums = headerChecksums
+        self.checksums = checksums
+        self.pathMTUs = {}
         self._allConnectionsClosed = _PendingEvent()
+        self.timers = _TimerWheel()
+        self._outgoing = []
+        self._flushCall = None
+        self._closedStatistics = PTCPStatistics()
+
+
+    def statistics(self):
+        """
+        @return: a L{PTCPStatistics} describing the traffic on all the
+            connections there have been over this port, open or closed.
+        """
+        stats = self._closedStatistics.copy()
+        for conn in self._connections.itervalues():
+            stats.merge(conn.statistics())
+        return stats
 
 
     def connect(self, factory, host, port, pseudoPort=1):
@@ -892,25 +3129,108 @@ class PTCP(protocol.DatagramProtocol):
         @return: A L{PTCPConnection} instance representing the new
             connection, but you really shouldn't use this for
             anything.  Write a protocol!
+
+        @raise error.ConnectError: if the connection table is full.
+
+        @raise error.ConnectBindError: if every pseudo-port is already in use
+            for a connection to the same place.
         """
-        sourcePseudoPort = genConnID() % MAX_PSEUDO_PORT
-        conn = self._connections[(pseudoPort, sourcePseudoPort, (host, port))
-                                 ] = PTCPConnection(
+        if not self._makeRoom():
+            raise error.ConnectError(string="PTCP connection table is full")
+        sourcePseudoPort = self._allocatePseudoPort(pseudoPort, (host, port))
+        packey = (pseudoPort, sourcePseudoPort, (host, port))
+        conn = self._connections[packey] = PTCPConnection(
             sourcePseudoPort, pseudoPort, self, factory, (host, port))
         conn.machine.appActiveOpen()
         return conn
 
+    def _allocatePseudoPort(self, pseudoPort, peerAddressTuple):
+        """
+        Choose a pseudo-port for a new connection to the given pseudo-port of
+        a peer, which no other connection to that one is using; some other
+        connection, perhaps still in TIME-WAIT, might otherwise have packets
+        meant for the new one delivered to it.  Connections to different
+        places may share pseudo-ports.
+
+        @raise error.ConnectBindError: if there are no pseudo-ports left.
+        """
+        shard = self.shard
+        count = MAX_PSEUDO_PORT - MIN_CLIENT_PSEUDO_PORT
+        for i in xrange(count):
+            candidate = self._nextPseudoPort
+            self._nextPseudoPort += 1
+            if self._nextPseudoPort == MAX_PSEUDO_PORT:
+                self._nextPseudoPort = MIN_CLIENT_PSEUDO_PORT
+            if shard is not None and shard.owner(candidate) != shard.index:
+                continue
+            if (pseudoPort, candidate,
+                peerAddressTuple) not in self._connections:
+                return candidate
+        raise error.ConnectBindError(
+            string="No free PTCP pseudo-ports to %r" % (peerAddressTuple,))
+
+
+    def _makeRoom(self):
+        """
+        Make sure there is room for one more connection, throwing away the
+        oldest half-open one if there is not, or if there are already
+        C{maxHalfOpen} of them.
+
+        @return: C{True} if there is room.
+        """
+        if (len(self._connections) < self.maxConnections
+            and len(self._halfOpen) < self.maxHalfOpen):
+            return True
+        if not self._halfOpen:
+            return False
+        oldest = next(iter(self._halfOpen.itervalues()))
+        self._closedStatistics.halfOpenEvicted += 1
+        oldest.releaseConnectionResources()
+        return True
+
+
     def sendPacket(self, packet):
         if self.transportGoneAway:
             return
-        self.transport.write(packet.encode(), packet.destination)
+        datagram = packet.encode(self.checksums)
+        if getattr(self.transport, 'writeBatch', None) is None:
+            try:
+                self.transport.write(datagram, packet.destination)
+            except:
+                log.err(None, "Dropping datagram to %r" % (
+                        packet.destination,))
+            return
+        # It is encoded now, since retransmission may change it before it is
+        # written.
+        self._outgoing.append((datagram, packet.destination))
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self._flushOutgoing)
+
+
+    def _flushOutgoing(self):
+        """
+        Write all the datagrams sent since the last flush to the transport.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        outgoing, self._outgoing = self._outgoing, []
+        if self.transportGoneAway or not outgoing:
+            return
+        self.transport.writeBatch(outgoing)
 
 
     # Internal stuff
     def startProtocol(self):
         self.transportGoneAway = False
-        self._lastConnID = 10 # random.randrange(2 ** 32)
         self._connections = {}
+        self._halfOpen = OrderedDict()
+        # Start somewhere different each time, so that a peer which still
+        # remembers connections from before a restart is unlikely to confuse
+        # new ones with them.
+        self._nextPseudoPort = random.randrange(MIN_CLIENT_PSEUDO_PORT,
+                                                MAX_PSEUDO_PORT)
 
     def _finalCleanup(self):
         """
@@ -931,7 +3251,10 @@ class PTCP(protocol.DatagramProtocol):
         opriate application-level messages.
         """
         self.transportGoneAway = True
+        self._flushOutgoing()
         self._finalCleanup()
+        if self.shard is not None and self.shard.transport is not None:
+            self.shard.transport.stopListening()
 
     def cleanupAndClose(self):
         """
@@ -952,9 +3275,25 @@ class PTCP(protocol.DatagramProtocol):
             # It can't be any good.
             return
 
+        if self.shard is not None:
+            # Connections our peers open are to pseudo-port 1, and the kernel
+            # delivers everything from one peer address to the same process,
+            # so they stay here; replies to connections another process
+            # opened may not, and go back to it.
+            [destPseudoPort] = _destPortStruct.unpack_from(
+                bytes, _destPortOffset)
+            if destPseudoPort != 1:
+                owner = self.shard.owner(destPseudoPort)
+                if owner != self.shard.index:
+                    self.shard.forward(owner, bytes, addr)
+                    return
+
         pkt = PTCPPacket.decode(bytes, addr)
         try:
-            pkt.verifyChecksum()
+            if self.checksums:
+                pkt.verifyChecksum()
+            else:
+                pkt.verifyLength()
         except TruncatedDataError:
 #             print '(ptcp packet truncated: %r)' % (pkt,)
             self.sendPacket(
@@ -979,6 +3318,8 @@ class PTCP(protocol.DatagramProtocol):
     def _stop(self, result=None):
         if not self.stopped:
             self.stopped = True
+            # Get any final packets out while there is still a socket.
+            self._flushOutgoing()
             return self.transport.stopListening()
         else:
             return defer.succeed(None)
@@ -996,6 +3337,13 @@ class PTCP(protocol.DatagramProtocol):
         packey = (ptcpConn.peerPseudoPort, ptcpConn.hostPseudoPort,
                   ptcpConn.peerAddressTuple)
         del self._connections[packey]
+        self._halfOpen.pop(packey, None)
+        final = ptcpConn.statistics()
+        # Only open connections have windows, or are counted as open.
+        final.congestionWindow = final.sendWindow = final.receiveWindow = 0
+        final.openConnections = final.halfOpenConnections = 0
+        final.timeWaitConnections = 0
+        self._closedStatistics.merge(final)
         if ((not self.transportGoneAway) and
             (not self._connections) and
             self.factory is None):
@@ -1005,19 +3353,41 @@ class PTCP(protocol.DatagramProtocol):
 
     def packetReceived(self, packet):
         packey = (packet.sourcePseudoPort, packet.destPseudoPort, packet.peerAddressTuple)
+        # SYN and _ONLY_ SYN set, except maybe options.
+        synOnly = packet.flags & ~(_SACK | _PROBE | _HCRC) == _SYN
+        old = self._connections.get(packey)
+        if (synOnly and old is not None and old._state == 'timeWait'
+            and packet.seqNum != old.peerSendISN):
+            # Our peer has moved on to a new connection between the same
+            # pseudo-ports.  Since initial sequence numbers are random, a SYN
+            # with a different one cannot be a stray from the old connection,
+            # so there is no need to wait for it to finish TIME-WAIT; RFC
+            # 1122 section 4.2.2.13.
+            old.releaseConnectionResources()
         if packey not in self._connections:
-            if packet.flags == _SYN and packet.destPseudoPort == 1: # SYN and _ONLY_ SYN set.
+            if (synOnly
+                and packet.destPseudoPort == 1):
+                if not self._makeRoom():
+                    self._closedStatistics.synsDropped += 1
+                    return
                 conn = PTCPConnection(packet.destPseudoPort,
                                       packet.sourcePseudoPort, self,
                                       self.factory, packet.peerAddressTuple)
                 conn.machine.appPassiveOpen()
                 self._connections[packey] = conn
+                self._halfOpen[packey] = conn
             else:
                 log.msg("corrupted packet? %r %r %r" % (packet,packey, self._connections))
                 return
+        conn = self._connections[packey]
         try:
-            self._connections[packey].packetReceived(packet)
+            conn.packetReceived(packet)
         except:
             log.msg("PTCPConnection error on %r:" % (packet,))
             log.err()
             del self._connections[packey]
+            self._halfOpen.pop(packey, None)
+        else:
+            if packey in self._halfOpen and conn._state != 'synRcvd':
+                # The handshake is over, one way or another.
+                del self._halfOpen[packey]
@@ -0,0 +1,441 @@
+# -*- test-case-name: vertex.test.test_netemu -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+A benchmark of L{vertex.ptcp} over emulated network paths.
+
+Each run connects two L{ptcp.PTCP} ports over an L{EmulatedLink}, sends a
+fixed amount of data from one to the other, and reports the goodput, the
+latency of each chunk of data written, and the processor time spent per
+megabyte.  Everything runs in virtual time on a L{task.Clock}, so a run
+takes only as long as the processing it measures, and runs with the same
+parameters see exactly the same network.
+
+Run it with C{python -m vertex.ptcpbench}; see L{Options}.
+"""
+
+import os
+import sys
+
+import attr
+
+from twisted.internet import protocol, task
+from twisted.python import usage
+from twisted.python.monkey import MonkeyPatcher
+
+from vertex import congestion, ptcp
+from vertex.netemu import EmulatedLink, LinkConditions
+
+
+# Conditions to run the benchmark under when none are given.  Bandwidths are
+# in octets per second.
+scenarios = {
+    'clean': LinkConditions(),
+    'lan': LinkConditions(delay=0.0005, bandwidth=12.5e6),
+    'wan': LinkConditions(delay=0.04, jitter=0.002, bandwidth=1.25e6,
+                          queueSize=2 ** 16),
+    'lossy': LinkConditions(delay=0.02, loss=0.02, bandwidth=1.25e6,
+                            queueSize=2 ** 16),
+    'reordering': LinkConditions(delay=0.01, reorder=0.05, duplicate=0.01,
+                                 bandwidth=1.25e6),
+    'satellite': LinkConditions(delay=0.3, loss=0.005, bandwidth=2.5e5,
+                                queueSize=2 ** 17),
+    }
+
+
+
+def percentile(values, p):
+    """
+    Find a percentile of some values, by the nearest rank method.
+
+    @param values: a non-empty sequence of numbers.
+
+    @param p: the percentile, from 0 to 100.
+
+    @return: the smallest value which is at least C{p} percent of the way
+        through C{values} when they are sorted.
+    """
+    ordered = sorted(values)
+    rank = int(len(ordered) * p / 100.0 + 0.5)
+    return ordered[min(max(rank - 1, 0), len(ordered) - 1)]
+
+
+
+def _cpuTime():
+    """
+    @return: the processor time, user and system, used by this process so
+        far.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+
+@attr.s
+class BenchmarkResult(object):
+    """
+    The outcome of one L{run}.
+
+    @ivar size: the number of octets the sender wrote.
+    @ivar received: the number of octets which arrived.
+    @ivar duration: the virtual time, in seconds, from the first write to
+        the arrival of the last octet.
+    @ivar latencies: for each chunk written, the virtual time, in seconds,
+        between its being written and its last octet arriving.
+    @ivar cpuTime: the processor time, in seconds, used by the run.
+    @ivar statistics: the sender's L{ptcp.PTCPStatistics}.
+    @ivar link: the L{EmulatedLink} the run used.
+    """
+
+    size = attr.ib()
+    received = attr.ib()
+    duration = attr.ib()
+    latencies = attr.ib(repr=False)
+    cpuTime = attr.ib()
+    statistics = attr.ib(repr=False)
+    link = attr.ib(repr=False)
+
+    def completed():
+        doc = """
+        Whether all of the data arrived.
+        """
+        def get(self):
+            return self.received == self.size
+        return get, None, None, doc
+    completed = property(*completed())
+
+
+    def goodput():
+        doc = """
+        The rate, in octets per second of virtual time, at which data
+        arrived.
+        """
+        def get(self):
+            if not self.duration:
+                return 0.0
+            return self.received / self.duration
+        return get, None, None, doc
+    goodput = property(*goodput())
+
+
+    def cpuPerMB():
+        doc = """
+        The processor time, in seconds, used per megabyte which arrived.
+        """
+        def get(self):
+            if not self.received:
+                return None
+            return self.cpuTime / (self.received / float(2 ** 20))
+        return get, None, None, doc
+    cpuPerMB = property(*cpuPerMB())
+
+
+    def latency(self, p):
+        """
+        @return: the C{p}th percentile of the chunk latencies, in seconds, or
+            L{None} if no chunk arrived.
+        """
+        if not self.latencies:
+            return None
+        return percentile(self.latencies, p)
+
+
+
+class _Sender(protocol.Protocol):
+    """
+    Write C{size} octets, in chunks, as fast as the transport will take them
+    or at a steady rate, remembering when each chunk was written.
+
+    @ivar due: the times at which each chunk was written or, if the transport
+        was paused, due to be written.
+    """
+
+    def __init__(self, clock, size, chunkSize, rate):
+        self.clock = clock
+        self.size = size
+        self.chunkSize = chunkSize
+        self.rate = rate
+        self.due = []
+        self.written = 0
+        self.paused = False
+        self._backlog = 0
+        self._ticker = None
+
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+        if self.rate is None:
+            self._backlog = -(-self.size // self.chunkSize)
+            self.due = [self.clock.seconds()] * self._backlog
+            self._writeBacklog()
+        else:
+            self._tick()
+
+
+    def _tick(self):
+        self._ticker = None
+        self.due.append(self.clock.seconds())
+        self._backlog += 1
+        self._writeBacklog()
+        if len(self.due) * self.chunkSize < self.size:
+            self._ticker = self.clock.callLater(
+                self.chunkSize / float(self.rate), self._tick)
+
+
+    def _writeBacklog(self):
+        while self._backlog and not self.paused:
+            chunk = min(self.chunkSize, self.size - self.written)
+            self.transport.write('x' * chunk)
+            self.written += chunk
+            self._backlog -= 1
+        if self.written >= self.size:
+            self.transport.unregisterProducer()
+
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        self._writeBacklog()
+
+
+    def stopProducing(self):
+        self.paused = True
+
+
+    def connectionLost(self, reason):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+
+
+
+class _Receiver(protocol.Protocol):
+    """
+    Count the octets which arrive, and note when each of the sender's chunks
+    is complete.
+
+    @ivar arrivals: the times at which each chunk was complete.
+    """
+
+    def __init__(self, clock, size, chunkSize):
+        self.clock = clock
+        self.size = size
+        self.chunkSize = chunkSize
+        self.received = 0
+        self.arrivals = []
+
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        now = self.clock.seconds()
+        while (len(self.arrivals) * self.chunkSize < self.size and
+               min((len(self.arrivals) + 1) * self.chunkSize, self.size)
+               <= self.received):
+            self.arrivals.append(now)
+
+
+    def connectionLost(self, reason):
+        pass
+
+
+
+def run(conditions, backward=None, size=2 ** 20, chunkSize=2 ** 14,
+        rate=None, congestionControl=congestion.NewReno, sack=True,
+        pathMTUDiscovery=True, pacing=True, seed=0, timeout=3600.0):
+    """
+    Send some data from one L{ptcp.PTCP} port to another over an
+    L{EmulatedLink}, and measure how well it went.
+
+    @param conditions: the L{LinkConditions} from the sender to the
+        receiver.
+
+    @param backward: the L{LinkConditions} from the receiver to the sender;
+        the same as C{conditions} by default.
+
+    @param size: the number of octets to send.
+
+    @param chunkSize: the number of octets the sender writes at once.
+
+    @param rate: the rate, in octets per second, at which the sender writes;
+        if L{None}, it writes everything at once.
+
+    @param congestionControl: see L{ptcp.PTCP.__init__}.
+    @param sack: see L{ptcp.PTCP.__init__}.
+    @param pathMTUDiscovery: see L{ptcp.PTCP.__init__}.
+    @param pacing: see L{ptcp.PTCP.__init__}.
+
+    @param seed: the seed for the link's random number generators.
+
+    @param timeout: the virtual time, in seconds, after which to give up.
+
+    @rtype: L{BenchmarkResult}
+    """
+    clock = task.Clock()
+    patcher = MonkeyPatcher((ptcp, 'reactor', clock))
+    patcher.patch()
+    try:
+        sender = _Sender(clock, size, chunkSize, rate)
+        receiver = _Receiver(clock, size, chunkSize)
+        clientFactory = protocol.ClientFactory()
+        clientFactory.protocol = lambda: sender
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = lambda: receiver
+        options = dict(congestionControl=congestionControl, sack=sack,
+                       pathMTUDiscovery=pathMTUDiscovery, pacing=pacing)
+        client = ptcp.PTCP(None, **options)
+        server = ptcp.PTCP(serverFactory, **options)
+        link = EmulatedLink(clock, conditions, backward, seed)
+        link.connect(client, server)
+
+        cpuStart = _cpuTime()
+        client.connect(clientFactory, *link.addressB)
+        deadline = clock.seconds() + timeout
+        while receiver.received < size and clock.seconds() < deadline:
+            calls = clock.getDelayedCalls()
+            if not calls:
+                break
+            next = min([call.getTime() for call in calls])
+            clock.advance(max(0, next - clock.seconds()))
+        cpuTime = _cpuTime() - cpuStart
+        end = clock.seconds()
+
+        statistics = client.statistics()
+        client.cleanupAndClose()
+        server.cleanupAndClose()
+    finally:
+        patcher.restore()
+
+    latencies = [arrived - due
+                 for (due, arrived) in zip(sender.due, receiver.arrivals)]
+    duration = 0.0
+    if sender.due:
+        if receiver.received >= size:
+            end = receiver.arrivals[-1]
+        duration = end - sender.due[0]
+    return BenchmarkResult(size=size, received=receiver.received,
+                           duration=duration, latencies=latencies,
+                           cpuTime=cpuTime, statistics=statistics, link=link)
+
+
+
+class Options(usage.Options):
+    """
+    Command line options for the benchmark.  Without any link conditions, it
+    runs every one of L{scenarios}.
+    """
+
+    synopsis = "python -m vertex.ptcpbench [options]"
+
+    optParameters = [
+        ['scenario', 's', None,
+         'Run only this scenario: one of %s.' % (
+                ', '.join(sorted(scenarios)),)],
+        ['size', None, 2 ** 20, 'Octets to send.', int],
+        ['chunk', None, 2 ** 14, 'Octets to write at once.', int],
+        ['rate', None, None,
+         'Octets per second to write; as fast as possible by default.',
+         float],
+        ['congestion', 'c', congestion.NewReno.name,
+         'Congestion control: one of %s.' % (
+                ', '.join(sorted(congestion.controllers)),)],
+        ['seed', None, 0, 'Seed for the link.', int],
+        ['delay', None, None, 'One-way delay, in seconds.', float],
+        ['jitter', None, None, 'Delay variation, in seconds.', float],
+        ['loss', None, None, 'Probability of dropping a datagram.', float],
+        ['reorder', None, None,
+         'Probability of delaying a datagram past later ones.', float],
+        ['duplicate', None, None,
+         'Probability of delivering a datagram twice.', float],
+        ['bandwidth', None, None, 'Octets per second.', float],
+        ['queue', None, None,
+         'Octets which may wait for the bandwidth.', int],
+        ]
+
+    optFlags = [
+        ['no-sack', None, 'Do not use selective acknowledgements.'],
+        ['no-pmtud', None, 'Do not probe for a larger segment size.'],
+        ['no-pacing', None, 'Do not pace segments.'],
+        ]
+
+    _conditions = [('delay', 'delay'), ('jitter', 'jitter'),
+                   ('loss', 'loss'), ('reorder', 'reorder'),
+                   ('duplicate', 'duplicate'), ('bandwidth', 'bandwidth'),
+                   ('queue', 'queueSize')]
+
+    def postOptions(self):
+        if self['congestion'] not in congestion.controllers:
+            raise usage.UsageError(
+                "Unknown congestion control %r" % (self['congestion'],))
+        custom = dict([(name, self[option])
+                       for (option, name) in self._conditions
+                       if self[option] is not None])
+        if custom:
+            self.scenarios = [('custom', LinkConditions(**custom))]
+        elif self['scenario'] is not None:
+            if self['scenario'] not in scenarios:
+                raise usage.UsageError(
+                    "Unknown scenario %r" % (self['scenario'],))
+            self.scenarios = [(self['scenario'],
+                               scenarios[self['scenario']])]
+        else:
+            self.scenarios = sorted(scenarios.items())
+
+
+
+def report(name, result):
+    """
+    Describe the result of a run in one line.
+
+    @param name: the name of the scenario.
+    @type result: L{BenchmarkResult}
+    """
+    def ms(seconds):
+        if seconds is None:
+            return '-'
+        return '%.1f' % (seconds * 1000,)
+    stats = result.statistics
+    cpu = result.cpuPerMB
+    return '%-12s %10.1f %8s %8s %8s %8s %7d %7d %s' % (
+        name, result.goodput / 1024, ms(result.latency(50)),
+        ms(result.latency(90)), ms(result.latency(99)),
+        cpu is None and '-' or '%.3f' % (cpu,), stats.retransmits,
+        result.link.forward.dropped + result.link.backward.dropped,
+        not result.completed and 'INCOMPLETE' or '')
+
+
+
+def main(argv=None, out=None):
+    """
+    Run the benchmark from the command line, and write a table of results.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if out is None:
+        out = sys.stdout
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        raise SystemExit('%s\n%s' % (options, e))
+    out.write('%-12s %10s %8s %8s %8s %8s %7s %7s\n' % (
+            'scenario', 'KB/s', 'p50 ms', 'p90 ms', 'p99 ms', 'cpu s/MB',
+            'rexmit', 'dropped'))
+    for name, conditions in options.scenarios:
+        result = run(conditions, size=options['size'],
+                     chunkSize=options['chunk'], rate=options['rate'],
+                     congestionControl=congestion.controllers[
+                         options['congestion']],
+                     sack=not options['no-sack'],
+                     pathMTUDiscovery=not options['no-pmtud'],
+                     pacing=not options['no-pacing'], seed=options['seed'])
+        out.write(report(name, result) + '\n')
+        out.flush()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- test-case-name: vertex.test.test_ptcpshard -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Spread the PTCP connections over one UDP port across several processes.
+
+A single L{vertex.ptcp.PTCP} port keeps one process, and so one core, busy.
+With L{listenSharded}, each of several worker processes binds the same UDP
+port with C{SO_REUSEPORT} (see L{vertex.udpbatch.BatchedPort.reusePort}),
+and each owns a shard of the connections over it.  The kernel gives each
+datagram to one of the workers by a hash of the addresses it was sent from
+and to, so every datagram from a given peer reaches the same worker:
+connections which peers open, to pseudo-port 1, stay with whichever worker
+received their SYN without any help.
+
+Connections a worker opens itself are different, since the kernel may hash
+the replies to them to another worker.  So each worker opens connections
+only from the pseudo-ports its shard owns (those equal to its index, modulo
+the number of workers), and a L{ShardBus} passes any datagram for a
+pseudo-port another worker owns on to that worker, over a Unix datagram
+socket.
+
+Workers must all be running, with the same number of shards, before any of
+them opens connections; adding or removing one changes which worker the
+kernel picks for some peers, and breaks the connections they had.
+"""
+
+import os
+import socket
+import struct
+
+from twisted.internet import protocol
+
+from vertex import udpbatch
+
+# Each datagram passed between workers is preceded by the length of the host
+# it came from, the port it came from, the flow information and scope ID of
+# an IPv6 address (zero for IPv4), and the host itself.
+_headerStruct = struct.Struct('!BHLL')
+
+
+
+class ShardBus(protocol.DatagramProtocol):
+    """
+    Carries datagrams between the workers sharing a UDP port.
+
+    @ivar ptcp: the L{vertex.ptcp.PTCP} port of this worker.
+
+    @ivar index: the number of this worker's shard, from 0.
+
+    @ivar count: the number of shards.
+
+    @ivar path: the path of each worker's Unix datagram socket, with a C{%d}
+        for the number of its shard.
+
+    @ivar forwarded: the number of datagrams passed on to other workers.
+
+    @ivar received: the number of datagrams other workers passed on to this
+        one.
+
+    @ivar dropped: the number of datagrams which could not be passed on,
+        because the worker they were for was not running.
+    """
+
+    def __init__(self, ptcp, index, count, path):
+        if not 0 <= index < count:
+            raise ValueError("Shard %d of %d" % (index, count))
+        self.ptcp = ptcp
+        self.index = index
+        self.count = count
+        self.path = path
+        self.forwarded = 0
+        self.received = 0
+        self.dropped = 0
+
+
+    def owner(self, pseudoPort):
+        """
+        @return: the number of the shard which owns a pseudo-port.
+        """
+        return pseudoPort % self.count
+
+
+    def pathFor(self, index):
+        """
+        @return: the path of the socket of the worker of the given shard.
+        """
+        return self.path % (index,)
+
+
+    def forward(self, index, datagram, addr):
+        """
+        Pass a datagram which arrived at our UDP port on to the worker of
+        another shard, which will handle it as though it had arrived there.
+
+        @param addr: the address the datagram came from, as the socket
+            module gives it: (host, port) for IPv4, and (host, port,
+            flowinfo, scope_id) for IPv6.
+        """
+        host, port = addr[:2]
+        flowInfo, scopeID = addr[2:] or (0, 0)
+        message = (_headerStruct.pack(len(host), port, flowInfo, scopeID)
+                   + host + datagram)
+        try:
+            self.transport.write(message, self.pathFor(index))
+        except socket.error:
+            # Nobody is there to take it; our peer will send it again.
+            self.dropped += 1
+        else:
+            self.forwarded += 1
+
+
+    def datagramReceived(self, message, addr):
+        length, port, flowInfo, scopeID = _headerStruct.unpack_from(message)
+        start = _headerStruct.size + length
+        host = message[_headerStruct.size:start]
+        if ':' in host:
+            addr = (host, port, flowInfo, scopeID)
+        else:
+            addr = (host, port)
+        self.received += 1
+        self.ptcp.datagramReceived(message[start:], addr)
+
+
+    def stopProtocol(self):
+        try:
+            os.unlink(self.pathFor(self.index))
+        except OSError:
+            pass
+
+
+
+def listenSharded(portNum, ptcp, index, count, path, interface='',
+                  maxPacketSize=8192, reactor=None):
+    """
+    Listen on a UDP port shared by several workers, as the worker for one
+    shard of the connections over it.
+
+    @param ptcp: the L{vertex.ptcp.PTCP} port of this worker.
+
+    @param index: see L{ShardBus.index}.
+
+    @param count: see L{ShardBus.count}.
+
+    @param path: see L{ShardBus.path}.  A socket left behind by an earlier
+        worker for the same shard is replaced.
+
+    @param reactor: the reactor to listen with; the global reactor by
+        default.
+
+    @raise error.CannotListenError: if the platform cannot share UDP ports.
+
+    @return: the listening UDP port.  Stopping it stops the L{ShardBus} too.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    bus = ShardBus(ptcp, index, count, path)
+    busPath = bus.pathFor(index)
+    if os.path.exists(busPath):
+        os.unlink(busPath)
+    busPort = reactor.listenUNIXDatagram(
+        busPath, bus, maxPacketSize=maxPacketSize + 512)
+    ptcp.shard = bus
+    try:
+        return udpbatch.listenUDP(portNum, ptcp, interface, maxPacketSize,
+                                  reactor, reusePort=True)
+    except:
+        ptcp.shard = None
+        busPort.stopListening()
+        raise
@@ -25,6 +25,7 @@ from twisted.internet.ssl import (
 from twisted.python import log
 from twisted.python.failure import Failure
 from twisted.application import service
+from twisted.protocols.basic import Int16StringReceiver, StatefulStringProtocol
 
 # twisted.cred
 from twisted.cred.checkers import ICredentialsChecker
@@ -34,11 +35,11 @@ from twisted.cred.error import UnauthorizedLogin
 
 from twisted.protocols.amp import (
     Argument, Boolean, String, Unicode, ListOf, AmpList, AmpBox, Command,
-    StartTLS, ProtocolSwitchCommand, AMP
+    StartTLS, ProtocolSwitchCommand, AMP, MAX_VALUE_LENGTH
 )
 
 # vertex
-from vertex import subproducer, ptcp
+from vertex import subproducer, ptcp, udpbatch, ptcpshard
 from vertex import endpoint, ivertex
 from vertex.address import (
     Q2QTransportAddress, VirtualTransportAddress, Q2QAddress
@@ -48,7 +49,8 @@ from vertex.amputil import (
     )
 from vertex.command import (
     Sign, Listen, Virtual, Identify, BindUDP, SourceIP,
-    Write, Close, Choke, Unchoke, WhoAmI
+    Write, Close, Choke, Unchoke, WindowUpdate, WhoAmI,
+    DataFrame, parseFrameKey
     )
 from vertex.conncache import ConnectionCache
 
@@ -58,7 +60,7 @@ import txscrypt
 
 from vertex.exceptions import (
     BadCertificateRequest, VerifyError, ConnectionError,
-    AttemptsFailed, NoAttemptsMade
+    AttemptsFailed, NoAttemptsMade, FlowControlError
     )
 
 port = 8788
@@ -282,10 +284,15 @@ class VirtualConnectionAttempt(AbstractConnectionAttempt):
             cid = -cid
         innerTransport = VirtualTransport(self.q2qproto, cid, self, True)
         def startit(result):
+            if result['window'] is not None:
+                innerTransport.startFlowControl(result['window'])
+            innerTransport.binaryFrames = bool(result['frames'])
             innerTransport.startProtocol()
             return self.deferred
 
-        d = self.q2qproto.callRemote(Virtual, id=cid)
+        d = self.q2qproto.callRemote(Virtual, id=cid,
+                                     window=innerTransport.receiveWindow,
+                                     frames=True)
         d.addCallback(startit)
         return d
 
@@ -561,6 +568,33 @@ def safely(f, *a, **k):
     except:
         log.err()
 
+def _checkBoxParser(parser):
+    """
+    Make sure that the private parts of L{AMP}'s box parser which
+    L{Q2Q.proto_init} and L{Q2Q.proto_frame} rely on are as they expect: it
+    is a L{StatefulStringProtocol}, so each key or value is handed to
+    C{proto_<state>}, starting with C{proto_init} for the first key of each
+    box; and it reads them as L{Int16StringReceiver} strings no longer than
+    C{MAX_LENGTH}, which it switches between C{_MAX_KEY_LENGTH} for keys and
+    C{_MAX_VALUE_LENGTH} for values.
+
+    @param parser: the box parser class, such as L{AMP}.
+
+    @raise ImportError: if it is not as expected, and so L{DataFrame}s could
+        not be received.
+    """
+    if not (issubclass(parser, StatefulStringProtocol)
+            and issubclass(parser, Int16StringReceiver)
+            and parser.state == 'init'
+            and callable(getattr(parser, 'proto_init', None))
+            and getattr(parser, '_MAX_KEY_LENGTH', None) == parser.MAX_LENGTH
+            and getattr(parser, '_MAX_VALUE_LENGTH', 0) >= MAX_VALUE_LENGTH):
+        raise ImportError(
+            "%s.%s's box parser is not as Q2Q expects; this version of "
+            "Twisted is not supported" % (parser.__module__, parser.__name__))
+
+_checkBoxParser(AMP)
+
 class Q2Q(AMP, subproducer.SuperProducer):
     """
     Quotient to Quotient protocol.
@@ -641,6 +675,17 @@ class Q2Q(AMP, subproducer.SuperProducer):
         ""
         self.connectionObservers.append(observer)
 
+    def transportDisconnecting(self):
+        """
+        Whether my transport has been asked to close its connection.  Once
+        TLS has been started on a TCP transport, closing it is left to the TLS
+        protocol it has been given, and only that knows.
+        """
+        transport = self.transport
+        if interfaces.ISSLTransport.providedBy(transport):
+            transport = getattr(transport, 'protocol', transport)
+        return getattr(transport, 'disconnecting', False)
+
 
     @BindUDP.responder
     def _bindUDP(self, q2qsrc, q2qdst, udpsrc, udpdst, protocol):
@@ -1058,6 +1103,15 @@ class Q2Q(AMP, subproducer.SuperProducer):
         return {}
 
 
+    @WindowUpdate.responder
+    def _windowUpdate(self, id, credit):
+        connection = self.connections.get(id)
+        if connection is not None:
+            # Otherwise, it crossed a Close on the wire.
+            connection.windowUpdate(credit)
+        return {}
+
+
     @Write.responder
     def _write(self, body, id):
         """
@@ -1086,6 +1140,40 @@ class Q2Q(AMP, subproducer.SuperProducer):
         return {}
 
 
+    def sendData(self, id, data):
+        """
+        Send some data over a virtual channel created by VIRTUAL, in a
+        L{DataFrame}.
+        """
+        self.sendBox(DataFrame(id, data))
+
+
+    def proto_init(self, string):
+        """
+        Recognize the start of a L{DataFrame} where a box might begin.
+        """
+        # XXX Overriding a private interface of BinaryBoxProtocol; see
+        # _checkBoxParser.
+        id = parseFrameKey(string)
+        if id is None:
+            return AMP.proto_init(self, string)
+        self._frameID = id
+        self.MAX_LENGTH = self._MAX_VALUE_LENGTH
+        return 'frame'
+
+
+    def proto_frame(self, string):
+        """
+        Receive the data of a L{DataFrame}, as L{_write} receives a WRITE.
+        """
+        self.MAX_LENGTH = self._MAX_KEY_LENGTH
+        connection = self.connections.get(self._frameID)
+        if connection is not None:
+            # Otherwise, it crossed a Close on the wire.
+            connection.dataReceived(string)
+        return 'init'
+
+
     @Close.responder
     def _close(self, id):
         """
@@ -1283,7 +1371,7 @@ class Q2Q(AMP, subproducer.SuperProducer):
             authorize=authorize, **extra).addCallback(_cbSecure)
 
     @Virtual.responder
-    def _virtual(self, id):
+    def _virtual(self, id, window, frames):
         if self.isServer:
             assert id > 0
         else:
@@ -1291,9 +1379,15 @@ class Q2Q(AMP, subproducer.SuperProducer):
         # We are double-deferring here so that we only start writing data to
         # our client _after_ they have processed our ACK.
         tpt = VirtualTransport(self, id, self.service._bootstrapFactory, False)
-
-
-        return dict(__transport__=tpt)
+        response = dict(__transport__=tpt)
+        # Otherwise, the peer does not know about credit windows, or frames.
+        if window is not None:
+            tpt.startFlowControl(window)
+            response['window'] = tpt.receiveWindow
+        if frames:
+            tpt.binaryFrames = True
+            response['frames'] = True
+        return response
 
 
     # Client/Support methods.
@@ -1574,9 +1668,70 @@ class Q2QBootstrapFactory(protocol.Factory):
         return q2etc
 
 class VirtualTransport(subproducer.SubProducer):
+    """
+    One virtual connection multiplexed over a Q2Q connection.
+
+    If both ends support it (see L{Virtual}), each direction of the
+    connection is flow controlled with a credit window, like HTTP/2's: the
+    sender may only have C{receiveWindow} octets which the receiver has not
+    yet delivered to its protocol in flight, and the receiver sends a
+    L{WindowUpdate} as its protocol consumes them.  No one virtual connection
+    can then fill up the Q2Q connection and hold up all the others, and a
+    protocol which pauses its transport stops its peer sending without any
+    more data piling up.  Otherwise, L{Choke} and L{Unchoke} are sent as the
+    protocol pauses and resumes its transport.
+
+    @ivar receiveWindow: The number of octets the peer may send before it
+        hears that some have been delivered.
+
+    @ivar writeBufferLimit: The number of octets which may be waiting for
+        credit before a registered producer is paused; it is resumed when
+        they have all been sent.  Writes are never refused, so a protocol
+        which does not register a producer can still buffer without limit.
+
+    @ivar flowControlled: Whether the connection uses credit windows.
+
+    @ivar binaryFrames: Whether data is sent in L{DataFrame}s rather than
+        L{Write} boxes.
+
+    @ivar noDelay: Whether each write is sent at once.  Otherwise, as with
+        Nagle's algorithm on a TCP connection, writes are coalesced, and
+        sent together once the reactor has finished with whatever it was
+        doing, or once there are C{coalesceSize} octets of them; so a
+        protocol which writes a little at a time, like an AMP protocol, sends
+        far fewer messages.  See L{setTcpNoDelay}.
+
+    @ivar coalesceSize: The number of octets of coalesced writes which are
+        sent at once.
+
+    @ivar weight: This connection's share of the Q2Q connection, relative to
+        the others over it, when it is busy; see
+        L{subproducer.SuperProducer}.  A protocol which needs to stay
+        responsive while others transfer bulk data can raise it.
+
+    @ivar _sendCredit: The number of octets which may be sent before the
+        peer grants more credit.
+
+    @ivar _sendBuffer: Strings waiting for credit to be sent.
+
+    @ivar _receiveCredit: The number of octets the peer may still send.
+
+    @ivar _received: Strings received, but not delivered to the protocol
+        because it paused its transport.
+
+    @ivar _consumed: The number of octets delivered to the protocol since
+        the last L{WindowUpdate} was sent.
+    """
     implements(interfaces.IProducer, interfaces.ITransport, interfaces.IConsumer)
     disconnecting = False
 
+    receiveWindow = 2 ** 16
+    writeBufferLimit = 2 ** 16
+    flowControlled = False
+    binaryFrames = False
+    noDelay = False
+    coalesceSize = MAX_VALUE_LENGTH
+
     def __init__(self, q2q, connectionID, protocolFactory, isClient):
         """
         @param q2q: a Q2Q Protocol instance.
@@ -1599,6 +1754,18 @@ class VirtualTransport(subproducer.SubProducer):
         self.isClient = isClient
         self.q2q.connections[self.id] = self
         self.protocolFactory = protocolFactory
+        self._sendCredit = 0
+        self._sendBuffer = []
+        self._sendBufferSize = 0
+        self._receiveCredit = self.receiveWindow
+        self._received = []
+        self._readPaused = False
+        self._delivering = False
+        self._consumed = 0
+        self._closeWhenSent = False
+        self._coalesced = []
+        self._coalescedSize = 0
+        self._flushCall = None
 
     protocol = None
 
@@ -1607,20 +1774,67 @@ class VirtualTransport(subproducer.SubProducer):
         self.protocol.makeConnection(self)
         return self.protocol
 
+    def startFlowControl(self, peerWindow):
+        """
+        Flow control this connection with credit windows, now that both ends
+        have agreed to.
+
+        @param peerWindow: the peer's C{receiveWindow}.
+        """
+        self.flowControlled = True
+        self._sendCredit = peerWindow
+
+    def windowUpdate(self, credit):
+        """
+        The peer has delivered some of what we sent; send more.
+
+        @param credit: the number of octets it delivered.
+        """
+        self._sendCredit += credit
+        self._sendBuffered()
+
     def pauseProducing(self):
-        self.q2q.callRemote(Choke, id=self.id)
+        if self.flowControlled:
+            # Grant no more credit until we are resumed.
+            self._readPaused = True
+        else:
+            self.q2q.callRemote(Choke, id=self.id)
 
     def resumeProducing(self):
-        self.q2q.callRemote(Unchoke, id=self.id)
+        if self.flowControlled:
+            self._readPaused = False
+            self._deliver()
+        else:
+            self.q2q.callRemote(Unchoke, id=self.id)
 
     def writeSequence(self, iovec):
-        self.write(''.join(iovec))
+        # Joined with the rest of what is coalesced, only once, when flushed.
+        for data in iovec:
+            if data:
+                self._coalesced.append(data)
+                self._coalescedSize += len(data)
+        if self.noDelay:
+            self._flush()
+        else:
+            self._flushLater()
 
     def loseConnection(self):
         if self.disconnecting:
             # print 'omg wtf loseConnection!???!'
             return
         self.disconnecting = True
+        self._flush()
+        if self._sendBuffer:
+            # Close once everything written has been sent.
+            self._closeWhenSent = True
+            return
+        self._sendClose()
+
+    def _sendClose(self):
+        # Behind any data still waiting for its turn.
+        self.superproducer.schedule(self, 0, self._closeNow)
+
+    def _closeNow(self):
         d = self.q2q.callRemote(Close, id=self.id)
         def cbClosed(ignored):
             self.connectionLost(Failure(CONNECTION_DONE))
@@ -1637,8 +1851,28 @@ class VirtualTransport(subproducer.SubProducer):
         d.addCallbacks(cbClosed, ebClosed)
 
 
+    _lostReason = None
+
     def connectionLost(self, reason):
         del self.q2q.connections[self.id]
+        self.superproducer.unscheduleFor(self)
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+        self._coalesced = []
+        self._coalescedSize = 0
+        self._sendBuffer = []
+        self._sendBufferSize = 0
+        if (self._received and self.protocol is not None
+                and reason.check(error.ConnectionDone)):
+            # The peer closed after sending what the protocol has not yet
+            # resumed its transport to receive; tell it once it has.
+            self._lostReason = reason
+            return
+        self._received = []
+        self._notifyLost(reason)
+
+    def _notifyLost(self, reason):
         if self.protocol is not None:
             self.protocol.connectionLost(reason)
         if self.isClient:
@@ -1646,6 +1880,49 @@ class VirtualTransport(subproducer.SubProducer):
 
 
     def dataReceived(self, data):
+        if not self.flowControlled:
+            self._dataReceived(data)
+            return
+        self._receiveCredit -= len(data)
+        if self._receiveCredit < 0:
+            self.disconnecting = True
+            d = self.q2q.callRemote(Close, id=self.id)
+            d.addErrback(lambda reason: reason.trap(error.ConnectionDone))
+            self.connectionLost(Failure(FlowControlError(
+                "Virtual #%d received %d octets more than its window" % (
+                    self.id, -self._receiveCredit))))
+            return
+        self._received.append(data)
+        self._deliver()
+
+    def _deliver(self):
+        """
+        Deliver what has been received to the protocol, unless it has paused
+        its transport, and grant the peer credit for it once there is enough
+        to be worth a L{WindowUpdate}.
+        """
+        if self._delivering:
+            # The protocol resumed its transport from dataReceived.
+            return
+        self._delivering = True
+        try:
+            while self._received and not self._readPaused:
+                data = self._received.pop(0)
+                self._consumed += len(data)
+                self._dataReceived(data)
+        finally:
+            self._delivering = False
+        if not self._received and self._lostReason is not None:
+            reason, self._lostReason = self._lostReason, None
+            self._notifyLost(reason)
+        elif (self._consumed >= self.receiveWindow // 2
+                and self.id in self.q2q.connections):
+            self._receiveCredit += self._consumed
+            self.q2q.callRemote(WindowUpdate, id=self.id,
+                                credit=self._consumed)
+            self._consumed = 0
+
+    def _dataReceived(self, data):
         try:
             self.protocol.dataReceived(data)
         except:
@@ -1659,8 +1936,98 @@ class VirtualTransport(subproducer.SubProducer):
             log.err(reason)
             self.connectionLost(reason)
 
+    def _sendData(self, data):
+        # The Q2Q decides when it is our turn; see SuperProducer.schedule.
+        if self.binaryFrames:
+            send = lambda: self.q2q.sendData(self.id, data)
+        else:
+            send = lambda: self.q2q.callRemote(Write, body=data, id=self.id)
+        self.superproducer.schedule(self, len(data), send)
+
+    def setTcpNoDelay(self, enabled):
+        """
+        Like L{ITCPTransport.setTcpNoDelay}: send each write at once, or
+        coalesce them.  See L{noDelay}.
+        """
+        self.noDelay = enabled
+        if enabled:
+            self._flush()
+
+    def getTcpNoDelay(self):
+        """
+        Like L{ITCPTransport.getTcpNoDelay}.
+        """
+        return self.noDelay
+
     def write(self, data):
-        self.q2q.callRemote(Write, body=data, id=self.id)
+        if self.noDelay:
+            self._write(data)
+            return
+        if not data:
+            return
+        self._coalesced.append(data)
+        self._coalescedSize += len(data)
+        self._flushLater()
+
+    def _flushLater(self):
+        """
+        Send the writes which have been coalesced once the reactor is done
+        with whatever made them, or now, if there are enough of them.
+        """
+        if self._coalescedSize >= self.coalesceSize:
+            self._flush()
+        elif self._coalesced and self._flushCall is None:
+            self._flushCall = reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        """
+        Send the writes which have been coalesced.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if self._coalesced:
+            data = ''.join(self._coalesced)
+            self._coalesced = []
+            self._coalescedSize = 0
+            self._write(data)
+
+    def _write(self, data):
+        if not self.flowControlled:
+            for start in xrange(0, len(data), MAX_VALUE_LENGTH):
+                self._sendData(data[start:start + MAX_VALUE_LENGTH])
+            return
+        if not data:
+            return
+        self._sendBuffer.append(data)
+        self._sendBufferSize += len(data)
+        self._sendBuffered()
+        if self._sendBufferSize > self.writeBufferLimit:
+            self.choke()
+
+    def _sendBuffered(self):
+        """
+        Send as much of what has been written as the peer has granted credit
+        for.
+        """
+        while self._sendBuffer and self._sendCredit > 0:
+            data = self._sendBuffer[0]
+            size = min(len(data), self._sendCredit, MAX_VALUE_LENGTH)
+            if size < len(data):
+                self._sendBuffer[0] = data[size:]
+                data = data[:size]
+            else:
+                del self._sendBuffer[0]
+            self._sendBufferSize -= size
+            self._sendCredit -= size
+            self._sendData(data)
+        if not self._sendBuffer:
+            if not self.peerAcceptingData:
+                self.unchoke()
+            if self._closeWhenSent:
+                self._closeWhenSent = False
+                self._sendClose()
 
     def getHost(self):
         return VirtualTransportAddress(self.q2q.transport.getHost())
@@ -1972,8 +2339,25 @@ def _noResults(*x):
     return []
 
 class PTCPConnectionDispatcher(object):
-    def __init__(self, factory):
+    """
+    @ivar batchedIO: whether to bind ports which send and receive datagrams
+        in batches; see L{vertex.udpbatch}.
+
+    @ivar keepAlive: how long, in seconds, connections over the ports bound
+        may be idle before they are probed; see L{ptcp.PTCP.keepAlive}.  The
+        default is short enough to refresh the NAT mappings punched by
+        L{seedNAT} before most NATs forget them.
+
+    @ivar checksums: whether the ports bound compute and check checksums;
+        see L{ptcp.PTCP.checksums}.  Only turn this off if everything carried
+        over them is protected by TLS.
+    """
+    def __init__(self, factory, batchedIO=False, keepAlive=25.0,
+                 checksums=True):
         self.factory = factory
+        self.batchedIO = batchedIO
+        self.keepAlive = keepAlive
+        self.checksums = checksums
         self._ports = {}
 
     def seedNAT(self, hostport, sourcePort=0, conditional=True):
@@ -1994,13 +2378,41 @@ class PTCPConnectionDispatcher(object):
 
     def bindNewPort(self, portNum=0, iface=''):
         iPortNum = portNum
-        proto = ptcp.PTCP(self.factory)
-        p = reactor.listenUDP(portNum, proto, interface=iface)
+        proto = ptcp.PTCP(self.factory, keepAlive=self.keepAlive,
+                          checksums=self.checksums)
+        if self.batchedIO:
+            p = udpbatch.listenUDP(portNum, proto, interface=iface)
+        else:
+            p = reactor.listenUDP(portNum, proto, interface=iface)
         portNum = p.getHost().port
         log.msg("Binding PTCP/UDP %d=%d" % (iPortNum,portNum))
         self._ports[portNum] = (p, proto)
         return portNum
 
+    def bindShardedPort(self, portNum, index, count, path, iface=''):
+        """
+        Bind a UDP port which other processes share, as the worker for one
+        shard of the PTCP connections over it; see L{vertex.ptcpshard}.
+
+        @param index: the number of this process's shard, from 0.
+
+        @param count: the number of processes sharing the port.
+
+        @param path: the path of each process's socket for passing datagrams
+            to the others, with a C{%d} for the number of its shard.
+
+        @return: the number of the port bound.
+        """
+        proto = ptcp.PTCP(self.factory, keepAlive=self.keepAlive,
+                          checksums=self.checksums)
+        p = ptcpshard.listenSharded(portNum, proto, index, count, path,
+                                    interface=iface)
+        portNum = p.getHost().port
+        log.msg("Binding PTCP/UDP %d as shard %d of %d" % (
+                portNum, index, count))
+        self._ports[portNum] = (p, proto)
+        return portNum
+
     def unbindPort(self, portNum):
         log.msg("Unbinding PTCP/UDP %d" % portNum)
         port, proto = self._ports.pop(portNum)
@@ -2019,6 +2431,16 @@ class PTCPConnectionDispatcher(object):
                     # print 'NOT yielding', c, 'in', c.state
                     pass
 
+    def statistics(self):
+        """
+        @return: a L{ptcp.PTCPStatistics} describing the traffic on all the
+            connections there have been over the ports currently bound.
+        """
+        stats = ptcp.PTCPStatistics()
+        for p, proto in self._ports.itervalues():
+            stats.merge(proto.statistics())
+        return stats
+
     def killAllConnections(self):
         dl = []
         for p, proto in self._ports.itervalues():
@@ -2045,6 +2467,21 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
         <https://en.wikipedia.org/wiki/Network_address_translation
         #Methods_of_translation>}.
     @type sharedUDPPortnum: L{int}
+
+    @ivar batchedIO: whether PTCP ports send and receive datagrams in
+        batches; see L{PTCPConnectionDispatcher.batchedIO}.
+    @type batchedIO: L{bool}
+
+    @ivar ptcpChecksums: whether PTCP ports compute and check checksums; see
+        L{PTCPConnectionDispatcher.checksums}.
+    @type ptcpChecksums: L{bool}
+
+    @ivar udpShard: if not L{None}, a tuple of C{(portNum, index, count,
+        path)}: the shared UDP port is then port C{portNum}, shared with
+        other processes, of which this is the one with shard C{index}; see
+        L{PTCPConnectionDispatcher.bindShardedPort}.  It is bound instead of
+        a UDP port alongside C{q2qPortnum}, which such processes cannot
+        share.
     """
     # server factory stuff
     publicIP = None
@@ -2083,7 +2520,10 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
                  publicIP=None,
                  udpEnabled=None,
                  portal=None,
-                 verifyHook=None):
+                 verifyHook=None,
+                 batchedIO=None,
+                 ptcpChecksums=None,
+                 udpShard=None):
         """
 
         @param protocolFactoryFactory: A callable of three arguments
@@ -2093,11 +2533,26 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
 
         @param certificateStorage: an implementor of ICertificateStore, or None
         for the default implementation.
+
+        @param batchedIO: see L{Q2QService.batchedIO}.
+
+        @param ptcpChecksums: see L{Q2QService.ptcpChecksums}.
+
+        @param udpShard: see L{Q2QService.udpShard}.
         """
 
         if udpEnabled is not None:
             self.udpEnabled = udpEnabled
 
+        if batchedIO is not None:
+            self.batchedIO = batchedIO
+
+        if ptcpChecksums is not None:
+            self.ptcpChecksums = ptcpChecksums
+
+        if udpShard is not None:
+            self.udpShard = udpShard
+
         if protocolFactoryFactory is None:
             protocolFactoryFactory = _noResults
         self.protocolFactoryFactory = protocolFactoryFactory
@@ -2323,15 +2778,25 @@ class Q2QService(service.MultiService, protocol.ServerFactory):
 
     virtualEnabled = True
 
+    batchedIO = False
+    ptcpChecksums = True
+    udpShard = None
+
     def startService(self):
         self._bootstrapFactory = Q2QBootstrapFactory(self)
         if self.udpEnabled:
-            self.dispatcher = PTCPConnectionDispatcher(self._bootstrapFactory)
+            self.dispatcher = PTCPConnectionDispatcher(
+                self._bootstrapFactory, batchedIO=self.batchedIO,
+                checksums=self.ptcpChecksums)
+            if self.udpShard is not None:
+                portNum, index, count, path = self.udpShard
+                self.sharedUDPPortnum = self.dispatcher.bindShardedPort(
+                    portNum, index, count, path, iface=self.publicIP or '')
 
         if self.q2qPortnum is not None:
             self.q2qPort = reactor.listenTCP(self.q2qPortnum, self)
             self.q2qPortnum = self.q2qPort.getHost().port
-            if self.dispatcher is not None:
+            if self.dispatcher is not None and self.sharedUDPPortnum is None:
                 self.sharedUDPPortnum = self.dispatcher.bindNewPort(self.q2qPortnum, iface=self.publicIP or '')
 
         if self.inboundTCPPortnum is not None:
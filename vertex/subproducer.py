@@ -1,6 +1,9 @@
 # -*- test-case-name: vertex.test.test_subproducer -*-
 # Copyright 2005 Divmod, Inc.  See LICENSE file for details
 
+from collections import deque
+
+from twisted.internet import reactor
 from twisted.python import log
 
 class SuperProducer:
@@ -9,15 +12,180 @@ class SuperProducer:
     consumer.
 
     I must be mixed into a protocol, or something else with a 'transport' attribute.
+
+    I also decide which of my sub-producers gets to write next.  While my
+    consumer is paused, what they send is queued, and once it resumes the
+    queues are sent by deficit round robin: each sub-producer in turn may
+    send up to its 'weight' times 'quantum' octets more than it has already
+    sent, so that a bulk transfer cannot hold up an interactive one for long,
+    however much it has queued.
+
+    So that my consumer can pause me, I register with it as a streaming
+    producer whenever I have anything to share out: while any of my
+    sub-producers has a producer, or anything is queued, or I am paused.  My
+    sub-producers' producers which are not streaming are asked for more each
+    time the reactor comes round, as long as I am not paused.
+
+    @ivar quantum: the number of octets a sub-producer with a weight of 1
+    may send in each round.
     """
 
     producersPaused = False
+    quantum = 2 ** 14
 
     def __init__(self):
         self.producingTransports = {}
+        self._registered = False
+        self._pullCall = None
+        self._clearSchedule()
+
+    def _clearSchedule(self):
+        # What each sub-producer has queued, as (size, send) pairs.
+        self._queues = {}
+        # How much more each sub-producer may send in its turn.
+        self._deficits = {}
+        # The sub-producers with queues, the one whose turn it is first.
+        self._active = deque()
+        # Whether the first of them has had its quantum for this turn.
+        self._turnStarted = False
+        self._draining = False
+
+    def schedule(self, trans, size, send):
+        """
+        Send something on behalf of one of my sub-producers, as soon as it is
+        that one's turn.
+
+        @param trans: the L{SubProducer} sending.
+
+        @param size: the number of octets that will be sent.
+
+        @param send: a callable of no arguments which sends it.
+        """
+        self._register()
+        if not self._active and not self.producersPaused:
+            # Nothing is waiting, so nobody is being overtaken.
+            send()
+        else:
+            queue = self._queues.get(trans)
+            if queue is None:
+                queue = self._queues[trans] = deque()
+                self._deficits[trans] = 0
+                self._active.append(trans)
+            queue.append((size, send))
+            self._drain()
+        self._unregisterIfIdle()
+
+    def unscheduleFor(self, trans):
+        """
+        Forget whatever one of my sub-producers has queued.
+        """
+        if trans in self._queues:
+            # Empty it too, in case it is being drained.
+            self._queues.pop(trans).clear()
+            del self._deficits[trans]
+            if self._active[0] is trans:
+                self._turnStarted = False
+            self._active.remove(trans)
+
+    def _drain(self):
+        """
+        Send what my sub-producers have queued, in turn, until my consumer
+        pauses me.
+        """
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while self._active and not self.producersPaused:
+                trans = self._active[0]
+                queue = self._queues[trans]
+                deficit = self._deficits[trans]
+                if not self._turnStarted:
+                    deficit += self.quantum * trans.weight
+                    self._turnStarted = True
+                while (queue and queue[0][0] <= deficit
+                       and not self.producersPaused):
+                    size, send = queue.popleft()
+                    deficit -= size
+                    try:
+                        send()
+                    except:
+                        log.err()
+                if self._queues.get(trans) is not queue:
+                    # It was unscheduled while sending.
+                    continue
+                if not queue:
+                    self.unscheduleFor(trans)
+                elif self.producersPaused and queue[0][0] <= deficit:
+                    # Carry on with this turn once we are resumed.
+                    self._deficits[trans] = deficit
+                else:
+                    self._deficits[trans] = deficit
+                    self._active.rotate(-1)
+                    self._turnStarted = False
+        finally:
+            self._draining = False
+
+    def transportDisconnecting(self):
+        """
+        Whether my consumer has been asked to close its connection.
+        """
+        return getattr(self.transport, 'disconnecting', False)
+
+    def _register(self):
+        """
+        Register with my consumer, if I am not already, so that it pauses me
+        when it is full; but not once it is disconnecting, since some
+        consumers only throw away what is written after that while no
+        producer is registered.
+        """
+        if not (self._registered or self.transportDisconnecting()):
+            self._registered = True
+            self.transport.registerProducer(self, True)
+
+    def _unregisterIfIdle(self):
+        """
+        Unregister from my consumer if I have nothing more to share out.
+        """
+        if (self._registered and not self.producingTransports
+                and not self._active and not self.producersPaused):
+            self._registered = False
+            self.transport.unregisterProducer()
+
+    def _pullSoon(self):
+        """
+        Ask my sub-producers' producers which are not streaming for more once
+        the reactor comes round, unless I am paused.  My consumer will not
+        ask them, since I am streaming.
+        """
+        if self._pullCall is not None or self.producersPaused:
+            return
+        for transport in self.producingTransports:
+            if not transport.streamingProducer:
+                self._pullCall = reactor.callLater(0, self._pull)
+                return
+
+    def _stopPulling(self):
+        if self._pullCall is not None:
+            self._pullCall.cancel()
+            self._pullCall = None
+
+    def _pull(self):
+        self._pullCall = None
+        if self.producersPaused:
+            return
+        for transport in self.producingTransports.keys():
+            if not transport.streamingProducer:
+                try:
+                    transport.maybeResumeProducing()
+                except:
+                    del self.producingTransports[transport]
+                    log.err()
+        self._pullSoon()
 
     def pauseProducing(self):
         self.producersPaused = True
+        self._stopPulling()
         for transport in self.producingTransports.keys():
             try:
                 transport.parentPauseProducing()
@@ -29,41 +197,68 @@ class SuperProducer:
         producersWerePaused = self.producersPaused
         if producersWerePaused:
             self.producersPaused = False
+        self._drain()
+        if self.producersPaused:
+            # What was queued filled the consumer up again.
+            return
         for transport in self.producingTransports.keys():
             try:
                 transport.parentResumeProducing()
             except:
                 del self.producingTransports[transport]
                 log.err()
+        self._pullSoon()
+        self._unregisterIfIdle()
 
     def stopProducing(self):
+        self._stopPulling()
         for transport in self.producingTransports.keys():
             try:
                 transport.parentStopProducing()
             except:
                 log.err()
         self.producingTransports = {}
+        self._clearSchedule()
 
     def registerProducerFor(self, trans):
         if not self.producersPaused:
             trans.parentResumeProducing()
-        wasProducing = bool(self.producingTransports)
         assert trans not in self.producingTransports
         self.producingTransports[trans] = 1
-        if not wasProducing:
-            self.transport.registerProducer(self, False)
+        self._register()
+        self._pullSoon()
 
     def unregisterProducerFor(self, trans):
         if trans in self.producingTransports:
             del self.producingTransports[trans]
-            if not self.producingTransports:
-                self.transport.unregisterProducer()
+            # Stop asking for more if that was the last one to ask.
+            self._stopPulling()
+            self._pullSoon()
+            self._unregisterIfIdle()
 
 
-class SubProducer:
+class SubProducer(object):
     """ I am a mixin that provides upwards-registration of my producer to a
     SuperProducer instance.
+
+    @ivar weight: my share of my SuperProducer's consumer, relative to its
+    other sub-producers', when they all have something to send.  An
+    application may change it at any time, to any positive number.
     """
+
+    _weight = 1
+
+    def _getWeight(self):
+        return self._weight
+
+    def _setWeight(self, weight):
+        if not weight > 0:
+            # Otherwise my turns would never let me send anything.
+            raise ValueError("Weight must be positive, not %r" % (weight,))
+        self._weight = weight
+
+    weight = property(_getWeight, _setWeight)
+
     def __init__(self, superproducer):
         self.superproducer = superproducer
         self.producer = None
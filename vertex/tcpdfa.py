@@ -120,6 +120,13 @@ class TCP(object):
         
         """
 
+    @_machine.input()
+    def appHalfClose(self):
+        """
+        The application has finished sending, but not receiving; send a FIN
+        without disconnecting it.
+        """
+
     @_machine.input()
     def synAck(self):
         """
@@ -175,8 +182,9 @@ class TCP(object):
         is acknowledged by our peer, generate a single 'ack' input.
         """
         last = self.lastTransmitted
+        end = last.relativeSeq() + last.segmentLength()
         self.ackPredicate = lambda ackPacket: (
-            ackPacket.relativeAck() >= last.relativeSeq()
+            ackPacket.relativeAck() >= end
         )
 
 
@@ -198,9 +206,9 @@ class TCP(object):
     @_machine.output()
     def sendFin(self):
         """
-        
+        Send a FIN packet, acknowledging everything received so far.
         """
-        self.originate(fin=True)
+        self.originate(fin=True, ack=True)
 
 
     @_machine.output()
@@ -242,13 +250,15 @@ class TCP(object):
         """
         Receive an L{ack} or L{synAck} input from the given packet.
         """
-        ackPredicate = self.ackPredicate
-        self.ackPredicate = lambda packet: False
         if ackPacket.syn:
             # New SYN packets are always news.
+            self.ackPredicate = lambda packet: False
             self.synAck()
             return
-        if ackPredicate(ackPacket):
+        # An acknowledgement of only some of the data sent before our last
+        # packet is not the one we are waiting for; keep waiting.
+        if self.ackPredicate(ackPacket):
+            self.ackPredicate = lambda packet: False
             self.ack()
 
 
@@ -309,74 +319,136 @@ class TCP(object):
         self._impl.outgoingConnectionFailed()
 
 
+    def _entered(machine, name):
+        """
+        Make an output which tells our implementation that we have entered
+        the named state.  Every transition to a different state produces one,
+        before any other output, so that those see the new state.
+        """
+        def entered(self):
+            self._impl.stateEntered(name)
+        entered.__name__ = 'entered' + name[0].upper() + name[1:]
+        return machine.output()(entered)
+
+    enteredClosed = _entered(_machine, 'closed')
+    enteredSynSent = _entered(_machine, 'synSent')
+    enteredSynRcvd = _entered(_machine, 'synRcvd')
+    enteredListen = _entered(_machine, 'listen')
+    enteredEstablished = _entered(_machine, 'established')
+    enteredCloseWait = _entered(_machine, 'closeWait')
+    enteredLastAck = _entered(_machine, 'lastAck')
+    enteredFinWait1 = _entered(_machine, 'finWait1')
+    enteredFinWait2 = _entered(_machine, 'finWait2')
+    enteredClosing = _entered(_machine, 'closing')
+    enteredTimeWait = _entered(_machine, 'timeWait')
+
+    del _entered
+
+
     # invariant: if a state has .upon(ack) in it, all enter=that-state edges
     # here must produce the "expectAck" output.
-    closed.upon(appPassiveOpen, enter=listen, outputs=[appNotifyListen])
-    closed.upon(appActiveOpen, enter=synSent, outputs=[sendSyn,
-                                                       expectAck])
+    closed.upon(appPassiveOpen, enter=listen,
+                outputs=[enteredListen, appNotifyListen])
+    closed.upon(appActiveOpen, enter=synSent,
+                outputs=[enteredSynSent, sendSyn, expectAck])
 
     synSent.upon(timeout, enter=closed,
-                 outputs=[appNotifyAttemptFailed, releaseResources])
+                 outputs=[enteredClosed, appNotifyAttemptFailed,
+                          releaseResources])
     synSent.upon(appClose, enter=closed,
-                 outputs=[appNotifyAttemptFailed, releaseResources])
+                 outputs=[enteredClosed, appNotifyAttemptFailed,
+                          releaseResources])
     synSent.upon(synAck, enter=established,
-                 outputs=[sendAck, appNotifyConnected])
+                 outputs=[enteredEstablished, sendAck, appNotifyConnected])
 
     synRcvd.upon(ack, enter=established,
-                 outputs=[appNotifyConnected])
+                 outputs=[enteredEstablished, appNotifyConnected])
     synRcvd.upon(appClose, enter=finWait1,
-                 outputs=[sendFin, expectAck])
+                 outputs=[enteredFinWait1, sendFin, expectAck])
     synRcvd.upon(timeout, enter=closed,
-                 outputs=[sendRst, releaseResources])
+                 outputs=[enteredClosed, sendRst, releaseResources])
     synRcvd.upon(rst, enter=broken,
-                 outputs=[releaseResources])
+                 outputs=[enteredClosed, releaseResources])
 
     listen.upon(appSendData, enter=synSent,
-                outputs=[sendSyn, expectAck])
+                outputs=[enteredSynSent, sendSyn, expectAck])
     listen.upon(syn, enter=synRcvd,
-                outputs=[sendSynAck, expectAck])
+                outputs=[enteredSynRcvd, sendSynAck, expectAck])
 
     established.upon(appClose, enter=finWait1,
-                     outputs=[appNotifyDisconnected,
+                     outputs=[enteredFinWait1,
+                              appNotifyDisconnected,
+                              sendFin,
+                              expectAck])
+    established.upon(appHalfClose, enter=finWait1,
+                     outputs=[enteredFinWait1,
                               sendFin,
                               expectAck])
     established.upon(fin, enter=closeWait,
-                     outputs=[appNotifyHalfClose,
+                     outputs=[enteredCloseWait,
+                              appNotifyHalfClose,
                               sendAck])
-    established.upon(timeout, enter=broken, outputs=[appNotifyDisconnected,
-                                                     releaseResources])
+    established.upon(timeout, enter=broken,
+                     outputs=[enteredClosed,
+                              appNotifyDisconnected,
+                              releaseResources])
 
     established.upon(segmentReceived, enter=established,
                      outputs=[sendAckSoon])
 
 
     closeWait.upon(appClose, enter=lastAck,
-                   outputs=[sendFin,
+                   outputs=[enteredLastAck,
+                            sendFin,
+                            expectAck,
+                            appNotifyDisconnected])
+    closeWait.upon(appHalfClose, enter=lastAck,
+                   outputs=[enteredLastAck,
+                            sendFin,
                             expectAck,
                             appNotifyDisconnected])
     closeWait.upon(timeout, enter=broken,
-                   outputs=[appNotifyDisconnected,
+                   outputs=[enteredClosed,
+                            appNotifyDisconnected,
                             releaseResources])
 
-    lastAck.upon(ack, enter=closed, outputs=[releaseResources])
-    lastAck.upon(timeout, enter=broken, outputs=[releaseResources])
+    lastAck.upon(ack, enter=closed,
+                 outputs=[enteredClosed, releaseResources])
+    lastAck.upon(timeout, enter=broken,
+                 outputs=[enteredClosed, releaseResources])
 
     # TODO: is this actually just "ack" or is it ack _of_ something in
     # particular?  ack of the fin we sent upon transitioning to this state?
-    finWait1.upon(ack, enter=finWait2, outputs=[])
-    finWait1.upon(fin, enter=closing, outputs=[sendAck])
-    finWait1.upon(timeout, enter=broken, outputs=[releaseResources])
-
-    finWait2.upon(timeout, enter=broken, outputs=[releaseResources])
-    finWait2.upon(fin, enter=timeWait, outputs=[sendAck, startTimeWaiting])
-
-    closing.upon(timeout, enter=broken, outputs=[releaseResources])
-    closing.upon(ack, enter=timeWait, outputs=[startTimeWaiting])
-
-    timeWait.upon(timeout, enter=closed, outputs=[releaseResources])
-
-    for noDataState in [finWait1, finWait2, closing]:
-        noDataState.upon(segmentReceived, enter=noDataState, outputs=[])
+    finWait1.upon(ack, enter=finWait2, outputs=[enteredFinWait2])
+    # An application which only half-closed the connection is still there
+    # in FIN-WAIT-1 and FIN-WAIT-2, receiving data, until our peer closes its
+    # half too.  One which closed it fully has already been told that it is
+    # disconnected, and is not told again.
+    finWait1.upon(fin, enter=closing,
+                  outputs=[enteredClosing, sendAck, appNotifyDisconnected])
+    finWait1.upon(timeout, enter=broken,
+                  outputs=[enteredClosed, appNotifyDisconnected,
+                           releaseResources])
+
+    finWait2.upon(timeout, enter=broken,
+                  outputs=[enteredClosed, appNotifyDisconnected,
+                           releaseResources])
+    finWait2.upon(fin, enter=timeWait,
+                  outputs=[enteredTimeWait, sendAck, appNotifyDisconnected,
+                           startTimeWaiting])
+
+    closing.upon(timeout, enter=broken,
+                 outputs=[enteredClosed, releaseResources])
+    closing.upon(ack, enter=timeWait,
+                 outputs=[enteredTimeWait, startTimeWaiting])
+
+    timeWait.upon(timeout, enter=closed,
+                  outputs=[enteredClosed, releaseResources])
+
+    for halfClosedState in [finWait1, finWait2]:
+        halfClosedState.upon(segmentReceived, enter=halfClosedState,
+                             outputs=[sendAckSoon])
+    closing.upon(segmentReceived, enter=closing, outputs=[])
 
 if __name__ == '__main__':
     for line in TCP._machine.graphviz():
@@ -0,0 +1,207 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{vertex.congestion}.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from vertex import congestion
+
+MSS = 1000
+
+
+
+class NewRenoTests(TestCase):
+    """
+    Tests for L{congestion.NewReno}.
+    """
+
+    controllerClass = congestion.NewReno
+
+    def setUp(self):
+        self.controller = self.controllerClass(MSS)
+
+
+    def test_initialWindow(self):
+        """
+        A new controller starts with the RFC 3390 initial window and an
+        unbounded slow start threshold.
+        """
+        self.assertEqual(self.controller.cwnd, 4 * MSS)
+        self.assertTrue(self.controller.inSlowStart())
+
+
+    def test_initialWindowSmallSegments(self):
+        """
+        The initial window is never larger than four segments nor smaller than
+        two.
+        """
+        self.assertEqual(congestion.initialWindow(100), 400)
+        self.assertEqual(congestion.initialWindow(4000), 8000)
+        self.assertEqual(congestion.initialWindow(2000), 4380)
+
+
+    def test_slowStart(self):
+        """
+        In slow start, each acknowledgement grows the window by the number of
+        octets acknowledged, up to one segment.
+        """
+        self.controller.acked(MSS, 0)
+        self.assertEqual(self.controller.cwnd, 5 * MSS)
+        self.controller.acked(3 * MSS, 0)
+        self.assertEqual(self.controller.cwnd, 6 * MSS)
+        self.controller.acked(MSS // 2, 0)
+        self.assertEqual(self.controller.cwnd, 6 * MSS + MSS // 2)
+
+
+    def test_congestionAvoidance(self):
+        """
+        Once the window reaches the slow start threshold, it grows by one
+        segment for each window's worth of data acknowledged.
+        """
+        self.controller.ssthresh = 4 * MSS
+        self.assertFalse(self.controller.inSlowStart())
+        for i in range(3):
+            self.controller.acked(MSS, 0)
+        self.assertEqual(self.controller.cwnd, 4 * MSS)
+        self.controller.acked(MSS, 0)
+        self.assertEqual(self.controller.cwnd, 5 * MSS)
+
+
+    def test_lossDetected(self):
+        """
+        Fast retransmit halves the amount of data in flight to get the new
+        slow start threshold, and inflates the window by the three segments
+        which generated the duplicate acknowledgements.
+        """
+        self.controller.cwnd = 20 * MSS
+        self.controller.lossDetected(20 * MSS, 0)
+        self.assertEqual(self.controller.ssthresh, 10 * MSS)
+        self.assertEqual(self.controller.cwnd, 13 * MSS)
+        self.controller.duplicateAck()
+        self.assertEqual(self.controller.cwnd, 14 * MSS)
+
+
+    def test_minimumThreshold(self):
+        """
+        The slow start threshold never drops below two segments.
+        """
+        self.controller.lossDetected(MSS, 0)
+        self.assertEqual(self.controller.ssthresh, 2 * MSS)
+
+
+    def test_partialAck(self):
+        """
+        A partial acknowledgement during fast recovery deflates the window by
+        the amount acknowledged, then adds back one segment.
+        """
+        self.controller.cwnd = 13 * MSS
+        self.controller.partialAck(3 * MSS)
+        self.assertEqual(self.controller.cwnd, 11 * MSS)
+
+
+    def test_recoveryComplete(self):
+        """
+        Leaving fast recovery sets the window to the slow start threshold, or
+        to slightly more than what is still in flight if that is smaller.
+        """
+        self.controller.ssthresh = 10 * MSS
+        self.controller.cwnd = 15 * MSS
+        self.controller.recoveryComplete(12 * MSS, 0)
+        self.assertEqual(self.controller.cwnd, 10 * MSS)
+        self.controller.recoveryComplete(2 * MSS, 0)
+        self.assertEqual(self.controller.cwnd, 3 * MSS)
+
+
+    def test_timeout(self):
+        """
+        A retransmission timeout collapses the window to one segment and puts
+        the connection back into slow start.
+        """
+        self.controller.cwnd = 20 * MSS
+        self.controller.timeout(16 * MSS, 0)
+        self.assertEqual(self.controller.cwnd, MSS)
+        self.assertTrue(self.controller.inSlowStart())
+
+
+    def test_setMSS(self):
+        """
+        Changing the segment size keeps the window the same number of
+        segments large.
+        """
+        self.controller.setMSS(MSS // 2)
+        self.assertEqual(self.controller.mss, MSS // 2)
+        self.assertEqual(self.controller.cwnd, 2 * MSS)
+
+
+
+class CubicTests(NewRenoTests):
+    """
+    Tests for L{congestion.Cubic}.  It shares its slow start, fast recovery
+    and timeout behaviour with L{congestion.NewReno}, except that it backs
+    off by less.
+    """
+
+    controllerClass = congestion.Cubic
+
+    def test_lossDetected(self):
+        """
+        Fast retransmit reduces the slow start threshold by CUBIC's beta
+        factor rather than halving it, and remembers the window at the time
+        of the loss.
+        """
+        self.controller.cwnd = 20 * MSS
+        self.controller.lossDetected(20 * MSS, 0)
+        self.assertEqual(self.controller.ssthresh, 14 * MSS)
+        self.assertEqual(self.controller.cwnd, 17 * MSS)
+        self.assertEqual(self.controller.wMax, 20)
+
+
+    def test_fastConvergence(self):
+        """
+        A loss while the window is still below the window at the previous loss
+        lowers the remembered maximum further, to make room for other flows.
+        """
+        self.controller.wMax = 30
+        self.controller.cwnd = 20 * MSS
+        self.controller.lossDetected(20 * MSS, 0)
+        self.assertEqual(self.controller.wMax, 20 * 1.7 / 2)
+
+
+    def test_congestionAvoidance(self):
+        """
+        After a loss, the window grows back towards the window at which the
+        loss happened, reaching it after C{K} seconds, and then keeps probing
+        beyond it.
+        """
+        self.controller.cwnd = 100 * MSS
+        self.controller.timeout(100 * MSS, 0)
+        self.controller.cwnd = self.controller.ssthresh
+        now = 0.0
+        k = ((100 - 70) / self.controller.C) ** (1.0 / 3.0)
+        windows = []
+        while now < 2 * k:
+            for i in range(self.controller.cwnd // MSS):
+                self.controller.acked(MSS, now)
+            windows.append(self.controller.cwnd)
+            now += 0.1
+        self.assertTrue(windows[0] < 80 * MSS, windows[0])
+        self.assertEqual(windows, sorted(windows))
+        self.assertTrue(windows[-1] > 100 * MSS, windows[-1])
+
+
+    def test_tcpFriendly(self):
+        """
+        When the cubic function would grow the window more slowly than
+        NewReno, the window grows at least as fast as NewReno's would.
+        """
+        self.controller.ssthresh = 10 * MSS
+        self.controller.cwnd = 10 * MSS
+        self.controller.wMax = 10
+        # With no time passing, the cubic target never rises.
+        for i in range(100):
+            self.controller.acked(MSS, 0)
+        self.assertTrue(self.controller.cwnd > 12 * MSS,
+                        self.controller.cwnd)
@@ -0,0 +1,300 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{vertex.netemu} and L{vertex.ptcpbench}.
+"""
+
+from StringIO import StringIO
+
+from twisted.internet import protocol, task
+from twisted.python import usage
+from twisted.trial import unittest
+
+from vertex import ptcp, ptcpbench
+from vertex.netemu import EmulatedLink, LinkConditions
+
+
+
+class RecordingProtocol(protocol.DatagramProtocol):
+    """
+    A datagram protocol which remembers the datagrams it receives, and when.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.received = []
+        self.stopped = False
+
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((self.clock.seconds(), datagram, addr))
+
+
+    def stopProtocol(self):
+        self.stopped = True
+
+
+
+class EmulatedLinkTests(unittest.TestCase):
+    """
+    Tests for L{EmulatedLink}.
+    """
+
+    def connect(self, forward=None, backward=None, seed=0):
+        """
+        Start two L{RecordingProtocol}s on either end of a link.
+        """
+        self.clock = task.Clock()
+        self.link = EmulatedLink(self.clock, forward, backward, seed)
+        self.a = RecordingProtocol(self.clock)
+        self.b = RecordingProtocol(self.clock)
+        self.link.connect(self.a, self.b)
+
+
+    def send(self, count, size=10):
+        """
+        Send some numbered datagrams from C{a} to C{b}, and wait for them all
+        to arrive.
+
+        @return: the numbers of the datagrams which arrived, in order.
+        """
+        for i in range(count):
+            self.a.transport.write(str(i).ljust(size), ('10.1.1.1', 1))
+        self.clock.pump([1] * 100)
+        return [int(datagram) for (when, datagram, addr) in self.b.received]
+
+
+    def test_perfect(self):
+        """
+        A link with no impairments delivers every datagram at once, in order,
+        from the address of the other end.
+        """
+        self.connect()
+        self.a.transport.write('hello', ('10.1.1.1', 1))
+        self.b.transport.write('goodbye', ('10.1.1.1', 1))
+        self.clock.advance(0)
+        self.assertEqual(self.b.received,
+                         [(0, 'hello', EmulatedLink.addressA)])
+        self.assertEqual(self.a.received,
+                         [(0, 'goodbye', EmulatedLink.addressB)])
+        self.assertEqual(self.link.a.getHost().port, EmulatedLink.addressA[1])
+
+
+    def test_delay(self):
+        """
+        Datagrams arrive after the link's delay, which may be different in
+        each direction.
+        """
+        self.connect(LinkConditions(delay=0.5), LinkConditions(delay=0.25))
+        self.a.transport.write('hello')
+        self.b.transport.write('goodbye')
+        self.clock.advance(0.3)
+        self.assertEqual(self.b.received, [])
+        self.assertEqual(len(self.a.received), 1)
+        self.clock.advance(0.2)
+        self.assertEqual([when for (when, d, a) in self.b.received], [0.5])
+
+
+    def test_loss(self):
+        """
+        The link drops the given proportion of datagrams, and counts them.
+        """
+        self.connect(LinkConditions(loss=0.25))
+        received = self.send(1000)
+        self.assertApproximates(len(received), 750, 50)
+        self.assertEqual(received, sorted(received))
+        self.assertEqual(self.link.forward.sent, 1000)
+        self.assertEqual(self.link.forward.dropped, 1000 - len(received))
+        self.assertEqual(self.link.forward.delivered, len(received))
+
+
+    def test_seed(self):
+        """
+        Links with the same seed drop the same datagrams; links with different
+        ones do not.
+        """
+        self.connect(LinkConditions(loss=0.5), seed=3)
+        first = self.send(100)
+        self.connect(LinkConditions(loss=0.5), seed=3)
+        self.assertEqual(self.send(100), first)
+        self.connect(LinkConditions(loss=0.5), seed=4)
+        self.assertNotEqual(self.send(100), first)
+
+
+    def test_duplicate(self):
+        """
+        The link delivers the given proportion of datagrams twice.
+        """
+        self.connect(LinkConditions(duplicate=0.1))
+        received = self.send(1000)
+        self.assertApproximates(len(received), 1100, 40)
+        self.assertEqual(sorted(set(received)), range(1000))
+
+
+    def test_reorder(self):
+        """
+        The link holds back the given proportion of datagrams for an extra
+        delay, so that some later ones overtake them.
+        """
+        self.connect(LinkConditions(delay=1.0, reorder=0.1))
+        for i in range(100):
+            self.a.transport.write(str(i))
+            self.clock.advance(0.1)
+        self.clock.pump([1] * 10)
+        received = [int(d) for (when, d, a) in self.b.received]
+        self.assertEqual(sorted(received), range(100))
+        self.assertNotEqual(received, range(100))
+
+
+    def test_jitter(self):
+        """
+        Each datagram's delay varies by up to the link's jitter.
+        """
+        self.connect(LinkConditions(delay=1.0, jitter=0.5))
+        for i in range(100):
+            self.a.transport.write('x')
+        self.clock.pump([0.01] * 200)
+        times = [when for (when, d, a) in self.b.received]
+        self.assertEqual(len(times), 100)
+        self.assertTrue(min(times) >= 0.5)
+        self.assertTrue(max(times) <= 1.5 + 0.01)
+        self.assertTrue(max(times) - min(times) > 0.5)
+
+
+    def test_bandwidth(self):
+        """
+        Datagrams are put onto a link with limited bandwidth one after the
+        other, and any which would overflow its queue are dropped.
+        """
+        self.connect(LinkConditions(delay=1.0, bandwidth=100, queueSize=350))
+        for i in range(5):
+            self.a.transport.write('x' * 100)
+        self.clock.pump([0.5] * 20)
+        self.assertEqual([when for (when, d, a) in self.b.received],
+                         [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(self.link.forward.dropped, 1)
+
+
+    def test_stopListening(self):
+        """
+        Stopping one end of the link stops its protocol, and datagrams which
+        arrive afterwards are thrown away.
+        """
+        self.connect(LinkConditions(delay=1.0))
+        self.a.transport.write('hello')
+        d = self.link.b.stopListening()
+        self.assertTrue(self.b.stopped)
+        self.clock.advance(2)
+        self.assertEqual(self.b.received, [])
+        self.assertEqual(self.successResultOf(d), None)
+
+
+
+class BenchmarkTests(unittest.TestCase):
+    """
+    Tests for L{ptcpbench}.
+    """
+
+    def test_percentile(self):
+        """
+        L{ptcpbench.percentile} finds percentiles by the nearest rank method.
+        """
+        values = range(1, 101)
+        self.assertEqual(ptcpbench.percentile(values, 50), 50)
+        self.assertEqual(ptcpbench.percentile(values, 99), 99)
+        self.assertEqual(ptcpbench.percentile(values, 100), 100)
+        self.assertEqual(ptcpbench.percentile([3], 0), 3)
+
+
+    def test_run(self):
+        """
+        L{ptcpbench.run} sends all of the data over the emulated link, and
+        measures how long it took, without disturbing the real reactor.
+        """
+        reactor = ptcp.reactor
+        result = ptcpbench.run(
+            LinkConditions(delay=0.01, loss=0.01, bandwidth=1e6),
+            size=2 ** 16, chunkSize=2 ** 12)
+        self.assertIdentical(ptcp.reactor, reactor)
+        self.assertTrue(result.completed)
+        self.assertEqual(result.received, 2 ** 16)
+        self.assertEqual(len(result.latencies), 16)
+        self.assertTrue(result.duration >= 2 ** 16 / 1e6 + 0.01)
+        self.assertApproximates(result.goodput,
+                                result.received / result.duration, 1e-6)
+        self.assertTrue(0.01 <= result.latency(50) <= result.latency(99))
+        self.assertEqual(result.statistics.bytesSent,
+                         2 ** 16 + result.statistics.bytesRetransmitted)
+
+
+    def test_reproducible(self):
+        """
+        Runs with the same parameters see the same network, and take the same
+        virtual time.
+        """
+        conditions = LinkConditions(delay=0.01, jitter=0.005, loss=0.02)
+        one = ptcpbench.run(conditions, size=2 ** 15, seed=5)
+        two = ptcpbench.run(conditions, size=2 ** 15, seed=5)
+        self.assertEqual(one.duration, two.duration)
+        self.assertEqual(one.latencies, two.latencies)
+        self.assertEqual(one.link.forward.dropped, two.link.forward.dropped)
+
+
+    def test_rate(self):
+        """
+        Given a rate, the sender writes a chunk at a time, and the latency of
+        each chunk is about the time it takes to cross the link.
+        """
+        result = ptcpbench.run(LinkConditions(delay=0.05), size=2 ** 14,
+                               chunkSize=2 ** 10, rate=2 ** 12)
+        self.assertTrue(result.completed)
+        self.assertTrue(result.duration >= 3.75)
+        self.assertTrue(result.latency(90) < 0.5)
+
+
+    def test_timeout(self):
+        """
+        A run which cannot finish gives up after the timeout, and reports how
+        much arrived.
+        """
+        result = ptcpbench.run(LinkConditions(loss=1.0), size=2 ** 12,
+                               timeout=10)
+        self.assertFalse(result.completed)
+        self.assertEqual(result.received, 0)
+        self.assertEqual(result.goodput, 0)
+        self.assertIdentical(result.latency(50), None)
+
+
+    def test_options(self):
+        """
+        Without link conditions, every scenario runs; with any, only a custom
+        one does.
+        """
+        options = ptcpbench.Options()
+        options.parseOptions([])
+        self.assertEqual([name for (name, c) in options.scenarios],
+                         sorted(ptcpbench.scenarios))
+        options = ptcpbench.Options()
+        options.parseOptions(['--scenario', 'wan'])
+        self.assertEqual(options.scenarios,
+                         [('wan', ptcpbench.scenarios['wan'])])
+        options = ptcpbench.Options()
+        options.parseOptions(['--delay', '0.1', '--loss', '0.01'])
+        self.assertEqual(options.scenarios,
+                         [('custom', LinkConditions(delay=0.1, loss=0.01))])
+        self.assertRaises(usage.UsageError, ptcpbench.Options().parseOptions,
+                          ['--scenario', 'moon'])
+        self.assertRaises(usage.UsageError, ptcpbench.Options().parseOptions,
+                          ['--congestion', 'vegas'])
+
+
+    def test_main(self):
+        """
+        L{ptcpbench.main} writes a line for each scenario.
+        """
+        out = StringIO()
+        ptcpbench.main(['--size', '4096', '--delay', '0.01'], out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('custom'))
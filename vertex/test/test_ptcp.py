@@ -1,12 +1,17 @@
 # -*- test-case-name: vertex.test.test_ptcp -*-
 from __future__ import print_function
 
-import random, os
+import errno, random, os, socket, struct, binascii
 
-from twisted.internet import reactor, protocol, defer, error
+from zope.interface import implementer
+
+from twisted.internet import reactor, protocol, defer, error, task
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.python.monkey import MonkeyPatcher
 from twisted.trial import unittest
 
-from vertex import ptcp
+from vertex import ptcp, congestion, udpbatch
+from vertex.netemu import EmulatedLink, LinkConditions
 
 def reallyLossy(method):
     r = random.Random()
@@ -70,6 +75,19 @@ class Django(protocol.ClientFactory):
 class ConnectedPTCPMixin:
     serverPort = None
 
+    # A MonkeyPatcher for any timeouts which need to be shortened for the
+    # duration of the test.  Since connections keep timing out while they
+    # close, this is only restored once they have all closed, after the test
+    # case's cleanups have already run.
+    patcher = None
+
+    def listenUDP(self, proto):
+        """
+        Start a UDP port for a L{ptcp.PTCP}.
+        """
+        return reactor.listenUDP(0, proto)
+
+
     def setUpForATest(self,
                       ServerProtocol=TestProtocol, ClientProtocol=TestProtocol):
         serverProto = ServerProtocol()
@@ -85,14 +103,15 @@ class ConnectedPTCPMixin:
         cf = Django()
         cf.protocol = lambda: clientProto
 
-        serverTransport = ptcp.PTCP(sf)
-        clientTransport = ptcp.PTCP(None)
+        # Don't keep the tests waiting for connections to leave TIME-WAIT.
+        serverTransport = ptcp.PTCP(sf, timeWait=0)
+        clientTransport = ptcp.PTCP(None, timeWait=0)
 
         self.serverTransport = serverTransport
         self.clientTransport = clientTransport
 
-        serverPort = reactor.listenUDP(0, serverTransport)
-        clientPort = reactor.listenUDP(0, clientTransport)
+        serverPort = self.listenUDP(serverTransport)
+        clientPort = self.listenUDP(clientTransport)
 
         self.clientPort = clientPort
         self.serverPort = serverPort
@@ -110,6 +129,8 @@ class ConnectedPTCPMixin:
         for ptcpTransport in (self.serverTransport, self.clientTransport):
             td.append(ptcpTransport.waitForAllConnectionsToClose())
         d = defer.DeferredList(td)
+        if self.patcher is not None:
+            d.addBoth(lambda ignored: self.patcher.restore())
         return d
 
 
@@ -150,12 +171,16 @@ class PTCPTransportTestCase(ConnectedPTCPMixin, unittest.TestCase):
         I have no idea why one of these values is divided by 10 and the
         other is multiplied by 10.  -exarkun
         """
-        self.patch(
-            ptcp.PTCPConnection, '_retransmitTimeout',
-            ptcp.PTCPConnection._retransmitTimeout / 10)
-        self.patch(
-            ptcp.PTCPPacket, 'retransmitCount',
-            ptcp.PTCPPacket.retransmitCount * 10)
+        self.patcher = MonkeyPatcher(
+            (ptcp.PTCPConnection, '_retransmitTimeout',
+             ptcp.PTCPConnection._retransmitTimeout / 10),
+            (ptcp.PTCPConnection, '_minRetransmitTimeout',
+             ptcp.PTCPConnection._minRetransmitTimeout / 10),
+            (ptcp.PTCPConnection, '_maxRetransmitTimeout',
+             ptcp.PTCPConnection._retransmitTimeout / 10 * 4),
+            (ptcp.PTCPPacket, 'retransmitCount',
+             ptcp.PTCPPacket.retransmitCount * 10))
+        self.patcher.patch()
 
 
     def xtestWhoAmI(self):
@@ -290,7 +315,7 @@ class PTCPTransportTestCase(ConnectedPTCPMixin, unittest.TestCase):
             # The server must write enough to completely fill the outgoing buffer,
             # since our peer isn't ACKing /anything/ and our server waits for
             # writes to be acked before proceeding.
-            serverProto.WRITE_SIZE = serverProto.transport.sendWindow * 5
+            serverProto.WRITE_SIZE = serverProto.transport.mtu * 5
 
             # print 'Connected'
             # print 'PAUSING CLIENT PROTO', clientProto, clientTransport, clientPort
@@ -320,14 +345,24 @@ class SmallMTUTransportTestCase(PTCPTransportTestCase):
 
 
 
+class BatchedTransportTestCase(PTCPTransportTestCase):
+    def listenUDP(self, proto):
+        return udpbatch.listenUDP(0, proto)
+
+
+
 class TimeoutTestCase(ConnectedPTCPMixin, unittest.TestCase):
     def setUp(self):
         """
-        Shorten the retransmit timeout so that tests finish more quickly.
+        Shorten the retransmit timeout, and keep it from backing off very
+        far, so that tests finish more quickly.
         """
-        self.patch(
-            ptcp.PTCPConnection, '_retransmitTimeout',
-            ptcp.PTCPConnection._retransmitTimeout / 10)
+        self.patcher = MonkeyPatcher(
+            (ptcp.PTCPConnection, '_retransmitTimeout',
+             ptcp.PTCPConnection._retransmitTimeout / 10),
+            (ptcp.PTCPConnection, '_maxRetransmitTimeout',
+             ptcp.PTCPConnection._retransmitTimeout / 10 * 2))
+        self.patcher.patch()
 
 
     def testConnectTimeout(self):
@@ -362,3 +397,2691 @@ class TimeoutTestCase(ConnectedPTCPMixin, unittest.TestCase):
         d = defer.DeferredList([serverProto.onConnect, clientProto.onConnect])
         d.addCallback(cbConnected)
         return d
+
+
+
+class FakePTCP(object):
+    """
+    A stand-in for L{ptcp.PTCP} which records the packets sent by its
+    connections instead of putting them on the network.
+
+    @ivar sent: the packets sent and not yet taken by L{take}.
+    @type sent: L{list} of L{ptcp.PTCPPacket}
+    """
+
+    def __init__(self, congestionControl=congestion.NewReno, sack=True,
+                 pathMTUDiscovery=False, pacing=False, maxPacingRate=None,
+                 timeWait=60.0, keepAlive=None, headerChecksums=True):
+        self.congestionControl = congestionControl
+        self.sack = sack
+        self.pathMTUDiscovery = pathMTUDiscovery
+        self.pacing = pacing
+        self.maxPacingRate = maxPacingRate
+        self.timeWait = timeWait
+        self.keepAlive = keepAlive
+        self.keepAliveInterval = 5.0
+        self.keepAliveProbes = 5
+        self.headerChecksums = headerChecksums
+        self.checksums = True
+        self.pathMTUs = {}
+        self.timers = ptcp._TimerWheel()
+        self.tracer = None
+        self.sent = []
+        self.closed = []
+
+
+    def sendPacket(self, packet):
+        """
+        Record a packet rather than sending it.
+        """
+        self.sent.append(packet)
+
+
+    def connectionClosed(self, connection):
+        """
+        Record that a connection released its resources.
+        """
+        self.closed.append(connection)
+
+
+    def take(self):
+        """
+        Return and forget the packets sent so far.
+        """
+        sent, self.sent = self.sent, []
+        return sent
+
+
+
+class AccumulatingProtocol(protocol.Protocol):
+    """
+    A protocol which remembers all the bytes delivered to it.
+    """
+
+    def __init__(self):
+        self.received = []
+        self.lost = False
+        self.reason = None
+
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+
+    def connectionLost(self, reason):
+        self.lost = True
+        self.reason = reason
+
+
+
+@implementer(IHalfCloseableProtocol)
+class HalfCloseableProtocol(AccumulatingProtocol):
+    """
+    An L{AccumulatingProtocol} which carries on after its peer has finished
+    sending.
+    """
+
+    readLost = False
+    writeLost = False
+
+    def readConnectionLost(self):
+        self.readLost = True
+
+
+    def writeConnectionLost(self):
+        self.writeLost = True
+
+
+
+class ConnectionPair(object):
+    """
+    Two L{ptcp.PTCPConnection}s talking to each other through L{FakePTCP}s,
+    on a L{task.Clock}, so that tests can control exactly which packets
+    arrive, and when.
+
+    @ivar client: the connection which actively opened.
+    @ivar server: the connection which passively opened.
+    @ivar maxPacketSize: if not L{None}, L{pump} throws away any packet whose
+        encoding is larger than this, as a path with a small MTU would.
+
+    The initial sequence numbers of the connections are random unless
+    C{clientISN} and C{serverISN} are given.
+    """
+
+    clientAddress = ('10.0.0.1', 1234)
+    serverAddress = ('10.0.0.2', 5678)
+
+    def __init__(self, testCase, congestionControl=congestion.NewReno,
+                 clientSack=True, serverSack=True, pathMTUDiscovery=False,
+                 maxPacketSize=None, clientISN=None, serverISN=None,
+                 protocolFactory=AccumulatingProtocol,
+                 clientHeaderChecksums=True, serverHeaderChecksums=True):
+        self.clock = task.Clock()
+        self.maxPacketSize = maxPacketSize
+        testCase.patch(ptcp, 'reactor', self.clock)
+        self.clientPTCP = FakePTCP(congestionControl, clientSack,
+                                   pathMTUDiscovery,
+                                   headerChecksums=clientHeaderChecksums)
+        self.serverPTCP = FakePTCP(congestionControl, serverSack,
+                                   pathMTUDiscovery,
+                                   headerChecksums=serverHeaderChecksums)
+        self.clientProtocol = protocolFactory()
+        self.serverProtocol = protocolFactory()
+        clientFactory = protocol.ClientFactory()
+        clientFactory.protocol = lambda: self.clientProtocol
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = lambda: self.serverProtocol
+        self.client = ptcp.PTCPConnection(
+            8, 1, self.clientPTCP, clientFactory, self.serverAddress)
+        self.server = ptcp.PTCPConnection(
+            1, 8, self.serverPTCP, serverFactory, None)
+        if clientISN is not None:
+            self.client.hostSendISN = clientISN
+        if serverISN is not None:
+            self.server.hostSendISN = serverISN
+        self.server.machine.appPassiveOpen()
+        self.client.machine.appActiveOpen()
+        self.pump()
+
+
+    def deliver(self, packets, connection):
+        """
+        Deliver some packets, sent by the other connection, to the given
+        connection, encoding and decoding them as if they went over the wire.
+        """
+        if connection is self.client:
+            source = self.serverAddress
+        else:
+            source = self.clientAddress
+        for packet in packets:
+            connection.packetReceived(
+                ptcp.PTCPPacket.decode(packet.encode(), source))
+
+
+    def pump(self):
+        """
+        Deliver packets back and forth, running any imminent timers, until
+        neither side has anything more to send.
+        """
+        while True:
+            self.clock.advance(ptcp.SEND_DELAY)
+            fromClient = self.clientPTCP.take()
+            fromServer = self.serverPTCP.take()
+            if not (fromClient or fromServer):
+                return
+            if self.maxPacketSize is not None:
+                fits = lambda p: len(p.encode()) <= self.maxPacketSize
+                fromClient = filter(fits, fromClient)
+                fromServer = filter(fits, fromServer)
+            self.deliver(fromClient, self.server)
+            self.deliver(fromServer, self.client)
+
+
+
+class CongestionControlTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} drives its congestion
+    controller.
+    """
+
+    def test_established(self):
+        """
+        L{ConnectionPair} sets up a connection with a congestion controller
+        of the type specified by the L{ptcp.PTCP} it belongs to.
+        """
+        pair = ConnectionPair(self, congestion.Cubic)
+        self.assertIsInstance(pair.client.congestion, congestion.Cubic)
+        self.assertIdentical(pair.client.protocol, pair.clientProtocol)
+        self.assertIdentical(pair.server.protocol, pair.serverProtocol)
+
+
+    def test_initialWindow(self):
+        """
+        A new connection sends as many full segments as its initial congestion
+        window allows, then stops and pauses its producer.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.write('x' * (client.mtu * 10))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual(
+            len(sent), congestion.initialWindow(client.mtu) // client.mtu)
+        self.assertEqual(client.sendWindowRemaining, 0)
+
+
+    def test_slowStart(self):
+        """
+        Each acknowledgement received in slow start allows more data to be
+        sent.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        before = client.congestion.cwnd
+        client.write('x' * (client.mtu * 4))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        pair.deliver(pair.clientPTCP.take(), pair.server)
+        pair.clock.advance(0.1)
+        pair.deliver(pair.serverPTCP.take(), client)
+        self.assertTrue(client.congestion.cwnd > before)
+        self.assertEqual(list(client.retransmissionQueue), [])
+        self.assertEqual(client._pipe, 0)
+
+
+    def test_fastRetransmit(self):
+        """
+        When a segment is lost, the segments after it cause the peer to send
+        duplicate acknowledgements; the third one makes the sender retransmit
+        the missing segment immediately and reduce its congestion window.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.write('x' * (client.mtu * 4))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual(len(sent), 4)
+        pair.deliver(sent[1:], pair.server)
+        duplicates = pair.serverPTCP.take()
+        self.assertEqual(len(duplicates), 3)
+        self.assertEqual(set(p.ackNum for p in duplicates),
+                         set([sent[0].seqNum]))
+
+        pair.deliver(duplicates[:2], client)
+        self.assertEqual(pair.clientPTCP.take(), [])
+        pair.deliver(duplicates[2:], client)
+        [retransmitted] = pair.clientPTCP.take()
+        self.assertEqual(retransmitted.seqNum, sent[0].seqNum)
+        self.assertTrue(client._inRecovery)
+        self.assertEqual(client.congestion.ssthresh, 2 * client.mtu)
+
+
+    def test_retransmissionTimeout(self):
+        """
+        When nothing is acknowledged for a whole retransmission timeout, the
+        congestion window collapses to one segment and only the oldest
+        segment is retransmitted.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.write('x' * (client.mtu * 4))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        pair.clock.advance(client._retransmitTimeout)
+        [retransmitted] = pair.clientPTCP.take()
+        self.assertEqual(retransmitted.seqNum, sent[0].seqNum)
+        self.assertEqual(client.congestion.cwnd, client.mtu)
+
+
+    def test_goBackAfterTimeout(self):
+        """
+        After a retransmission timeout, acknowledgements of the retransmitted
+        segment clock out retransmissions of the rest of the lost segments.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.write('x' * (client.mtu * 4))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        pair.clientPTCP.take()
+        pair.clock.advance(client._retransmitTimeout)
+        pair.pump()
+        pair.clock.advance(1)
+        pair.pump()
+        # The last segment is acknowledged only once the delayed
+        # acknowledgement timer expires.
+        pair.clock.advance(ptcp.ACK_DELAY)
+        pair.pump()
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         'x' * (client.mtu * 4))
+        self.assertEqual(list(client.retransmissionQueue), [])
+
+
+
+class RetransmitTimeoutTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} estimates the round trip time to
+    its peer and uses that to compute its retransmission timeout.
+    """
+
+    def sendOneSegment(self, pair, roundTrip):
+        """
+        Send a segment from the client to the server, and deliver its
+        acknowledgement after C{roundTrip} seconds, without letting the
+        segment be retransmitted in the meantime.
+
+        @return: the segment which was sent.
+        """
+        pair.client.write('x' * pair.client.mtu)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        [sent] = pair.clientPTCP.take()
+        pair.client._cancelRetransmitTimer()
+        pair.deliver([sent], pair.server)
+        pair.clock.advance(roundTrip)
+        pair.deliver(pair.serverPTCP.take(), pair.client)
+        return sent
+
+
+    def test_firstMeasurement(self):
+        """
+        The first acknowledgement of a segment which was sent only once sets
+        the smoothed round trip time to the time it took, and its variation to
+        half that.
+        """
+        pair = ConnectionPair(self)
+        pair.client.smoothedRTT = pair.client.rttVariation = None
+        self.sendOneSegment(pair, 2.0)
+        self.assertApproximates(pair.client.smoothedRTT, 2.0, 0.01)
+        self.assertApproximates(pair.client.rttVariation, 1.0, 0.01)
+        self.assertApproximates(pair.client._retransmitTimeout, 6.0, 0.05)
+
+
+    def test_smoothing(self):
+        """
+        Later measurements move the estimate towards the measured value by an
+        eighth of the difference, and the variation by a quarter.
+        """
+        pair = ConnectionPair(self)
+        pair.client.smoothedRTT = 1.0
+        pair.client.rttVariation = 0.5
+        self.sendOneSegment(pair, 2.0)
+        self.assertApproximates(pair.client.smoothedRTT, 1.125, 0.01)
+        self.assertApproximates(pair.client.rttVariation, 0.625, 0.01)
+        self.assertApproximates(pair.client._retransmitTimeout, 3.625, 0.05)
+
+
+    def test_minimum(self):
+        """
+        Very short round trip times, such as those on a local network, result
+        in the minimum retransmission timeout.
+        """
+        pair = ConnectionPair(self)
+        self.sendOneSegment(pair, 0.001)
+        self.assertEqual(pair.client._retransmitTimeout,
+                         pair.client._minRetransmitTimeout)
+
+
+    def test_timerUsesEstimate(self):
+        """
+        A segment is retransmitted once the computed timeout has passed, not
+        before.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client._retransmitTimeout = 3.0
+        client.write('x')
+        pair.clock.advance(ptcp.SEND_DELAY)
+        [sent] = pair.clientPTCP.take()
+        pair.clock.advance(2.9)
+        self.assertEqual(pair.clientPTCP.take(), [])
+        pair.clock.advance(0.1)
+        [retransmitted] = pair.clientPTCP.take()
+        self.assertEqual(retransmitted.seqNum, sent.seqNum)
+
+
+    def test_backoff(self):
+        """
+        Each time the retransmission timer expires, the time until it next
+        expires doubles, up to a maximum.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client._retransmitTimeout = 1.0
+        self.patch(client, '_maxRetransmitTimeout', 4.0)
+        client.write('x')
+        pair.clock.advance(ptcp.SEND_DELAY)
+        pair.clientPTCP.take()
+        sentAt = [pair.clock.seconds()]
+        for i in range(1200):
+            pair.clock.advance(0.01)
+            for packet in pair.clientPTCP.take():
+                sentAt.append(packet.sentAt)
+        intervals = [round(later - earlier, 1)
+                     for (earlier, later) in zip(sentAt, sentAt[1:])]
+        self.assertEqual(intervals, [1.0, 2.0, 4.0, 4.0])
+        self.assertEqual(client._retransmitTimeout, 1.0)
+
+
+    def test_karn(self):
+        """
+        The acknowledgement of a retransmitted segment does not change the
+        round trip time estimate, but it does stop the timer backing off.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.smoothedRTT = 0.1
+        client.rttVariation = 0.05
+        client._retransmitTimeout = 1.0
+        client.write('x')
+        pair.clock.advance(ptcp.SEND_DELAY)
+        pair.clientPTCP.take()
+        pair.clock.advance(1.0)
+        [retransmitted] = pair.clientPTCP.take()
+        self.assertEqual(client._backoff, 1)
+        pair.deliver([retransmitted], pair.server)
+        pair.clock.advance(0.5)
+        pair.deliver(pair.serverPTCP.take(), client)
+        self.assertEqual(list(client.retransmissionQueue), [])
+        self.assertEqual(client.smoothedRTT, 0.1)
+        self.assertEqual(client.rttVariation, 0.05)
+        self.assertEqual(client._retransmitTimeout, 1.0)
+        self.assertEqual(client._backoff, 0)
+
+
+
+class ReassemblyTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} holds on to segments which arrive
+    out of order.
+    """
+
+    def sendSegments(self, pair, count):
+        """
+        Have the client send some full segments, each containing a different
+        letter.
+
+        @return: the segments, as they were sent.
+        """
+        client = pair.client
+        client.write(''.join(chr(ord('a') + i) * client.mtu
+                             for i in range(count)))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual(len(sent), count)
+        return sent
+
+
+    def test_deliverContiguousRun(self):
+        """
+        Segments which arrive after a gap are not delivered to the
+        application, but once the gap is filled they are all delivered
+        together in a single call, and acknowledged immediately.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 4)
+        pair.deliver([sent[3], sent[1], sent[2]], pair.server)
+        self.assertEqual(pair.serverProtocol.received, [])
+        self.assertEqual(len(pair.server._reassemblyQueue), 3)
+        pair.serverPTCP.take()
+
+        pair.deliver([sent[0]], pair.server)
+        self.assertEqual(pair.serverProtocol.received,
+                         [''.join(p.data for p in sent)])
+        self.assertEqual(len(pair.server._reassemblyQueue), 0)
+        [ack] = pair.serverPTCP.take()
+        self.assertEqual(ack.ackNum,
+                         (sent[3].seqNum + sent[3].dlen) % (2**32))
+
+
+    def test_partialRun(self):
+        """
+        When a gap is filled, only the segments contiguous with it are
+        delivered; those after a further gap stay in the queue.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 4)
+        pair.deliver([sent[1], sent[3]], pair.server)
+        pair.deliver([sent[0]], pair.server)
+        self.assertEqual(pair.serverProtocol.received,
+                         [sent[0].data + sent[1].data])
+        self.assertEqual(len(pair.server._reassemblyQueue), 1)
+        pair.deliver([sent[2]], pair.server)
+        self.assertEqual(pair.serverProtocol.received[1:],
+                         [sent[2].data + sent[3].data])
+
+
+    def test_duplicates(self):
+        """
+        A segment which arrives more than once while it is being held is only
+        held, and delivered, once.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 2)
+        pair.deliver([sent[1], sent[1]], pair.server)
+        self.assertEqual(len(pair.server._reassemblyQueue), 1)
+        pair.deliver([sent[0], sent[1]], pair.server)
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         sent[0].data + sent[1].data)
+
+
+    def test_finAfterGap(self):
+        """
+        A FIN which arrives before the data preceding it is not processed
+        until that data has been delivered.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 2)
+        pair.client.loseConnection()
+        pair.clock.advance(ptcp.SEND_DELAY)
+        [fin] = pair.clientPTCP.take()
+        self.assertTrue(fin.fin)
+        pair.deliver([fin, sent[1]], pair.server)
+        self.assertIdentical(pair.server._closeWaitLoseConnection, None)
+        pair.deliver([sent[0]], pair.server)
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         sent[0].data + sent[1].data)
+        self.assertNotIdentical(pair.server._closeWaitLoseConnection, None)
+
+
+
+class ReassemblyQueueTests(unittest.TestCase):
+    """
+    Tests for L{ptcp._ReassemblyQueue}.
+    """
+
+    def segment(self, seq, data):
+        return ptcp.PTCPPacket.create(1, 2, seq, 0, data)
+
+
+    def test_popInOrder(self):
+        """
+        Segments come out of the queue in sequence order, regardless of the
+        order they went in, and only once the stream has reached them.
+        """
+        queue = ptcp._ReassemblyQueue(100)
+        queue.insert(self.segment(20, 'c' * 10))
+        queue.insert(self.segment(10, 'b' * 10))
+        self.assertIdentical(queue.pop(5), None)
+        self.assertEqual(queue.pop(10).data, 'b' * 10)
+        self.assertEqual(queue.pop(20).data, 'c' * 10)
+        self.assertIdentical(queue.pop(30), None)
+        self.assertEqual(queue.size, 0)
+
+
+    def test_discardObsolete(self):
+        """
+        Segments which lie entirely before the next sequence number expected
+        are thrown away rather than returned.
+        """
+        queue = ptcp._ReassemblyQueue(100)
+        queue.insert(self.segment(10, 'b' * 10))
+        queue.insert(self.segment(20, 'c' * 10))
+        self.assertEqual(queue.pop(25).data, 'c' * 10)
+        self.assertEqual(len(queue), 0)
+
+
+    def test_limit(self):
+        """
+        Segments which would take the amount of data held over the limit are
+        refused.
+        """
+        queue = ptcp._ReassemblyQueue(15)
+        self.assertTrue(queue.insert(self.segment(10, 'b' * 10)))
+        self.assertFalse(queue.insert(self.segment(20, 'c' * 10)))
+        self.assertEqual(queue.size, 10)
+        self.assertEqual(len(queue), 1)
+
+
+
+class SequenceNumberTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} numbers the octets it sends,
+    from a random starting point and on past 2**32.
+    """
+
+    def test_sequenceLap(self):
+        """
+        L{ptcp.sequenceLap} finds the lap which puts a wire sequence number
+        nearest to the relative sequence number given.
+        """
+        isn = 2**32 - 100
+        self.assertEqual(ptcp.sequenceLap(isn + 50, isn, 0), 0)
+        self.assertEqual(ptcp.sequenceLap(50, isn, 100), 1)
+        self.assertEqual(ptcp.sequenceLap(2**32 - 10, isn, 100), 0)
+        self.assertEqual(ptcp.sequenceLap(10, 0, 2**32 * 3 - 10), 3)
+        self.assertEqual(ptcp.sequenceLap(2**32 - 10, 0, 2**32 * 3), 2)
+        for wire in [0, 50, isn, 2**32 - 1]:
+            lap = ptcp.sequenceLap(wire, isn, 2**33)
+            self.assertTrue(
+                abs(ptcp.relativeSequence(wire, isn, lap) - 2**33) <= 2**31)
+
+
+    def test_randomISN(self):
+        """
+        Each connection starts its sequence numbers somewhere different.
+        """
+        isns = set(ptcp.ISN() for i in range(10))
+        self.assertEqual(len(isns), 10)
+        for isn in isns:
+            self.assertTrue(0 <= isn < 2**32)
+        pair = ConnectionPair(self)
+        self.assertNotEqual(pair.client.hostSendISN, pair.server.hostSendISN)
+
+
+    def talk(self, pair, seconds):
+        for i in range(int(seconds / 0.1)):
+            pair.pump()
+            pair.clock.advance(0.1)
+
+
+    def test_wraparound(self):
+        """
+        Data flows both ways across the point at which sequence numbers wrap
+        around 2**32.
+        """
+        pair = ConnectionPair(self, clientISN=2**32 - 5000,
+                              serverISN=2**32 - 1)
+        toServer = ''.join(chr(ord('a') + i % 26) * 1000 for i in range(50))
+        toClient = 'x' * 3000
+        pair.client.write(toServer)
+        pair.server.write(toClient)
+        self.talk(pair, 5)
+        self.assertEqual(''.join(pair.serverProtocol.received), toServer)
+        self.assertEqual(''.join(pair.clientProtocol.received), toClient)
+        self.assertEqual(pair.client.nextSendSeqNum, len(toServer) + 1)
+        self.assertEqual(list(pair.client.retransmissionQueue), [])
+
+
+    def test_lossAcrossWraparound(self):
+        """
+        Segments lost on either side of the wraparound point are found by
+        selective acknowledgements, and retransmitted.
+        """
+        pair = ConnectionPair(self, clientISN=2**32 - 2000)
+        client = pair.client
+        client.congestion.cwnd = client.mtu * 8
+        data = ''.join(chr(ord('a') + i) * client.mtu for i in range(8))
+        client.write(data)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual(len(sent), 8)
+        self.assertTrue(sent[0].seqNum > sent[-1].seqNum)
+        pair.deliver([sent[i] for i in [1, 3, 4, 5, 6, 7]], pair.server)
+        pair.deliver(pair.serverPTCP.take(), client)
+        self.assertEqual([p.sacked for p in client.retransmissionQueue],
+                         [False, True, False, True, True, True, True, True])
+        self.talk(pair, 5)
+        self.assertEqual(''.join(pair.serverProtocol.received), data)
+
+
+    def test_fragmentAcrossWraparound(self):
+        """
+        A segment split up across the wraparound point is split into segments
+        whose wire sequence numbers wrap, and whose relative ones do not.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 2**32 - 5, 0, 'x' * 20)
+        packet.seqOffset = 2**32 - 100
+        fragments = packet.fragment(10)
+        self.assertEqual([p.seqNum for p in fragments], [2**32 - 5, 5])
+        self.assertEqual([p.relativeSeq() for p in fragments], [95, 105])
+
+
+
+class RetransmissionQueueTests(unittest.TestCase):
+    """
+    Tests for L{ptcp._RetransmissionQueue}.
+    """
+
+    def fill(self, count, size=10):
+        """
+        Make a queue of segments of the given size, from sequence number 0.
+        """
+        queue = ptcp._RetransmissionQueue()
+        for i in range(count):
+            queue.append(i * size, ptcp.PTCPPacket.create(
+                    1, 2, i * size, 0, str(i % 10) * size))
+        return queue
+
+
+    def test_trim(self):
+        """
+        A cumulative acknowledgement removes the segments it covers entirely,
+        and no others.
+        """
+        queue = self.fill(3)
+        acked = queue.trim(25)
+        self.assertEqual([packet.data for packet in acked], ['0' * 10,
+                                                             '1' * 10])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue[0].data, '2' * 10)
+        self.assertIdentical(queue[-1], queue[0])
+        self.assertEqual(queue.trim(25), [])
+        self.assertRaises(IndexError, lambda: queue[1])
+
+
+    def test_compact(self):
+        """
+        Once most of the queue has been trimmed, the rest of it can still be
+        found, walked and trimmed.
+        """
+        queue = self.fill(300)
+        queue.trim(2000)
+        self.assertEqual(len(queue), 100)
+        self.assertEqual(queue[0].seqNum, 2000)
+        self.assertEqual(queue.covered(2500, 2520)[0].seqNum, 2500)
+        self.assertEqual([packet.seqNum for packet in queue],
+                         range(2000, 3000, 10))
+        queue.trim(3000)
+        self.assertEqual(list(queue), [])
+
+
+    def test_covered(self):
+        """
+        L{ptcp._RetransmissionQueue.covered} finds the segments lying wholly
+        within a range of sequence numbers.
+        """
+        queue = self.fill(10)
+        self.assertEqual(
+            [packet.seqNum for packet in queue.covered(20, 55)], [20, 30, 40])
+        self.assertEqual(queue.covered(21, 30), [])
+        self.assertEqual(queue.covered(200, 300), [])
+
+
+    def test_segmentAt(self):
+        """
+        L{ptcp._RetransmissionQueue.segmentAt} finds the segment starting at
+        a sequence number, if it is still queued.
+        """
+        queue = self.fill(5)
+        self.assertIdentical(queue.segmentAt(30), queue[3])
+        self.assertIdentical(queue.segmentAt(35), None)
+        self.assertIdentical(queue.segmentAt(50), None)
+        queue.trim(20)
+        self.assertIdentical(queue.segmentAt(10), None)
+        self.assertIdentical(queue.segmentAt(20), queue[0])
+
+
+    def test_fragment(self):
+        """
+        A segment split into smaller ones is replaced by them in the queue,
+        and they inherit its state.
+        """
+        queue = self.fill(3)
+        queue[1].lost = True
+        queue[1].sendIndex = 7
+        fragments = queue.fragment(10, 4)
+        self.assertEqual([packet.data for packet in fragments],
+                         ['1111', '1111', '11'])
+        self.assertEqual([packet.seqNum for packet in queue],
+                         [0, 10, 14, 18, 20])
+        for packet in fragments:
+            self.assertTrue(packet.lost)
+            self.assertEqual(packet.sendIndex, 7)
+        self.assertEqual(queue.covered(14, 20), fragments[1:])
+
+
+
+class PacketTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCPPacket}.
+    """
+
+    def test_roundTrip(self):
+        """
+        A packet survives encoding and decoding, with its header fields,
+        flags and data intact.
+        """
+        packet = ptcp.PTCPPacket.create(
+            1, 2, 2 ** 32 - 1, 200, 'hello', window=1234, ack=True, fin=True)
+        bytes = packet.encode()
+        self.assertEqual(len(bytes), ptcp._fixedSize + 5)
+        decoded = ptcp.PTCPPacket.decode(bytes, ('127.0.0.1', 1))
+        decoded.verifyChecksum()
+        self.assertEqual(
+            (decoded.sourcePseudoPort, decoded.destPseudoPort,
+             decoded.seqNum, decoded.ackNum, decoded.window,
+             decoded.niceflags, decoded.dlen, decoded.data,
+             decoded.peerAddressTuple),
+            (1, 2, 2 ** 32 - 1, 200, 1234, '.AF.....', 5, 'hello',
+             ('127.0.0.1', 1)))
+        self.assertEqual(decoded.encode(), bytes)
+
+
+    def test_slots(self):
+        """
+        Packets have no instance dictionary.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 0, 0, 'x')
+        self.assertFalse(hasattr(packet, '__dict__'))
+        self.assertRaises(AttributeError, setattr, packet, 'bogus', 1)
+
+
+    def recordChecksums(self):
+        """
+        Record the strings L{ptcp.crc32} is called on.
+        """
+        calls = []
+        original = ptcp.crc32
+        def crc32(data, *a):
+            calls.append(data)
+            return original(data, *a)
+        self.patch(ptcp, 'crc32', crc32)
+        return calls
+
+
+    def test_checksumComputedOnce(self):
+        """
+        The checksum of a packet's payload is computed the first time it is
+        encoded and reused after that; only the header, which may change
+        before a retransmission, is checksummed again.
+        """
+        packet = ptcp.PTCPPacket.create(
+            1, 2, 0, 0, 'x' * 100, sackBlocks=[(1, 2)], hcrc=True)
+        calls = self.recordChecksums()
+        first = packet.encode()
+        self.assertEqual([len(data) for data in calls],
+                         [len(packet.encodedOptions()), 100,
+                          ptcp._fixedSize])
+        del calls[:]
+        packet.ackNum = 5
+        second = packet.encode()
+        self.assertEqual([len(data) for data in calls], [ptcp._fixedSize])
+        self.assertNotEqual(first[:ptcp._fixedSize],
+                            second[:ptcp._fixedSize])
+        ptcp.PTCPPacket.decode(second, ('127.0.0.1', 1)).verifyChecksum()
+
+
+    def test_legacyChecksum(self):
+        """
+        Without the HCRC flag, the checksum covers only the payload, and is
+        the same on the wire as the signed one earlier versions sent.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 200, 'hello', ack=True)
+        bytes = packet.encode()
+        self.assertIn(struct.pack('!l', binascii.crc32('hello')), bytes)
+        corrupt = ptcp.PTCPPacket.decode(
+            bytes.replace('\x00\x00\x00\xc8', '\x00\x00\x00\xc9'),
+            ('127.0.0.1', 1))
+        self.assertEqual(corrupt.ackNum, 201)
+        corrupt.verifyChecksum()
+
+
+    def test_headerChecksum(self):
+        """
+        With the HCRC flag, the checksum covers the header as well as the
+        payload.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 200, 'hello', ack=True,
+                                        hcrc=True)
+        bytes = packet.encode()
+        ptcp.PTCPPacket.decode(bytes, ('127.0.0.1', 1)).verifyChecksum()
+        corrupt = ptcp.PTCPPacket.decode(
+            bytes.replace('\x00\x00\x00\xc8', '\x00\x00\x00\xc9'),
+            ('127.0.0.1', 1))
+        self.assertEqual(corrupt.ackNum, 201)
+        self.assertRaises(ptcp.ChecksumMismatchError, corrupt.verifyChecksum)
+
+
+    def test_synChecksum(self):
+        """
+        On a SYN, the HCRC flag only offers header checksums; the SYN itself
+        carries the sort of checksum any peer can check.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 0, '', syn=True,
+                                        hcrc=True)
+        decoded = ptcp.PTCPPacket.decode(packet.encode(), ('127.0.0.1', 1))
+        self.assertTrue(decoded.hcrc)
+        self.assertEqual(decoded.checksum, 0)
+        decoded.verifyChecksum()
+
+
+    def test_omittedChecksum(self):
+        """
+        A packet with header checksums may leave its checksum out, as a zero,
+        and is accepted without one; a checksum which comes out as zero is
+        sent as all ones instead.  Packets without header checksums always
+        carry one.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 200, 'hello', ack=True,
+                                        hcrc=True)
+        calls = self.recordChecksums()
+        decoded = ptcp.PTCPPacket.decode(packet.encode(checksum=False),
+                                         ('127.0.0.1', 1))
+        self.assertEqual(calls, [])
+        self.assertEqual(decoded.checksum, 0)
+        decoded.verifyChecksum()
+        packet.hcrc = False
+        decoded = ptcp.PTCPPacket.decode(packet.encode(checksum=False),
+                                         ('127.0.0.1', 1))
+        self.assertEqual(decoded.checksum,
+                         binascii.crc32('hello') & 0xffffffff)
+        self.patch(ptcp, 'crc32', lambda data, value=0: 0)
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 200, 'hello', ack=True,
+                                        hcrc=True)
+        decoded = ptcp.PTCPPacket.decode(packet.encode(), ('127.0.0.1', 1))
+        self.assertEqual(decoded.checksum, 0xffffffff)
+        decoded.verifyChecksum()
+
+
+    def test_retransmitsLeft(self):
+        """
+        Each packet starts with L{ptcp.PTCPPacket.retransmitCount} attempts.
+        """
+        self.patch(ptcp.PTCPPacket, 'retransmitCount', 3)
+        packet = ptcp.PTCPPacket.create(1, 2, 0, 0, 'x')
+        self.assertEqual(packet.retransmitsLeft, 3)
+        self.assertIn('retransmitsLeft=3', repr(packet))
+
+
+
+class HeaderChecksumTests(unittest.TestCase):
+    """
+    Tests for negotiating checksums which cover packet headers, and for
+    leaving checksums out.
+    """
+
+    def test_negotiated(self):
+        """
+        Header checksums are used if both ends offer them.
+        """
+        pair = ConnectionPair(self)
+        self.assertTrue(pair.client.headerChecksums)
+        self.assertTrue(pair.server.headerChecksums)
+        pair.client.write('hello')
+        pair.clock.advance(ptcp.SEND_DELAY)
+        [packet] = pair.clientPTCP.take()
+        self.assertTrue(packet.hcrc)
+
+
+    def test_notNegotiated(self):
+        """
+        Header checksums are not used if either end does not offer them, as
+        a peer which predates them does not.
+        """
+        for client, server in [(True, False), (False, True)]:
+            pair = ConnectionPair(self, clientHeaderChecksums=client,
+                                  serverHeaderChecksums=server)
+            self.assertFalse(pair.client.headerChecksums)
+            self.assertFalse(pair.server.headerChecksums)
+            pair.client.write('hello')
+            pair.clock.advance(ptcp.SEND_DELAY)
+            [packet] = pair.clientPTCP.take()
+            self.assertFalse(packet.hcrc)
+
+
+    def test_withoutChecksums(self):
+        """
+        Ports which do not use checksums leave them out of the packets they
+        send, and deliver data all the same; a port which does use them
+        accepts those packets, but throws away ones with corrupt headers.
+        """
+        clock = task.Clock()
+        self.patch(ptcp, 'reactor', clock)
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = AccumulatingProtocol
+        client = ptcp.PTCP(serverFactory, checksums=False)
+        server = ptcp.PTCP(serverFactory)
+        link = EmulatedLink(clock)
+        link.connect(client, server)
+        sent = []
+        def tracer(conn, event, packet):
+            if event == 'send':
+                sent.append(packet)
+        client.tracer = tracer
+        factory = protocol.ClientFactory()
+        factory.protocol = AccumulatingProtocol
+        conn = client.connect(factory, *EmulatedLink.addressB)
+        clock.pump([0.01] * 10)
+        conn.write('hello')
+        clock.pump([0.01] * 10)
+        [serverConn] = server._connections.values()
+        self.assertEqual(serverConn.protocol.received, ['hello'])
+        [syn] = [packet for packet in sent if packet.syn]
+        self.assertEqual(syn.checksum, 0)
+        self.assertTrue([packet for packet in sent if packet.dlen])
+        self.assertEqual([packet.checksum for packet in sent
+                          if not packet.syn], [0] * (len(sent) - 1))
+
+        packet = ptcp.PTCPPacket.create(
+            conn.hostPseudoPort, 1,
+            (conn.nextSendSeqNum + conn.hostSendISN) % (2 ** 32),
+            conn.currentAckNum(), 'world', window=1000, ack=True, hcrc=True)
+        bytes = packet.encode()
+        window = struct.pack('!L', 1000)
+        server.datagramReceived(bytes.replace(window, struct.pack('!L', 1001)),
+                                EmulatedLink.addressA)
+        self.assertEqual(serverConn.protocol.received, ['hello'])
+        server.datagramReceived(bytes, EmulatedLink.addressA)
+        self.assertEqual(serverConn.protocol.received, ['hello', 'world'])
+
+
+
+class SelectiveAcknowledgementTests(unittest.TestCase):
+    """
+    Tests for selective acknowledgements in L{ptcp.PTCPConnection}.
+    """
+
+    def sendSegments(self, pair, count):
+        """
+        Have the client send some full segments.
+
+        @return: the segments, as they were sent.
+        """
+        client = pair.client
+        client.congestion.cwnd = count * client.mtu
+        client.write('x' * (client.mtu * count))
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual(len(sent), count)
+        return sent
+
+
+    def test_negotiated(self):
+        """
+        Selective acknowledgements are used if both ends offer them.
+        """
+        pair = ConnectionPair(self)
+        self.assertTrue(pair.client.sackPermitted)
+        self.assertTrue(pair.server.sackPermitted)
+
+
+    def test_notNegotiated(self):
+        """
+        Selective acknowledgements are not used if either end does not offer
+        them.
+        """
+        for clientSack, serverSack in [(True, False), (False, True)]:
+            pair = ConnectionPair(self, clientSack=clientSack,
+                                  serverSack=serverSack)
+            self.assertFalse(pair.client.sackPermitted)
+            self.assertFalse(pair.server.sackPermitted)
+
+
+    def test_encoding(self):
+        """
+        SACK blocks survive encoding and decoding, and are covered by the
+        checksum.
+        """
+        packet = ptcp.PTCPPacket.create(
+            1, 2, 100, 200, 'hello', ack=True,
+            sackBlocks=[(300, 400), (2 ** 32 - 10, 5)])
+        bytes = packet.encode()
+        decoded = ptcp.PTCPPacket.decode(bytes, ('127.0.0.1', 1))
+        decoded.verifyChecksum()
+        self.assertTrue(decoded.sack)
+        self.assertEqual(decoded.sackBlocks,
+                         ((300, 400), (2 ** 32 - 10, 5)))
+        self.assertEqual(decoded.data, 'hello')
+        corrupt = ptcp.PTCPPacket.decode(
+            bytes.replace('\x00\x00\x01\x2c', '\x00\x00\x01\x2d'),
+            ('127.0.0.1', 1))
+        self.assertRaises(ptcp.ChecksumMismatchError, corrupt.verifyChecksum)
+
+
+    def test_noBlocks(self):
+        """
+        Packets without SACK blocks do not have the flag set, except for SYN
+        packets, where it means selective acknowledgements are offered.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 100, 200, 'hello', sack=True)
+        decoded = ptcp.PTCPPacket.decode(packet.encode(), ('127.0.0.1', 1))
+        self.assertFalse(decoded.sack)
+        self.assertEqual(decoded.data, 'hello')
+        packet = ptcp.PTCPPacket.create(1, 2, 0, 0, '', syn=True, sack=True)
+        decoded = ptcp.PTCPPacket.decode(packet.encode(), ('127.0.0.1', 1))
+        self.assertTrue(decoded.sack)
+        self.assertEqual(decoded.sackBlocks, ())
+
+
+    def test_reportBlocks(self):
+        """
+        Acknowledgements sent when segments arrive out of order describe the
+        runs of data held, starting with the one most recently added to.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 5)
+        pair.deliver([sent[1], sent[3], sent[2]], pair.server)
+        acks = pair.serverPTCP.take()
+        end = lambda p: (p.seqNum + p.dlen) % (2**32)
+        self.assertEqual(
+            [ack.sackBlocks for ack in acks],
+            [((sent[1].seqNum, end(sent[1])),),
+             ((sent[3].seqNum, end(sent[3])),
+              (sent[1].seqNum, end(sent[1]))),
+             ((sent[1].seqNum, end(sent[3])),)])
+
+
+    def test_retransmitHolesOnly(self):
+        """
+        During fast recovery, only the segments which the peer has not
+        selectively acknowledged are retransmitted: first those with at least
+        three selectively acknowledged segments after them, then any others
+        as the cumulative acknowledgement reaches them.
+        """
+        pair = ConnectionPair(self)
+        sent = self.sendSegments(pair, 8)
+        pair.deliver([sent[i] for i in [1, 3, 4, 6, 7]], pair.server)
+        pair.deliver(pair.serverPTCP.take(), pair.client)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        retransmitted = pair.clientPTCP.take()
+        self.assertEqual(sorted(p.seqNum for p in retransmitted),
+                         [sent[i].seqNum for i in [0, 2]])
+
+        pair.deliver(retransmitted, pair.server)
+        pair.deliver(pair.serverPTCP.take(), pair.client)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        retransmitted = pair.clientPTCP.take()
+        self.assertEqual([p.seqNum for p in retransmitted], [sent[5].seqNum])
+
+        pair.deliver(retransmitted, pair.server)
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         ''.join(p.data for p in sent))
+
+
+    def test_timeoutSkipsSacked(self):
+        """
+        After a retransmission timeout, segments the peer has selectively
+        acknowledged are not retransmitted.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        sent = self.sendSegments(pair, 3)
+        pair.deliver([sent[2]], pair.server)
+        pair.deliver(pair.serverPTCP.take(), client)
+        self.assertTrue(client.retransmissionQueue[2].sacked)
+        for i in range(3):
+            pair.clock.advance(client._retransmitTimeout * 2 ** client._backoff)
+            pair.deliver(pair.clientPTCP.take(), pair.server)
+            pair.clock.advance(ptcp.SEND_DELAY)
+            pair.deliver(pair.serverPTCP.take(), client)
+        self.assertEqual(list(client.retransmissionQueue), [])
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         ''.join(p.data for p in sent))
+
+
+    def test_recoveryCost(self):
+        """
+        The work done for each acknowledgement during fast recovery does not
+        grow with the size of the congestion window: segments are marked
+        lost, and retransmitted, without walking the retransmission queue.
+        """
+        self.patch(ptcp.PTCPConnection, 'recvWindow', 1 << 21)
+        pair = ConnectionPair(self)
+        client = pair.client
+        count = 2000
+        sent = self.sendSegments(pair, count)
+        pair.deliver([packet for i, packet in enumerate(sent) if i % 10],
+                     pair.server)
+        acks = pair.serverPTCP.take()
+
+        visited = []
+        queueType = ptcp._RetransmissionQueue
+        iterate, covered = queueType.__iter__, queueType.covered
+        def countingIter(queue):
+            for packet in iterate(queue):
+                visited.append(packet)
+                yield packet
+        def countingCovered(queue, left, right):
+            found = covered(queue, left, right)
+            visited.extend(found)
+            return found
+        self.patch(queueType, '__iter__', countingIter)
+        self.patch(queueType, 'covered', countingCovered)
+
+        pair.deliver(acks, client)
+        self.assertTrue(client._inRecovery)
+        self.assertEqual(client._lostSegments, count // 10 - 1)
+        # Only the segments named by each SACK block, and each segment once
+        # more as it is marked lost, need be looked at; walking the queue
+        # would look at thousands for every acknowledgement.
+        named = sum((right - left) // client.mtu
+                    for ack in acks for (left, right) in ack.sackBlocks)
+        self.assertTrue(len(visited) <= named + count,
+                        "%d segments visited for %d acks" % (
+                            len(visited), len(acks)))
+
+        pair.pump()
+        self.assertEqual(list(client.retransmissionQueue), [])
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         ''.join(p.data for p in sent))
+
+
+
+class FlowControlTests(unittest.TestCase):
+    """
+    Tests for the windows which L{ptcp.PTCPConnection}s advertise to each
+    other, and for honouring them.
+    """
+
+    def setUp(self):
+        self.patch(ptcp.PTCPConnection, 'recvWindow',
+                   ptcp.PTCPConnection.mtu * 4)
+        self.pair = ConnectionPair(self)
+
+
+    def talk(self, seconds):
+        """
+        Let the connections talk to each other for a while.
+        """
+        for i in range(int(seconds / 0.1)):
+            self.pair.pump()
+            self.pair.clock.advance(0.1)
+
+
+    def test_advertised(self):
+        """
+        Each connection learns the size of the other's receive buffer from
+        the handshake.  The client advertised its window before it received
+        the server's SYN, which takes up one octet of it.
+        """
+        self.assertEqual(self.pair.client.sendWindow,
+                         ptcp.PTCPConnection.mtu * 4)
+        self.assertEqual(self.pair.server.sendWindow,
+                         ptcp.PTCPConnection.mtu * 4 - 1)
+
+
+    def test_largeWindow(self):
+        """
+        Windows larger than 64k are advertised as they are.
+        """
+        packet = self.pair.client.originate(ack=True)
+        packet.window = 1 << 20
+        self.pair.deliver([packet], self.pair.server)
+        self.assertEqual(self.pair.server.sendWindow, 1 << 20)
+
+
+    def test_pausedReceiver(self):
+        """
+        While the application is paused, data is buffered for it until the
+        window closes, after which the sender only probes the window.  Once
+        the application resumes, it gets everything, in order.
+        """
+        pair = self.pair
+        client = pair.client
+        pair.server.pauseProducing()
+        data = ''.join(chr(i % 256) for i in range(client.mtu * 10))
+        client.write(data)
+        self.talk(5)
+        self.assertEqual(pair.serverProtocol.received, [])
+        self.assertEqual(client.sendWindow, 0)
+        self.assertEqual(pair.server._undeliveredSize, client.mtu * 4)
+        self.assertFalse(client._inRecovery)
+        pair.server.resumeProducing()
+        self.talk(5)
+        self.assertEqual(''.join(pair.serverProtocol.received), data)
+        self.assertEqual(pair.server._undeliveredSize, 0)
+        # The window only opens in steps of at least a segment.
+        self.assertTrue(client.sendWindow > client.mtu * 3)
+
+
+    def test_probeForever(self):
+        """
+        A sender keeps probing a closed window for far longer than it would
+        keep retransmitting a lost segment.
+        """
+        pair = self.pair
+        pair.server.pauseProducing()
+        pair.client.write('x' * (pair.client.mtu * 5))
+        self.talk(ptcp.PTCPConnection._maxRetransmitTimeout
+                 * ptcp.PTCPPacket.retransmitCount * 2)
+        self.assertFalse(pair.clientProtocol.lost)
+        pair.server.resumeProducing()
+        self.talk(ptcp.PTCPConnection._maxRetransmitTimeout * 2)
+        self.assertEqual(''.join(pair.serverProtocol.received),
+                         'x' * (pair.client.mtu * 5))
+
+
+    def test_finAfterBufferedData(self):
+        """
+        A FIN which arrives while the application is paused is not acted on
+        until the data before it has been delivered.
+        """
+        pair = self.pair
+        pair.server.pauseProducing()
+        pair.client.write('hello')
+        pair.client.loseConnection()
+        self.talk(1)
+        self.assertEqual(pair.serverProtocol.received, [])
+        self.assertFalse(pair.serverProtocol.lost)
+        pair.server.resumeProducing()
+        self.talk(1)
+        self.assertEqual(pair.serverProtocol.received, ['hello'])
+        self.assertTrue(pair.serverProtocol.lost)
+
+
+
+class PathMTUTests(unittest.TestCase):
+    """
+    Tests for path MTU discovery by L{ptcp.PTCPConnection}.
+    """
+
+    def connect(self, maxPacketSize=None):
+        self.pair = ConnectionPair(self, pathMTUDiscovery=True,
+                                   maxPacketSize=maxPacketSize)
+
+
+    def talk(self, seconds):
+        for i in range(int(seconds / 0.1)):
+            self.pair.pump()
+            self.pair.clock.advance(0.1)
+
+
+    def test_probe(self):
+        """
+        A probe's data is padding, which takes up no sequence space and is
+        never retransmitted.
+        """
+        packet = ptcp.PTCPPacket.create(1, 2, 0, 0, 'x' * 100, probe=True,
+                                        ack=True)
+        decoded = ptcp.PTCPPacket.decode(packet.encode(), ('127.0.0.1', 1))
+        self.assertTrue(decoded.probe)
+        self.assertEqual(decoded.dlen, 100)
+        self.assertEqual(decoded.segmentLength(), 0)
+        self.assertFalse(decoded.mustRetransmit())
+
+
+    def test_fullSize(self):
+        """
+        Once connected, each side finds that full-sized segments get through,
+        and remembers that for the peer's host.
+        """
+        self.connect()
+        self.talk(1)
+        self.assertTrue(self.pair.client.pathMTUProbing)
+        self.assertEqual(self.pair.client.mtu, ptcp.PTCPConnection.maxMTU)
+        self.assertEqual(self.pair.server.mtu, ptcp.PTCPConnection.maxMTU)
+        self.assertEqual(self.pair.clientPTCP.pathMTUs,
+                         {self.pair.serverAddress[0]:
+                              ptcp.PTCPConnection.maxMTU})
+        self.assertEqual(self.pair.client.congestion.mss,
+                         ptcp.PTCPConnection.maxMTU)
+
+
+    def test_search(self):
+        """
+        If full-sized segments don't get through, the largest size which
+        does is searched for.
+        """
+        self.connect(maxPacketSize=1000)
+        self.talk(10)
+        mtu = self.pair.client.mtu
+        self.assertTrue(
+            1000 - ptcp._fixedSize - ptcp.PTCPConnection._probeGranularity
+            < mtu <= 1000 - ptcp._fixedSize, mtu)
+        data = 'x' * (mtu * 20)
+        self.pair.client.write(data)
+        self.talk(2)
+        self.assertEqual(''.join(self.pair.serverProtocol.received), data)
+
+
+    def test_notOffered(self):
+        """
+        No probes are sent to a peer which did not offer to answer them.
+        """
+        self.pair = ConnectionPair(self)
+        self.pair.clientPTCP.pathMTUDiscovery = True
+        self.talk(1)
+        self.assertFalse(self.pair.client.pathMTUProbing)
+        self.assertEqual(self.pair.client.mtu, ptcp.PTCPConnection.mtu)
+
+
+    def test_cached(self):
+        """
+        A new connection to a host whose path MTU has been found starts out
+        with segments that large.
+        """
+        self.connect()
+        self.pair.clientPTCP.pathMTUs[self.pair.serverAddress[0]] = 1000
+        connection = ptcp.PTCPConnection(
+            9, 1, self.pair.clientPTCP, protocol.ClientFactory(),
+            self.pair.serverAddress)
+        self.assertEqual(connection.mtu, 1000)
+        self.assertEqual(connection.congestion.mss, 1000)
+
+
+    def test_shrinkLazily(self):
+        """
+        When the segment size shrinks, segments already sent are only split
+        up as they are retransmitted.
+        """
+        self.connect()
+        self.talk(1)
+        client = self.pair.client
+        retransmitted = []
+        def tracer(connection, event, detail):
+            if event == 'retransmit':
+                retransmitted.append(detail.dlen)
+        self.pair.clientPTCP.tracer = tracer
+        data = 'x' * (client.mtu * 4)
+        client.write(data)
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        self.pair.clientPTCP.take()
+        queued = len(client.retransmissionQueue)
+        self.assertTrue(queued)
+        client._shrinkMTU(ptcp.PTCPConnection.mtu)
+        self.assertEqual(len(client.retransmissionQueue), queued)
+        self.talk(10)
+        self.assertEqual(''.join(self.pair.serverProtocol.received), data)
+        self.assertTrue(retransmitted)
+        self.assertTrue(max(retransmitted) <= ptcp.PTCPConnection.mtu)
+
+
+    def test_truncatedToNothing(self):
+        """
+        A report that a segment was truncated to less than
+        L{ptcp.PTCPConnection.minMTU} shrinks the segment size only that
+        far, and once it is that small, further reports are ignored.
+        """
+        self.connect()
+        client, server = self.pair.client, self.pair.server
+        data = 'x' * (client.mtu * 4)
+        client.write(data)
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        self.pair.clientPTCP.take()
+        report = ptcp.PTCPPacket.create(
+            server.hostPseudoPort, client.hostPseudoPort, 0, 0,
+            struct.pack('!H', 0), stb=True)
+        self.pair.deliver([report], client)
+        self.assertEqual(client.mtu, ptcp.PTCPConnection.minMTU)
+        self.assertEqual(client.congestion.mss, ptcp.PTCPConnection.minMTU)
+        lost = client._lostSegments
+        self.assertTrue(lost)
+        self.pair.deliver([report], client)
+        self.assertEqual(client._lostSegments, lost)
+        self.talk(10)
+        self.assertEqual(''.join(self.pair.serverProtocol.received), data)
+
+
+    def test_blackHole(self):
+        """
+        If large segments start disappearing, the connection goes back to
+        small ones, forgets the cached path MTU, and its data still gets
+        through.
+        """
+        self.connect()
+        self.talk(1)
+        self.assertEqual(self.pair.client.mtu, ptcp.PTCPConnection.maxMTU)
+        self.pair.maxPacketSize = 512
+        data = 'x' * (ptcp.PTCPConnection.maxMTU * 10)
+        self.pair.client.write(data)
+        self.talk(20)
+        self.assertEqual(''.join(self.pair.serverProtocol.received), data)
+        self.assertTrue(self.pair.client.mtu <= 512 - ptcp._fixedSize)
+        self.assertNotEqual(self.pair.clientPTCP.pathMTUs.get(
+                self.pair.serverAddress[0]), ptcp.PTCPConnection.maxMTU)
+
+
+
+class HandshakeTests(unittest.TestCase):
+    """
+    Tests for opening L{ptcp.PTCPConnection}s.
+    """
+
+    def test_overtakenSyn(self):
+        """
+        Segments which overtake our peer's SYN are ignored until it arrives.
+        """
+        pair = ConnectionPair(self)
+        factory = protocol.ClientFactory()
+        factory.protocol = AccumulatingProtocol
+        client = ptcp.PTCPConnection(9, 1, pair.clientPTCP, factory,
+                                     pair.serverAddress)
+        server = ptcp.PTCPConnection(1, 9, pair.serverPTCP, factory, None)
+        server.machine.appPassiveOpen()
+        client.machine.appActiveOpen()
+        pair.deliver(pair.clientPTCP.take(), server)
+        server.originate(ack=True)
+        sent = pair.serverPTCP.take()
+        synAck, ack = sent[0], sent[-1]
+        def receive(packet):
+            client.packetReceived(ptcp.PTCPPacket.decode(
+                    packet.encode(), pair.serverAddress))
+        receive(ack)
+        self.assertEqual(client._state, 'synSent')
+        receive(synAck)
+        self.assertEqual(client._state, 'established')
+        self.assertNotIdentical(client.protocol, None)
+
+
+
+class CloseTests(unittest.TestCase):
+    """
+    Tests for closing L{ptcp.PTCPConnection}s.
+    """
+
+    def test_dataAckedBeforeFin(self):
+        """
+        A connection closed while some of its data is unacknowledged finishes
+        closing once its FIN is acknowledged, even if an acknowledgement of
+        only some of the data arrives first.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        client.write('x' * client.mtu * 3)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        client.loseConnection()
+        first, second, third, fin = pair.clientPTCP.take()
+        self.assertTrue(fin.fin)
+        pair.deliver([first], pair.server)
+        pair.clock.advance(0.1)
+        pair.deliver(pair.serverPTCP.take(), pair.client)
+        pair.deliver([second, third, fin], pair.server)
+        for i in range(10):
+            pair.pump()
+            pair.clock.advance(0.1)
+        self.assertEqual(pair.serverPTCP.closed, [pair.server])
+        pair.clock.advance(pair.clientPTCP.timeWait)
+        self.assertEqual(pair.clientPTCP.closed, [client])
+        self.assertEqual(pair.serverPTCP.closed, [pair.server])
+
+
+
+class HalfCloseTests(unittest.TestCase):
+    """
+    Tests for closing one direction of a L{ptcp.PTCPConnection} at a time.
+    """
+
+    def connect(self, protocolFactory=HalfCloseableProtocol):
+        self.pair = ConnectionPair(self, protocolFactory=protocolFactory)
+        self.client = self.pair.client
+        self.server = self.pair.server
+
+
+    def talk(self, seconds):
+        for i in range(int(seconds / 0.1)):
+            self.pair.pump()
+            self.pair.clock.advance(0.1)
+
+
+    def test_halfClose(self):
+        """
+        After one side stops writing, the other is told that it will get no
+        more data, and can still send some of its own.
+        """
+        self.connect()
+        self.client.write('request')
+        self.client.loseWriteConnection()
+        self.assertFalse(self.pair.clientProtocol.writeLost)
+        self.talk(1)
+        self.assertEqual(self.pair.serverProtocol.received, ['request'])
+        self.assertTrue(self.pair.clientProtocol.writeLost)
+        self.assertFalse(self.pair.clientProtocol.readLost)
+        self.assertTrue(self.pair.serverProtocol.readLost)
+        self.assertFalse(self.pair.serverProtocol.writeLost)
+        self.assertFalse(self.pair.serverProtocol.lost)
+        self.assertFalse(self.pair.clientProtocol.lost)
+
+        self.server.write('response')
+        self.server.loseConnection()
+        self.talk(1)
+        self.assertEqual(self.pair.clientProtocol.received, ['response'])
+        self.assertTrue(self.pair.clientProtocol.lost)
+        self.assertTrue(self.pair.serverProtocol.lost)
+        self.assertEqual(self.pair.serverPTCP.closed, [self.server])
+        self.assertEqual(self.client._state, 'timeWait')
+        self.pair.clock.advance(self.pair.clientPTCP.timeWait)
+        self.assertEqual(self.pair.clientPTCP.closed, [self.client])
+
+
+    def test_bothHalves(self):
+        """
+        A connection closed a half at a time by each side disconnects both of
+        them once the second half is closed.
+        """
+        self.connect()
+        self.client.loseWriteConnection()
+        self.talk(1)
+        self.server.loseWriteConnection()
+        self.talk(1)
+        self.assertTrue(self.pair.clientProtocol.lost)
+        self.assertTrue(self.pair.serverProtocol.lost)
+        self.assertEqual(self.pair.serverPTCP.closed, [self.server])
+
+
+    def test_notHalfCloseable(self):
+        """
+        A protocol which cannot carry on with only half a connection is
+        disconnected when its peer stops writing.
+        """
+        self.connect(AccumulatingProtocol)
+        self.client.loseWriteConnection()
+        self.talk(1)
+        self.assertTrue(self.pair.serverProtocol.lost)
+        self.assertTrue(self.pair.clientProtocol.lost)
+
+
+    def test_writeAfterHalfClose(self):
+        """
+        Data written after the write half of the connection is closed is
+        thrown away, but data written before it is sent first.
+        """
+        self.connect()
+        self.client.write('early')
+        self.client.loseWriteConnection()
+        self.client.write('late')
+        self.client.writeSequence(['later'])
+        self.talk(1)
+        self.assertEqual(''.join(self.pair.serverProtocol.received), 'early')
+        self.assertTrue(self.pair.serverProtocol.readLost)
+
+
+    def test_loseConnectionAfterHalfClose(self):
+        """
+        Closing the whole connection after closing its write half disconnects
+        the application straight away, and the connection still closes.
+        """
+        self.connect()
+        self.client.loseWriteConnection()
+        self.talk(1)
+        self.client.loseConnection()
+        self.assertTrue(self.pair.clientProtocol.lost)
+        self.server.write('unwanted')
+        self.server.loseConnection()
+        self.talk(1)
+        self.assertEqual(self.pair.clientProtocol.received, [])
+        self.assertEqual(self.pair.serverPTCP.closed, [self.server])
+        self.assertEqual(self.client._state, 'timeWait')
+
+
+
+class EmulatedPortsMixin:
+    """
+    Run two L{ptcp.PTCP} ports on either end of an L{EmulatedLink}, on a
+    L{task.Clock}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = AccumulatingProtocol
+        # A port with no factory stops once its last connection closes, so
+        # give both of them one.
+        self.client = ptcp.PTCP(serverFactory, timeWait=10)
+        self.server = ptcp.PTCP(serverFactory, timeWait=10)
+        self.link = EmulatedLink(self.clock, LinkConditions(delay=0.01))
+        self.link.connect(self.client, self.server)
+
+
+    def connect(self):
+        factory = protocol.ClientFactory()
+        factory.protocol = AccumulatingProtocol
+        return self.client.connect(factory, *EmulatedLink.addressB)
+
+
+    def wait(self, seconds):
+        self.clock.pump([0.01] * int(seconds / 0.01))
+
+
+
+class TimeWaitTests(EmulatedPortsMixin, unittest.TestCase):
+    """
+    Tests for the TIME-WAIT state of connections over a L{ptcp.PTCP}, and
+    for reusing their pseudo-ports.
+    """
+
+    def test_timeWait(self):
+        """
+        The side which closes first keeps the connection's pseudo-ports for
+        the port's C{timeWait}, and then forgets them.
+        """
+        conn = self.connect()
+        self.wait(1)
+        conn.loseConnection()
+        self.wait(1)
+        self.assertEqual(conn._state, 'timeWait')
+        self.assertEqual(self.client._connections.values(), [conn])
+        self.assertEqual(self.server._connections, {})
+        self.wait(10)
+        self.assertEqual(conn._state, 'closed')
+        self.assertEqual(self.client._connections, {})
+
+
+    def test_reuse(self):
+        """
+        A new connection from the pseudo-port of one its peer is holding in
+        TIME-WAIT replaces it straight away.
+        """
+        self.client._nextPseudoPort = 77
+        self.connect()
+        self.wait(1)
+        [old] = self.server._connections.values()
+        old.loseConnection()
+        self.wait(1)
+        self.assertEqual(old._state, 'timeWait')
+        self.assertEqual(self.client._connections, {})
+
+        self.client._nextPseudoPort = 77
+        conn = self.connect()
+        self.wait(0.5)
+        self.assertEqual(conn._state, 'established')
+        [new] = self.server._connections.values()
+        self.assertNotIdentical(new, old)
+        self.assertEqual(new._state, 'established')
+        self.assertEqual(self.server.statistics().connections, 2)
+
+
+    def test_straySyn(self):
+        """
+        A stray copy of the SYN which opened a connection in TIME-WAIT does
+        not replace it.
+        """
+        self.connect()
+        self.wait(1)
+        [old] = self.server._connections.values()
+        old.loseConnection()
+        self.wait(1)
+        syn = ptcp.PTCPPacket.create(old.peerPseudoPort, old.hostPseudoPort,
+                                     old.peerSendISN, 0, '', syn=True)
+        self.server.datagramReceived(syn.encode(), EmulatedLink.addressA)
+        self.assertEqual(self.server._connections.values(), [old])
+        self.assertEqual(old._state, 'timeWait')
+
+
+
+class ConnectionTableTests(EmulatedPortsMixin, unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCP} allocates pseudo-ports and limits the
+    size of its connection table.
+    """
+
+    def forgeSyn(self, pseudoPort):
+        """
+        Have the server receive a SYN from a peer which will never finish the
+        handshake.
+        """
+        syn = ptcp.PTCPPacket.create(pseudoPort, 1, 1000, 0, '', syn=True)
+        self.server.datagramReceived(syn.encode(), ('10.6.6.6', 666))
+
+
+    def test_pseudoPortsInUse(self):
+        """
+        A new connection does not take the pseudo-port of another to the same
+        place, but may share it with one to somewhere else.
+        """
+        self.client._nextPseudoPort = 100
+        self.assertEqual(self.connect().hostPseudoPort, 100)
+        self.client._nextPseudoPort = 100
+        self.assertEqual(self.connect().hostPseudoPort, 101)
+        self.client._nextPseudoPort = 100
+        self.assertEqual(
+            self.client._allocatePseudoPort(1, ('10.9.9.9', 1)), 100)
+
+
+    def test_pseudoPortsWrap(self):
+        """
+        Pseudo-ports are allocated in turn, going back to the lowest once the
+        highest has been used.
+        """
+        self.client._nextPseudoPort = ptcp.MAX_PSEUDO_PORT - 1
+        self.assertEqual(self.connect().hostPseudoPort,
+                         ptcp.MAX_PSEUDO_PORT - 1)
+        self.assertEqual(self.connect().hostPseudoPort,
+                         ptcp.MIN_CLIENT_PSEUDO_PORT)
+
+
+    def test_pseudoPortsExhausted(self):
+        """
+        Once every pseudo-port is in use for connections to the same place,
+        no more can be made.
+        """
+        self.patch(ptcp, 'MAX_PSEUDO_PORT', ptcp.MIN_CLIENT_PSEUDO_PORT + 2)
+        self.client._nextPseudoPort = ptcp.MIN_CLIENT_PSEUDO_PORT
+        self.connect()
+        self.connect()
+        self.assertRaises(error.ConnectBindError, self.connect)
+
+
+    def test_tableFull(self):
+        """
+        No connection can be made over a port whose connection table is full
+        of connections which are not half-open.
+        """
+        self.client.maxConnections = 1
+        self.connect()
+        self.assertRaises(error.ConnectError, self.connect)
+        self.server.maxConnections = 1
+        self.wait(1)
+        self.forgeSyn(500)
+        self.assertEqual(len(self.server._connections), 1)
+        self.assertEqual(self.server.statistics().synsDropped, 1)
+
+
+    def test_synFlood(self):
+        """
+        A flood of SYNs fills no more of the connection table than the
+        half-open limit allows, and a genuine peer can still connect.
+        """
+        self.server.maxHalfOpen = 4
+        for pseudoPort in range(1000, 1010):
+            self.forgeSyn(pseudoPort)
+        self.assertEqual(len(self.server._connections), 4)
+        self.assertEqual(
+            sorted(key[0] for key in self.server._connections),
+            range(1006, 1010))
+        stats = self.server.statistics()
+        self.assertEqual(stats.halfOpenConnections, 4)
+        self.assertEqual(stats.halfOpenEvicted, 6)
+        conn = self.connect()
+        self.wait(1)
+        self.assertEqual(conn._state, 'established')
+        self.assertEqual(len(self.server._halfOpen), 3)
+        self.assertEqual(len(self.server._connections), 4)
+
+
+    def test_occupancy(self):
+        """
+        The statistics of a port count the connections over it which are
+        open, half-open and in TIME-WAIT.
+        """
+        conn = self.connect()
+        self.wait(1)
+        self.forgeSyn(500)
+        stats = self.server.statistics()
+        self.assertEqual((stats.openConnections, stats.halfOpenConnections,
+                          stats.timeWaitConnections), (2, 1, 0))
+        conn.loseConnection()
+        self.wait(1)
+        stats = self.client.statistics()
+        self.assertEqual((stats.openConnections, stats.halfOpenConnections,
+                          stats.timeWaitConnections), (1, 0, 1))
+        self.wait(10)
+        stats = self.client.statistics()
+        self.assertEqual((stats.connections, stats.openConnections,
+                          stats.timeWaitConnections), (1, 0, 0))
+
+
+
+class KeepAliveTests(EmulatedPortsMixin, unittest.TestCase):
+    """
+    Tests for keepalive probes, and for giving up on peers which stop
+    answering them.
+    """
+
+    def setUp(self):
+        EmulatedPortsMixin.setUp(self)
+        self.client.keepAlive = 10.0
+        self.client.keepAliveInterval = 1.0
+        self.client.keepAliveProbes = 3
+        self.probes = []
+        def tracer(conn, event, detail):
+            if event == 'keepalive':
+                self.probes.append(self.clock.seconds())
+        self.client.tracer = tracer
+
+
+    def test_idle(self):
+        """
+        A connection which has been idle for C{keepAlive} seconds sends a
+        probe, which its peer answers, even if it has not enabled keepalives
+        itself.
+        """
+        conn = self.connect()
+        self.wait(25)
+        self.assertEqual(len(self.probes), 2)
+        self.assertApproximates(self.probes[1] - self.probes[0], 10.0, 0.1)
+        self.assertEqual(conn._state, 'established')
+        self.assertFalse(conn.protocol.lost)
+        self.assertEqual(self.client.statistics().keepAliveProbes, 2)
+        self.assertEqual(self.server.statistics().keepAliveProbes, 0)
+        self.assertEqual(self.client.statistics().deadPeers, 0)
+
+
+    def test_busy(self):
+        """
+        A connection whose peer keeps sending it things does not probe it.
+        """
+        conn = self.connect()
+        self.wait(1)
+        [serverConn] = self.server._connections.values()
+        for i in range(30):
+            serverConn.write('x')
+            self.wait(1)
+        self.assertEqual(self.probes, [])
+        self.assertEqual(conn.protocol.received, ['x'] * 30)
+
+
+    def test_disabled(self):
+        """
+        Without C{keepAlive}, an idle connection sends nothing.
+        """
+        self.client.keepAlive = None
+        conn = self.connect()
+        self.wait(1)
+        sent = self.link.forward.sent
+        self.wait(100)
+        self.assertEqual(self.link.forward.sent, sent)
+        self.assertEqual(conn._state, 'established')
+
+
+    def test_deadPeer(self):
+        """
+        A peer which answers none of C{keepAliveProbes} probes is given up on,
+        and the application is told that the connection was lost.
+        """
+        conn = self.connect()
+        self.wait(1)
+        protocol = conn.protocol
+        self.link.b.stopListening()
+        self.wait(10 + 3 * 1 + 0.5)
+        self.assertEqual(len(self.probes), 3)
+        self.assertTrue(protocol.lost)
+        protocol.reason.trap(error.ConnectionLost)
+        self.assertEqual(self.client._connections, {})
+        self.assertEqual(self.client.statistics().deadPeers, 1)
+
+
+    def test_deadPeerWithDataInFlight(self):
+        """
+        A peer which stops acknowledging data is given up on after as long as
+        an idle one would be, without sending probes as well as
+        retransmissions.
+        """
+        conn = self.connect()
+        self.wait(1)
+        protocol = conn.protocol
+        self.link.b.stopListening()
+        conn.write('x' * 100)
+        self.wait(10 + 3 * 1 + 0.5)
+        self.assertEqual(self.probes, [])
+        self.assertTrue(protocol.lost)
+        protocol.reason.trap(error.ConnectionLost)
+        self.assertEqual(self.client._connections, {})
+
+
+
+class PacingTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} paces the segments it sends.
+    """
+
+    def setUp(self):
+        self.pair = ConnectionPair(self)
+        self.client = self.pair.client
+        self.pair.clientPTCP.pacing = True
+        self.mtu = self.client.mtu
+        self.client.smoothedRTT = None
+        # Nothing will be acknowledged; don't retransmit meanwhile.
+        self.client._retransmitTimeout = 10.0
+        # Ten segments a round trip, out of slow start.
+        self.client.congestion.cwnd = self.client.congestion.ssthresh = (
+            10 * self.mtu)
+
+
+    def sent(self, seconds):
+        """
+        Run the clock for a while, a millisecond at a time, without
+        acknowledging anything.
+
+        @return: the number of segments the client sent meanwhile.
+        """
+        clock = self.pair.clock
+        end = clock.seconds() + seconds
+        while clock.seconds() < end:
+            clock.advance(min(0.001, end - clock.seconds()))
+        return len(self.pair.clientPTCP.take())
+
+
+    def test_rate(self):
+        """
+        Segments are paced a little faster than one window per round trip,
+        or twice as fast as that in slow start.
+        """
+        self.assertIdentical(self.client.pacingRate, None)
+        self.client.smoothedRTT = 2.0
+        self.assertEqual(self.client.pacingRate, 1.25 * 10 * self.mtu / 2.0)
+        self.client.congestion.ssthresh *= 2
+        self.assertEqual(self.client.pacingRate, 2.0 * 10 * self.mtu / 2.0)
+        self.pair.clientPTCP.maxPacingRate = 100.0
+        self.assertEqual(self.client.pacingRate, 100.0)
+        self.pair.clientPTCP.pacing = False
+        self.assertIdentical(self.client.pacingRate, None)
+
+
+    def test_spread(self):
+        """
+        A window of segments is sent over a round trip rather than all at
+        once, after a short burst.
+        """
+        self.client.smoothedRTT = 1.0
+        self.client.write('x' * self.mtu * 10)
+        self.assertEqual(self.sent(ptcp.SEND_DELAY), 2)
+        # 12.5 segments a second, so one every 80ms.
+        self.assertEqual(self.sent(0.07), 0)
+        self.assertEqual(self.sent(0.02), 1)
+        self.assertEqual(self.sent(0.6), 7)
+        self.assertEqual(self.client.stats.pacedSegments, 8)
+        self.assertApproximates(self.client.stats.pacingDelay, 0.64, 0.01)
+
+
+    def test_maxPacingRate(self):
+        """
+        The port's maximum rate applies even before the round trip time is
+        known.
+        """
+        self.pair.clientPTCP.maxPacingRate = self.mtu * 10.0
+        self.client.write('x' * self.mtu * 4)
+        self.assertEqual(self.sent(ptcp.SEND_DELAY), 2)
+        self.assertEqual(self.sent(0.09), 0)
+        self.assertEqual(self.sent(0.02), 1)
+        self.assertEqual(self.sent(0.1), 1)
+
+
+    def test_disabled(self):
+        """
+        Without pacing, the whole window is sent at once.
+        """
+        self.pair.clientPTCP.pacing = False
+        self.client.smoothedRTT = 1.0
+        self.client.write('x' * self.mtu * 10)
+        self.assertEqual(self.sent(ptcp.SEND_DELAY), 10)
+        self.assertEqual(self.client.stats.pacedSegments, 0)
+
+
+    def test_rounding(self):
+        """
+        A segment for which the pacer has all but a rounding error's worth of
+        tokens is sent right away.
+        """
+        self.client.smoothedRTT = 1.0
+        self.client._paceTokens = self.mtu - 1e-9
+        self.client._paceStamp = self.pair.clock.seconds()
+        self.assertTrue(self.client._paceAllows(self.mtu))
+        self.assertIdentical(self.client._paceTimer, None)
+
+
+    def test_stopped(self):
+        """
+        The pacer stops when the connection does.
+        """
+        self.client.smoothedRTT = 1.0
+        self.client.write('x' * self.mtu * 10)
+        self.sent(ptcp.SEND_DELAY)
+        self.client._stopRetransmitting()
+        self.assertEqual(self.sent(1), 0)
+
+
+
+class DelayedAckTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} delays acknowledgements, so that
+    they can cover more than one segment or ride along with data.
+    """
+
+    def setUp(self):
+        self.pair = ConnectionPair(self)
+        client = self.pair.client
+        client.write(''.join(chr(ord('a') + i) * client.mtu
+                             for i in range(4)))
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        self.segments = self.pair.clientPTCP.take()
+        self.assertEqual(len(self.segments), 4)
+
+
+    def acks(self):
+        """
+        @return: the acknowledgement numbers of the packets the server has
+            sent since this was last called.
+        """
+        return [p.ackNum for p in self.pair.serverPTCP.take()]
+
+
+    def end(self, segment):
+        """
+        @return: the acknowledgement number which covers C{segment}.
+        """
+        return (segment.seqNum + segment.dlen) % (2**32)
+
+
+    def test_delayed(self):
+        """
+        A single segment is acknowledged once C{ACK_DELAY} has passed.
+        """
+        self.pair.deliver(self.segments[:1], self.pair.server)
+        self.assertEqual(self.acks(), [])
+        self.pair.clock.advance(ptcp.ACK_DELAY / 2)
+        self.assertEqual(self.acks(), [])
+        self.pair.clock.advance(ptcp.ACK_DELAY)
+        self.assertEqual(self.acks(), [self.end(self.segments[0])])
+        self.pair.clock.advance(ptcp.ACK_DELAY * 2)
+        self.assertEqual(self.acks(), [])
+
+
+    def test_everySecondSegment(self):
+        """
+        Every second segment is acknowledged immediately.
+        """
+        for segment in self.segments:
+            self.pair.deliver([segment], self.pair.server)
+        self.assertEqual(self.acks(), [self.end(self.segments[1]),
+                                       self.end(self.segments[3])])
+        self.pair.clock.advance(ptcp.ACK_DELAY * 2)
+        self.assertEqual(self.acks(), [])
+
+
+    def test_outOfOrder(self):
+        """
+        A segment which arrives after a gap is acknowledged immediately, with
+        a duplicate acknowledgement.
+        """
+        self.pair.deliver(self.segments[1:2], self.pair.server)
+        self.assertEqual(self.acks(), [self.segments[0].seqNum])
+
+
+    def test_duplicate(self):
+        """
+        A segment which has already been received is acknowledged
+        immediately, since the peer evidently did not get the
+        acknowledgement of it.
+        """
+        self.pair.deliver(self.segments[:2], self.pair.server)
+        self.acks()
+        self.pair.deliver(self.segments[:1], self.pair.server)
+        self.assertEqual(self.acks(), [self.end(self.segments[1])])
+
+
+    def test_piggyback(self):
+        """
+        An acknowledgement is carried by data the application writes in the
+        meantime, rather than being sent by itself.
+        """
+        self.pair.deliver(self.segments[:1], self.pair.server)
+        self.pair.server.write('reply')
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        [reply] = self.pair.serverPTCP.take()
+        self.assertEqual(reply.data, 'reply')
+        self.assertEqual(reply.ackNum, self.end(self.segments[0]))
+        self.pair.clock.advance(ptcp.ACK_DELAY * 1.5)
+        self.assertEqual(self.acks(), [])
+
+
+    def test_piggybackImmediately(self):
+        """
+        When a segment must be acknowledged immediately, the acknowledgement
+        is carried by data the application has written but which has not yet
+        been sent.
+        """
+        self.pair.deliver(self.segments[:1], self.pair.server)
+        self.pair.server.write('reply')
+        self.pair.deliver(self.segments[1:2], self.pair.server)
+        [reply] = self.pair.serverPTCP.take()
+        self.assertEqual(reply.data, 'reply')
+        self.assertEqual(reply.ackNum, self.end(self.segments[1]))
+        self.pair.clock.advance(ptcp.ACK_DELAY * 1.5)
+        self.assertEqual(self.acks(), [])
+
+
+
+class StatisticsTests(unittest.TestCase):
+    """
+    Tests for L{ptcp.PTCPStatistics} and the way L{ptcp.PTCPConnection} and
+    L{ptcp.PTCP} keep them.
+    """
+
+    def setUp(self):
+        self.pair = ConnectionPair(self)
+        self.client = self.pair.client
+        self.server = self.pair.server
+        self.mtu = self.client.mtu
+
+
+    def test_traffic(self):
+        """
+        Segments and data sent and received are counted, as are round trip
+        time measurements.
+        """
+        before = self.client.stats.segmentsSent
+        self.client.write('x' * self.mtu * 3)
+        self.pair.pump()
+        self.pair.clock.advance(ptcp.ACK_DELAY)
+        self.pair.pump()
+        stats = self.client.statistics()
+        self.assertEqual(stats.segmentsSent - before, 3)
+        self.assertEqual(stats.bytesSent, self.mtu * 3)
+        self.assertEqual(stats.retransmits, 0)
+        self.assertEqual(self.server.stats.bytesReceived, self.mtu * 3)
+        self.assertEqual(self.server.stats.duplicateSegments, 0)
+        self.assertTrue(stats.rttSamples)
+        self.assertEqual(stats.minRTT, min(stats.minRTT, stats.maxRTT))
+        self.assertApproximates(stats.meanRTT,
+                                stats.rttTotal / stats.rttSamples, 1e-9)
+
+
+    def test_retransmits(self):
+        """
+        Retransmissions, and the timeouts which cause them, are counted.
+        """
+        self.client.write('x' * self.mtu)
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        self.pair.clientPTCP.take()
+        self.pair.clock.advance(self.client._retransmitTimeout)
+        self.assertEqual(len(self.pair.clientPTCP.take()), 1)
+        stats = self.client.stats
+        self.assertEqual(stats.timeouts, 1)
+        self.assertEqual(stats.retransmits, 1)
+        self.assertEqual(stats.bytesRetransmitted, self.mtu)
+        self.assertEqual(stats.bytesSent, self.mtu * 2)
+
+
+    def test_receivedOutOfOrder(self):
+        """
+        Segments which arrive after a gap, and segments which arrive again,
+        are counted.
+        """
+        self.client.write('x' * self.mtu * 2)
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        first, second = self.pair.clientPTCP.take()
+        self.pair.deliver([second, first, first], self.server)
+        self.assertEqual(self.server.stats.outOfOrderSegments, 1)
+        self.assertEqual(self.server.stats.duplicateSegments, 1)
+        self.assertEqual(self.server.stats.bytesReceived, self.mtu * 3)
+
+
+    def test_stateTime(self):
+        """
+        The time a connection spends in each state is recorded, up to the
+        moment the statistics are taken.
+        """
+        self.pair.clock.advance(5)
+        stats = self.client.statistics()
+        self.assertApproximates(stats.stateTime['established'], 5, 0.01)
+        self.assertIn('synSent', stats.stateTime)
+        self.client.loseConnection()
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        self.pair.clock.advance(2)
+        stats = self.client.statistics()
+        self.assertApproximates(stats.stateTime['established'], 5, 0.01)
+        self.assertApproximates(stats.stateTime['finWait1'], 2, 0.01)
+
+
+    def test_windows(self):
+        """
+        The statistics of a connection include its current windows and round
+        trip time.
+        """
+        stats = self.client.statistics()
+        self.assertEqual(stats.connections, 1)
+        self.assertEqual(stats.congestionWindow, self.client.congestion.cwnd)
+        self.assertEqual(stats.sendWindow, self.client.sendWindow)
+        self.assertEqual(stats.receiveWindow,
+                         self.client._advertisedEdge -
+                         self.client.nextRecvSeqNum)
+        self.assertEqual(stats.smoothedRTT, self.client.smoothedRTT)
+
+
+    def test_merge(self):
+        """
+        Merging statistics adds up their counters, and keeps the extremes of
+        their round trip times.
+        """
+        one = ptcp.PTCPStatistics()
+        one.segmentsSent = 3
+        one.measuredRTT(0.5)
+        one.stateTime['established'] = 1.0
+        two = ptcp.PTCPStatistics()
+        two.segmentsSent = 4
+        two.measuredRTT(0.25)
+        two.measuredRTT(2.0)
+        two.stateTime['established'] = 2.0
+        two.stateTime['closed'] = 3.0
+        two.smoothedRTT = 1.0
+        one.merge(two)
+        self.assertEqual(one.segmentsSent, 7)
+        self.assertEqual(one.rttSamples, 3)
+        self.assertEqual((one.minRTT, one.maxRTT), (0.25, 2.0))
+        self.assertEqual(one.meanRTT, 2.75 / 3)
+        self.assertEqual(one.stateTime, {'established': 3.0, 'closed': 3.0})
+        self.assertIdentical(one.smoothedRTT, None)
+        self.assertIdentical(ptcp.PTCPStatistics().meanRTT, None)
+
+
+    def test_port(self):
+        """
+        L{ptcp.PTCP.statistics} covers every connection over the port, even
+        once they have closed, but only counts the windows of open ones.
+        """
+        port = ptcp.PTCP(protocol.ServerFactory())
+        port.startProtocol()
+        port._connections[(8, 1, None)] = self.server
+        port._connections[(1, 8, self.pair.serverAddress)] = self.client
+        stats = port.statistics()
+        self.assertEqual(stats.connections, 2)
+        self.assertEqual(stats.segmentsSent,
+                         self.client.stats.segmentsSent +
+                         self.server.stats.segmentsSent)
+        self.assertEqual(stats.congestionWindow,
+                         self.client.congestion.cwnd +
+                         self.server.congestion.cwnd)
+        port.connectionClosed(self.client)
+        stats = port.statistics()
+        self.assertEqual(stats.connections, 2)
+        self.assertEqual(stats.congestionWindow, self.server.congestion.cwnd)
+
+
+    def test_tracer(self):
+        """
+        The port's tracer, if it has one, is told about every segment sent,
+        retransmitted and received, and every change of state.
+        """
+        events = []
+        self.pair.clientPTCP.tracer = lambda conn, event, detail: (
+            events.append((conn, event, detail)))
+        self.client.write('x')
+        self.pair.clock.advance(ptcp.SEND_DELAY)
+        [sent] = self.pair.clientPTCP.take()
+        self.pair.clock.advance(self.client._retransmitTimeout)
+        self.pair.clientPTCP.take()
+        self.pair.deliver([sent], self.server)
+        self.pair.clock.advance(ptcp.ACK_DELAY)
+        self.pair.deliver(self.pair.serverPTCP.take(), self.client)
+        self.client.loseConnection()
+        self.assertEqual(
+            [(conn, event) for (conn, event, detail) in events],
+            [(self.client, 'send'), (self.client, 'retransmit'),
+             (self.client, 'receive'), (self.client, 'state'),
+             (self.client, 'send')])
+        self.assertIdentical(events[0][2], sent)
+        self.assertEqual(events[3][2], 'finWait1')
+
+
+
+class SendBufferTests(unittest.TestCase):
+    """
+    Tests for L{ptcp._SendBuffer}.
+    """
+
+    def test_empty(self):
+        """
+        A new buffer is empty, and reading from it gives nothing.
+        """
+        buf = ptcp._SendBuffer()
+        self.assertEqual(len(buf), 0)
+        self.assertFalse(buf)
+        self.assertEqual(buf.read(10), '')
+
+
+    def test_readAcrossChunks(self):
+        """
+        Reads take data from the front of the buffer, spanning as many of the
+        written strings as necessary.
+        """
+        buf = ptcp._SendBuffer()
+        buf.append('abc')
+        buf.append('')
+        buf.extend(['defg', 'h'])
+        self.assertEqual(len(buf), 8)
+        self.assertEqual(buf.read(2), 'ab')
+        self.assertEqual(buf.read(3), 'cde')
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.read(10), 'fgh')
+        self.assertEqual(len(buf), 0)
+
+
+    def test_wholeChunk(self):
+        """
+        Reading exactly one whole written string gives back that string,
+        rather than a copy of it.
+        """
+        data = 'x' * 100
+        buf = ptcp._SendBuffer()
+        buf.append(data)
+        buf.append('y')
+        self.assertIdentical(buf.read(100), data)
+
+
+
+class WriteTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCPConnection} turns written data into
+    segments.
+    """
+
+    def test_writeSequence(self):
+        """
+        Strings passed to C{writeSequence} are sent in order, in full
+        segments spanning the boundaries between them.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        data = ['a' * (client.mtu // 2), 'b' * client.mtu,
+                'c' * (client.mtu // 2)]
+        client.writeSequence(data)
+        pair.clock.advance(ptcp.SEND_DELAY)
+        sent = pair.clientPTCP.take()
+        self.assertEqual([p.dlen for p in sent],
+                         [client.mtu, len(''.join(data)) - client.mtu])
+        pair.deliver(sent, pair.server)
+        self.assertEqual(''.join(pair.serverProtocol.received), ''.join(data))
+        self.assertEqual(len(client._outgoingBytes), 0)
+
+
+    def test_largeWrite(self):
+        """
+        A write much larger than the congestion window is sent a window at a
+        time, in order.
+        """
+        pair = ConnectionPair(self)
+        client = pair.client
+        data = ''.join(chr(i % 256) for i in range(client.mtu * 50))
+        client.write(data)
+        for i in range(100):
+            pair.pump()
+            pair.clock.advance(0.1)
+        self.assertEqual(''.join(pair.serverProtocol.received), data)
+
+
+
+class TimerWheelTests(unittest.TestCase):
+    """
+    Tests for L{ptcp._TimerWheel}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.wheel = ptcp._TimerWheel(tick=0.01, slots=8)
+        self.calls = []
+
+
+    def schedule(self, delay, name):
+        return self.wheel.callLater(delay, self.calls.append, name)
+
+
+    def test_oneReactorCall(self):
+        """
+        However many timers are scheduled, the reactor only has one call
+        pending, for the earliest of them, and each timer is called at its
+        own deadline.
+        """
+        self.schedule(0.5, 'c')
+        self.schedule(0.001, 'a')
+        self.schedule(0.025, 'b')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 0.001)
+        self.clock.advance(0.001)
+        self.assertEqual(self.calls, ['a'])
+        self.clock.advance(0.02)
+        self.assertEqual(self.calls, ['a'])
+        self.clock.advance(0.004)
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.wheel), 0)
+
+
+    def test_dueTogether(self):
+        """
+        All of the timers due by the time the wheel runs are called, in order
+        of deadline.
+        """
+        self.schedule(0.3, 'c')
+        self.schedule(0.1, 'a')
+        self.schedule(0.2, 'b')
+        self.clock.pump([1])
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+
+
+    def test_scheduledByCall(self):
+        """
+        A timer scheduled by a call the wheel makes does not delay timers
+        which were already waiting.
+        """
+        self.schedule(0.05, 'b')
+        self.wheel.callLater(0.01, self.schedule, 0.1, 'c')
+        self.clock.advance(0.01)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 0.05)
+        self.clock.advance(0.04)
+        self.assertEqual(self.calls, ['b'])
+        self.clock.advance(0.06)
+        self.assertEqual(self.calls, ['b', 'c'])
+
+
+    def test_beyondOneRevolution(self):
+        """
+        Timers further away than the wheel's circumference are not called
+        early.
+        """
+        self.schedule(0.5, 'far')
+        self.schedule(0.01, 'near')
+        self.clock.advance(0.01)
+        self.assertEqual(self.calls, ['near'])
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(), 0.5)
+        self.clock.advance(0.48)
+        self.assertEqual(self.calls, ['near'])
+        self.clock.advance(0.01)
+        self.assertEqual(self.calls, ['near', 'far'])
+
+
+    def test_cancel(self):
+        """
+        Cancelled timers are not called, and once none are left the reactor
+        call is cancelled too.
+        """
+        a = self.schedule(0.1, 'a')
+        b = self.schedule(0.2, 'b')
+        a.cancel()
+        self.assertFalse(a.active())
+        self.assertRaises(error.AlreadyCancelled, a.cancel)
+        self.clock.advance(0.1)
+        self.assertEqual(self.calls, [])
+        b.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_reset(self):
+        """
+        A timer can be moved earlier or later.
+        """
+        a = self.schedule(0.5, 'a')
+        a.reset(0.05)
+        self.clock.advance(0.05)
+        self.assertEqual(self.calls, ['a'])
+        self.assertRaises(error.AlreadyCalled, a.reset, 1)
+        b = self.schedule(0.01, 'b')
+        b.reset(0.2)
+        self.clock.advance(0.1)
+        self.assertEqual(self.calls, ['a'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.calls, ['a', 'b'])
+
+
+    def test_cancelledByEarlierCall(self):
+        """
+        A call which is due, but cancelled by an earlier call which was due at
+        the same time, is not made.
+        """
+        later = self.wheel.callLater(0.2, self.calls.append, 'later')
+        self.wheel.callLater(0.1, later.cancel)
+        self.clock.advance(1)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(len(self.wheel), 0)
+
+
+    def test_error(self):
+        """
+        An exception raised by one call is logged, and the calls after it are
+        still made.
+        """
+        self.wheel.callLater(0.1, lambda: 1 // 0)
+        self.schedule(0.1, 'a')
+        self.clock.advance(0.1)
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+
+class RecordingTransport(object):
+    """
+    A UDP transport which records what is written to it.
+
+    @ivar written: the (datagram, address) pairs passed to C{write}.
+    @ivar batches: the lists of (datagram, address) pairs passed to
+        C{writeBatch}.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.batches = []
+
+
+    def write(self, datagram, addr):
+        self.written.append((datagram, addr))
+
+
+
+class BatchingTransport(RecordingTransport):
+    """
+    A L{RecordingTransport} which can write datagrams in batches.
+    """
+
+    def writeBatch(self, datagrams):
+        self.batches.append(list(datagrams))
+
+
+
+class OutgoingTests(unittest.TestCase):
+    """
+    Tests for the way L{ptcp.PTCP} writes packets to its transport.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.ptcp = ptcp.PTCP(None)
+        self.packets = [
+            ptcp.PTCPPacket.create(1, 2, seq, 0, 'x', ack=True,
+                                   destination=('10.0.0.1', 1234))
+            for seq in range(3)]
+
+
+    def test_batched(self):
+        """
+        Packets sent during one reactor iteration are written to a transport
+        which supports it in a single batch, at the next iteration.
+        """
+        transport = BatchingTransport()
+        self.ptcp.makeConnection(transport)
+        for packet in self.packets:
+            self.ptcp.sendPacket(packet)
+        self.assertEqual(transport.batches, [])
+        self.clock.advance(0)
+        self.assertEqual(
+            transport.batches,
+            [[(packet.encode(), ('10.0.0.1', 1234))
+              for packet in self.packets]])
+        self.assertEqual(transport.written, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_unbatched(self):
+        """
+        Transports without C{writeBatch} are written to one datagram at a
+        time, as each packet is sent.
+        """
+        transport = RecordingTransport()
+        self.ptcp.makeConnection(transport)
+        for packet in self.packets:
+            self.ptcp.sendPacket(packet)
+        self.assertEqual(
+            transport.written,
+            [(packet.encode(), ('10.0.0.1', 1234))
+             for packet in self.packets])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_unbatchedFailure(self):
+        """
+        A datagram which cannot be written is logged and dropped, and does
+        not stop the next being written.
+        """
+        transport = RecordingTransport()
+        self.ptcp.makeConnection(transport)
+        def failingWrite(datagram, addr):
+            transport.write = RecordingTransport.write.__get__(transport)
+            raise socket.error(errno.EPERM, 'Operation not permitted')
+        transport.write = failingWrite
+        for packet in self.packets[:2]:
+            self.ptcp.sendPacket(packet)
+        self.assertEqual(transport.written,
+                         [(self.packets[1].encode(), ('10.0.0.1', 1234))])
+        self.assertEqual(len(self.flushLoggedErrors(socket.error)), 1)
+
+
+    def test_encodedWhenSent(self):
+        """
+        A packet changed after it is sent, but before the datagrams are
+        written, is written as it was when it was sent.
+        """
+        transport = BatchingTransport()
+        self.ptcp.makeConnection(transport)
+        packet = self.packets[0]
+        expected = packet.encode()
+        self.ptcp.sendPacket(packet)
+        packet.ackNum = 100
+        self.clock.advance(0)
+        self.assertEqual(transport.batches, [[(expected, ('10.0.0.1', 1234))]])
+
+
+    def test_flushedWhenStopped(self):
+        """
+        Packets still waiting to be written when the port is stopped are
+        written first.
+        """
+        transport = BatchingTransport()
+        transport.stopListening = lambda: None
+        self.ptcp.makeConnection(transport)
+        self.ptcp.sendPacket(self.packets[0])
+        self.ptcp._stop()
+        self.assertEqual(len(transport.batches), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_droppedWhenTransportGone(self):
+        """
+        Packets still waiting when the transport goes away are discarded.
+        """
+        transport = BatchingTransport()
+        self.ptcp.makeConnection(transport)
+        self.ptcp.sendPacket(self.packets[0])
+        self.ptcp.doStop()
+        self.assertEqual(transport.batches, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
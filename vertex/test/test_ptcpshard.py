@@ -0,0 +1,242 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{vertex.ptcpshard}.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+
+from twisted.internet import reactor, protocol, defer, task
+from twisted.trial import unittest
+
+from vertex import ptcp, ptcpshard, udpbatch
+
+
+
+class RecordingTransport(object):
+    """
+    A datagram transport which remembers what is written to it, or fails.
+    """
+
+    def __init__(self, fail=False):
+        self.written = []
+        self.fail = fail
+
+
+    def write(self, datagram, addr):
+        if self.fail:
+            raise socket.error(2, 'No such file or directory')
+        self.written.append((datagram, addr))
+
+
+
+class RecordingPTCP(object):
+    """
+    A stand-in for L{ptcp.PTCP} which remembers the datagrams it is given.
+    """
+
+    def __init__(self):
+        self.received = []
+
+
+    def datagramReceived(self, datagram, addr):
+        self.received.append((datagram, addr))
+
+
+
+class ShardBusTests(unittest.TestCase):
+    """
+    Tests for L{ptcpshard.ShardBus}.
+    """
+
+    def test_owner(self):
+        """
+        Each pseudo-port is owned by one shard, in turn, and each shard has
+        its own socket.
+        """
+        bus = ptcpshard.ShardBus(None, 1, 3, '/tmp/shard-%d')
+        self.assertEqual([bus.owner(port) for port in range(8, 14)],
+                         [2, 0, 1, 2, 0, 1])
+        self.assertEqual(bus.pathFor(2), '/tmp/shard-2')
+        self.assertRaises(ValueError, ptcpshard.ShardBus, None, 3, 3, '%d')
+
+
+    def test_roundTrip(self):
+        """
+        A datagram passed on by one worker reaches the other's PTCP port as
+        though it had come straight from its peer.
+        """
+        sender = ptcpshard.ShardBus(None, 0, 2, 'shard-%d')
+        sender.transport = RecordingTransport()
+        sender.forward(1, 'datagram', ('10.0.0.1', 4321))
+        [(message, path)] = sender.transport.written
+        self.assertEqual(path, 'shard-1')
+        self.assertEqual(sender.forwarded, 1)
+        receiver = ptcpshard.ShardBus(RecordingPTCP(), 1, 2, 'shard-%d')
+        receiver.datagramReceived(message, 'shard-0')
+        self.assertEqual(receiver.ptcp.received,
+                         [('datagram', ('10.0.0.1', 4321))])
+        self.assertEqual(receiver.received, 1)
+
+
+    def test_roundTripIPv6(self):
+        """
+        An IPv6 address, with its flow information and scope ID, survives
+        being passed between workers.
+        """
+        sender = ptcpshard.ShardBus(None, 0, 2, 'shard-%d')
+        sender.transport = RecordingTransport()
+        addr = ('fe80::1', 4321, 0, 2)
+        sender.forward(1, 'datagram', addr)
+        [(message, path)] = sender.transport.written
+        receiver = ptcpshard.ShardBus(RecordingPTCP(), 1, 2, 'shard-%d')
+        receiver.datagramReceived(message, 'shard-0')
+        self.assertEqual(receiver.ptcp.received, [('datagram', addr)])
+
+
+    def test_workerMissing(self):
+        """
+        Datagrams for a worker which is not running are dropped.
+        """
+        bus = ptcpshard.ShardBus(None, 0, 2, 'shard-%d')
+        bus.transport = RecordingTransport(fail=True)
+        bus.forward(1, 'datagram', ('10.0.0.1', 4321))
+        self.assertEqual((bus.forwarded, bus.dropped), (0, 1))
+
+
+
+class ShardedPTCPTests(unittest.TestCase):
+    """
+    Tests for a L{ptcp.PTCP} port which owns one shard of the connections
+    over its UDP port.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(ptcp, 'reactor', self.clock)
+        self.ptcp = ptcp.PTCP(None)
+        self.ptcp.makeConnection(RecordingTransport())
+        self.bus = ptcpshard.ShardBus(self.ptcp, 1, 4, 'shard-%d')
+        self.bus.transport = RecordingTransport()
+        self.ptcp.shard = self.bus
+
+
+    def test_allocation(self):
+        """
+        Connections are only opened from pseudo-ports the shard owns.
+        """
+        factory = protocol.ClientFactory()
+        factory.protocol = protocol.Protocol
+        ports = [self.ptcp.connect(factory, '10.0.0.2', 1234).hostPseudoPort
+                 for i in range(10)]
+        self.assertEqual(len(set(ports)), 10)
+        self.assertEqual([port % 4 for port in ports], [1] * 10)
+
+
+    def test_forwarding(self):
+        """
+        Datagrams for pseudo-ports other shards own are passed on to them
+        untouched; those for pseudo-ports this shard owns, and for
+        pseudo-port 1, are handled here.
+        """
+        handled = []
+        self.patch(self.ptcp, 'packetReceived', handled.append)
+        addr = ('10.0.0.2', 1234)
+        for destination in [1, 9, 10, 12]:
+            packet = ptcp.PTCPPacket.create(100, destination, 0, 0, 'x')
+            self.ptcp.datagramReceived(packet.encode(), addr)
+        self.assertEqual([received.destPseudoPort for received in handled],
+                         [1, 9])
+        self.assertEqual(
+            [(path, message[-1]) for (message, path)
+             in self.bus.transport.written],
+            [('shard-2', 'x'), ('shard-0', 'x')])
+
+
+
+class CollectingProtocol(protocol.Protocol):
+    """
+    A protocol which fires a L{Deferred} with the first data it receives.
+    """
+
+    def __init__(self, received):
+        self.received = received
+
+
+    def dataReceived(self, data):
+        # Let the connection finish handling the segment first, in case the
+        # test is torn down straight away.
+        reactor.callLater(0, self.received.pop(0).callback, data)
+
+
+
+class GreetingProtocol(protocol.Protocol):
+    """
+    A protocol which says hello as soon as it is connected.
+    """
+
+    def connectionMade(self):
+        self.transport.write('hello')
+
+
+
+class ShardedPortTests(unittest.TestCase):
+    """
+    Tests for L{ptcpshard.listenSharded}, with two workers in this process
+    sharing a port on the loopback interface.
+    """
+
+    def setUp(self):
+        if not udpbatch.reusePortSupported():
+            raise unittest.SkipTest("SO_REUSEPORT is not supported")
+        self.received = [defer.Deferred() for i in range(2)]
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = lambda: CollectingProtocol(self.received)
+        self.server = ptcp.PTCP(serverFactory)
+        self.serverPort = reactor.listenUDP(0, self.server,
+                                            interface='127.0.0.1')
+        # Unix socket paths must be short, so not under the trial directory.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'shard-%d')
+        self.workers = []
+        portNum = 0
+        for index in range(2):
+            worker = ptcp.PTCP(serverFactory)
+            port = ptcpshard.listenSharded(portNum, worker, index, 2, path,
+                                           interface='127.0.0.1')
+            portNum = port.getHost().port
+            self.workers.append((worker, port))
+
+
+    def tearDown(self):
+        dl = [self.server.cleanupAndClose()]
+        for worker, port in self.workers:
+            dl.append(worker.cleanupAndClose())
+        return defer.gatherResults(dl)
+
+
+    def test_connections(self):
+        """
+        Each worker can open connections, even though the replies to one of
+        them are delivered to the other, which passes them on.
+        """
+        factory = protocol.ClientFactory()
+        factory.protocol = GreetingProtocol
+        serverPortNum = self.serverPort.getHost().port
+        for worker, port in self.workers:
+            worker.connect(factory, '127.0.0.1', serverPortNum)
+        def received(result):
+            self.assertEqual(result, ['hello', 'hello'])
+            # Acknowledgements of the greetings may still be on their way
+            # between the workers, so only those which opened the
+            # connections can be counted on.
+            shards = [worker.shard for worker, port in self.workers]
+            self.assertEqual([shard.dropped for shard in shards], [0, 0])
+            self.assertTrue(sum([shard.forwarded for shard in shards]))
+            self.assertTrue(sum([shard.received for shard in shards]))
+        return defer.gatherResults(self.received).addCallback(received)
@@ -4,6 +4,10 @@
 """
 Tests for L{vertex.q2q}.
 """
+import os
+import shutil
+import tempfile
+
 from pretend import call
 
 from cStringIO import StringIO
@@ -12,7 +16,8 @@ from twisted.trial import unittest
 from twisted.application import service
 from twisted.cred.error import UnauthorizedLogin
 from twisted.internet import reactor, protocol, defer
-from twisted.internet.task import deferLater
+from twisted.internet.task import deferLater, Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.internet.ssl import DistinguishedName, PrivateCertificate, KeyPair
 from twisted.protocols import basic
 from twisted.python import log
@@ -24,7 +29,8 @@ from zope.interface import implements
 from zope.interface.verify import verifyObject
 from twisted.internet.interfaces import IResolverSimple
 
-from twisted.protocols.amp import UnknownRemoteError, QuitBox, Command, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, QuitBox, Command, AMP, MAX_VALUE_LENGTH)
 
 import txscrypt
 
@@ -34,6 +40,11 @@ from ._fakes import (_makeStubTxscrypt,
 
 from vertex import q2q
 from vertex import ivertex
+from vertex import subproducer
+from vertex import udpbatch
+from vertex.command import (
+    Write, Close, Choke, Unchoke, WindowUpdate, DataFrame)
+from vertex.exceptions import FlowControlError
 
 
 def noResources(*a):
@@ -101,6 +112,44 @@ class Utility(unittest.TestCase):
         cert = svc.certificateStorage.getPrivateCertificate("test.domain")
         self.failUnless(cert.getPublicKey().matches(cert.privateKey))
 
+    def startedService(self, **kw):
+        """
+        Start a L{q2q.Q2QService} on the loopback interface, to be stopped
+        when the test is done.
+        """
+        svc = q2q.Q2QService(noResources, q2qPortnum=None,
+                             publicIP='127.0.0.1', **kw)
+        svc.startService()
+        self.addCleanup(svc.stopService)
+        return svc
+
+    def test_ptcpOptions(self):
+        """
+        The options for the PTCP ports are passed on to the dispatcher which
+        binds them.
+        """
+        svc = self.startedService(batchedIO=True, ptcpChecksums=False)
+        self.assertTrue(svc.dispatcher.batchedIO)
+        self.assertFalse(svc.dispatcher.checksums)
+        [(port, proto)] = svc.dispatcher._ports.values()
+        self.assertIsInstance(port, udpbatch.BatchedPort)
+        self.assertFalse(proto.checksums)
+
+    def test_udpShard(self):
+        """
+        With C{udpShard}, the shared UDP port is bound as one shard of a
+        port shared with other processes.
+        """
+        if not udpbatch.reusePortSupported():
+            raise unittest.SkipTest("SO_REUSEPORT is not supported")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        svc = self.startedService(
+            udpShard=(0, 0, 1, os.path.join(directory, 'shard-%d')))
+        [(port, proto)] = svc.dispatcher._ports.values()
+        self.assertEqual(port.getHost().port, svc.sharedUDPPortnum)
+        self.assertEqual((proto.shard.index, proto.shard.count), (0, 1))
+
 class OneTrickPony(AMP):
     def amp_TRICK(self, box):
         return QuitBox(tricked='True')
@@ -749,6 +798,516 @@ class VirtualConnection(Q2QConnectionTestCase, ConnectionTestMixin):
     testListening.skip = 'virtual port forwarding not implemented'
     testChooserGetsThreeChoices.skip = 'cant do this without testListening'
 
+
+
+class FakeQ2Q(subproducer.SuperProducer):
+    """
+    A stand-in for L{q2q.Q2Q} which remembers the commands it is asked to
+    send, and answers them all at once.
+    """
+
+    def __init__(self):
+        subproducer.SuperProducer.__init__(self)
+        self.transport = StringTransport()
+        self.connections = {}
+        self.commands = []
+
+
+    def callRemote(self, command, **kw):
+        self.commands.append((command, kw))
+        return defer.succeed({})
+
+
+    def sendData(self, id, data):
+        self.commands.append((DataFrame, dict(id=id, data=data)))
+
+
+
+class RecordingProtocol(protocol.Protocol):
+    """
+    A protocol which remembers what it receives, and why it was disconnected.
+    """
+
+    def __init__(self):
+        self.received = []
+        self.reason = None
+
+
+    def dataReceived(self, data):
+        self.received.append(data)
+
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+
+class RecordingProducer(object):
+    """
+    A producer which remembers whether it is paused.
+    """
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+    def stopProducing(self):
+        pass
+
+
+
+class VirtualTransportTestCase(unittest.TestCase):
+    """
+    A L{q2q.VirtualTransport} over a L{FakeQ2Q}, for tests to try out.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(q2q, 'reactor', self.clock)
+        self.patch(q2q.VirtualTransport, 'receiveWindow', 10)
+        self.patch(q2q.VirtualTransport, 'writeBufferLimit', 10)
+        self.q2q = FakeQ2Q()
+        factory = protocol.Factory()
+        factory.protocol = RecordingProtocol
+        self.transport = q2q.VirtualTransport(self.q2q, 1, factory, False)
+        self.protocol = self.transport.startProtocol()
+
+
+    def sent(self, command):
+        """
+        Forget the commands sent so far.
+
+        @return: the arguments of those of the given type.
+        """
+        sent = [kw for (c, kw) in self.q2q.commands if c is command]
+        del self.q2q.commands[:]
+        return sent
+
+
+
+class VirtualFlowControlTests(VirtualTransportTestCase):
+    """
+    Tests for the credit windows of L{q2q.VirtualTransport}.
+    """
+
+    def setUp(self):
+        VirtualTransportTestCase.setUp(self)
+        self.transport.setTcpNoDelay(True)
+
+
+    def test_sendCredit(self):
+        """
+        No more is sent than the peer has granted credit for; the rest is
+        sent as it grants more.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.write('x' * 25)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='x' * 10)])
+        self.transport.windowUpdate(10)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='x' * 10)])
+        self.transport.windowUpdate(10)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='x' * 5)])
+        self.transport.write('y' * 5)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='y' * 5)])
+
+
+    def test_largeWrite(self):
+        """
+        Writes larger than an AMP value can hold are split up.
+        """
+        self.transport.startFlowControl(2 ** 20)
+        self.transport.write('x' * (MAX_VALUE_LENGTH + 1))
+        self.assertEqual([len(kw['body']) for kw in self.sent(Write)],
+                         [MAX_VALUE_LENGTH, 1])
+
+
+    def test_writeBufferLimit(self):
+        """
+        A producer is paused while more than C{writeBufferLimit} octets are
+        waiting for credit, and resumed once they have all been sent.
+        """
+        self.transport.startFlowControl(10)
+        producer = RecordingProducer()
+        self.transport.registerProducer(producer, True)
+        self.transport.write('x' * 10)
+        self.transport.write('x' * 10)
+        self.assertFalse(producer.paused)
+        self.transport.write('x')
+        self.assertTrue(producer.paused)
+        self.transport.windowUpdate(10)
+        self.assertTrue(producer.paused)
+        self.transport.windowUpdate(10)
+        self.assertFalse(producer.paused)
+        self.assertEqual(self.sent(Choke), [])
+
+
+    def test_grantCredit(self):
+        """
+        Data is delivered as it arrives, and credit granted for it once half
+        the window has been delivered.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.dataReceived('abc')
+        self.assertEqual(self.sent(WindowUpdate), [])
+        self.transport.dataReceived('defgh')
+        self.assertEqual(self.protocol.received, ['abc', 'defgh'])
+        self.assertEqual(self.sent(WindowUpdate), [dict(id=1, credit=8)])
+        self.transport.dataReceived('x' * 10)
+        self.assertEqual(self.sent(WindowUpdate), [dict(id=1, credit=10)])
+
+
+    def test_pauseReading(self):
+        """
+        While the protocol has paused its transport, data is held back, and
+        no credit is granted for it.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.pauseProducing()
+        self.transport.dataReceived('abcdef')
+        self.assertEqual(self.protocol.received, [])
+        self.transport.resumeProducing()
+        self.assertEqual(self.protocol.received, ['abcdef'])
+        self.assertEqual(self.sent(WindowUpdate), [dict(id=1, credit=6)])
+        self.assertEqual(self.sent(Choke) + self.sent(Unchoke), [])
+
+
+    def test_overrun(self):
+        """
+        A peer which sends more than its window is disconnected.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.pauseProducing()
+        self.transport.dataReceived('x' * 6)
+        self.transport.dataReceived('x' * 5)
+        self.assertEqual(self.sent(Close), [dict(id=1)])
+        self.assertNotIn(1, self.q2q.connections)
+        self.assertEqual(self.protocol.received, [])
+        self.protocol.reason.trap(FlowControlError)
+
+
+    def test_closedWhilePaused(self):
+        """
+        If the peer closes the connection while the protocol has paused its
+        transport, the protocol still receives what was sent before it hears
+        that the connection was lost.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.pauseProducing()
+        self.transport.dataReceived('abc')
+        self.transport.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertIdentical(self.protocol.reason, None)
+        self.transport.resumeProducing()
+        self.assertEqual(self.protocol.received, ['abc'])
+        self.protocol.reason.trap(ConnectionDone)
+
+
+    def test_closeAfterSending(self):
+        """
+        Closing the connection waits for everything written to be sent.
+        """
+        self.transport.startFlowControl(10)
+        self.transport.write('x' * 15)
+        self.transport.loseConnection()
+        self.assertEqual(self.sent(Close), [])
+        self.transport.windowUpdate(10)
+        self.assertEqual(self.q2q.commands,
+                         [(Write, dict(id=1, body='x' * 5)),
+                          (Close, dict(id=1))])
+        self.protocol.reason.trap(ConnectionDone)
+
+
+    def test_binaryFrames(self):
+        """
+        Once the peer has agreed to them, data is sent in L{DataFrame}s.
+        """
+        self.transport.binaryFrames = True
+        self.transport.write('abc')
+        self.transport.startFlowControl(10)
+        self.transport.write('x' * 15)
+        self.assertEqual(self.sent(DataFrame),
+                         [dict(id=1, data='abc'), dict(id=1, data='x' * 10)])
+        self.assertEqual(self.sent(Write), [])
+
+
+    def test_withoutFlowControl(self):
+        """
+        Without credit windows, everything written is sent at once, and the
+        peer is choked when the protocol pauses its transport.
+        """
+        self.transport.write('x' * 25)
+        self.transport.pauseProducing()
+        self.transport.resumeProducing()
+        self.assertEqual(self.q2q.commands,
+                         [(Write, dict(id=1, body='x' * 25)),
+                          (Choke, dict(id=1)),
+                          (Unchoke, dict(id=1))])
+
+
+
+class VirtualCoalescingTests(VirtualTransportTestCase):
+    """
+    Tests for how L{q2q.VirtualTransport} coalesces writes.
+    """
+
+    def test_coalesce(self):
+        """
+        Writes are sent together once the reactor is done with whatever
+        made them.
+        """
+        self.transport.write('abc')
+        self.transport.writeSequence(['de', 'f'])
+        self.transport.write('')
+        self.assertEqual(self.sent(Write), [])
+        self.clock.advance(0)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='abcdef')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_coalesceSize(self):
+        """
+        Once C{coalesceSize} octets have been written, they are sent at once.
+        """
+        self.transport.coalesceSize = 10
+        self.transport.write('x' * 6)
+        self.transport.write('y' * 6)
+        self.assertEqual(self.sent(Write),
+                         [dict(id=1, body='x' * 6 + 'y' * 6)])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_large(self):
+        """
+        Coalesced writes too large for one L{Write} are split up.
+        """
+        self.transport.write('x' * MAX_VALUE_LENGTH)
+        self.transport.write('x')
+        self.clock.advance(0)
+        self.assertEqual([len(kw['body']) for kw in self.sent(Write)],
+                         [MAX_VALUE_LENGTH, 1])
+
+
+    def test_noDelay(self):
+        """
+        With C{setTcpNoDelay}, each write is sent at once, beginning with any
+        which were already waiting.
+        """
+        self.assertFalse(self.transport.getTcpNoDelay())
+        self.transport.write('abc')
+        self.transport.setTcpNoDelay(True)
+        self.assertTrue(self.transport.getTcpNoDelay())
+        self.transport.write('def')
+        self.assertEqual(self.sent(Write),
+                         [dict(id=1, body='abc'), dict(id=1, body='def')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_writeSequence(self):
+        """
+        The pieces given to C{writeSequence} are coalesced as they are,
+        without being joined until they are sent; with C{setTcpNoDelay}, they
+        are sent at once, together.
+        """
+        pieces = ['de', 'f']
+        self.transport.write('abc')
+        self.transport.writeSequence(pieces)
+        self.assertEqual(self.transport._coalesced, ['abc', 'de', 'f'])
+        self.transport.writeSequence([])
+        self.clock.advance(0)
+        self.transport.setTcpNoDelay(True)
+        self.transport.writeSequence(iter(pieces))
+        self.assertEqual(self.sent(Write),
+                         [dict(id=1, body='abcdef'), dict(id=1, body='def')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_flowControlled(self):
+        """
+        Coalesced writes are sent as credit allows.
+        """
+        self.transport.startFlowControl(4)
+        self.transport.write('abc')
+        self.transport.write('def')
+        self.clock.advance(0)
+        self.assertEqual(self.sent(Write), [dict(id=1, body='abcd')])
+
+
+    def test_loseConnection(self):
+        """
+        Closing the connection sends any writes waiting to be coalesced
+        first.
+        """
+        self.transport.write('abc')
+        self.transport.loseConnection()
+        self.assertEqual(self.q2q.commands,
+                         [(Write, dict(id=1, body='abc')),
+                          (Close, dict(id=1))])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_connectionLost(self):
+        """
+        Writes waiting to be coalesced when the connection is lost are
+        dropped.
+        """
+        self.transport.write('abc')
+        self.transport.connectionLost(failure.Failure(ConnectionDone()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.q2q.commands, [])
+
+
+
+class VirtualSchedulingTests(VirtualTransportTestCase):
+    """
+    Tests for how L{q2q.VirtualTransport} takes its turn sending over the
+    Q2Q connection.
+    """
+
+    def test_paused(self):
+        """
+        While the Q2Q connection is paused, data and the L{Close} after it
+        wait their turn.
+        """
+        self.transport.setTcpNoDelay(True)
+        self.q2q.pauseProducing()
+        self.transport.write('abc')
+        self.transport.loseConnection()
+        self.assertEqual(self.q2q.commands, [])
+        self.q2q.resumeProducing()
+        self.assertEqual(self.q2q.commands,
+                         [(Write, dict(id=1, body='abc')),
+                          (Close, dict(id=1))])
+
+
+    def test_connectionLost(self):
+        """
+        What is waiting for its turn when the connection is lost is dropped.
+        """
+        self.transport.setTcpNoDelay(True)
+        self.q2q.pauseProducing()
+        self.transport.write('abc')
+        self.transport.connectionLost(failure.Failure(ConnectionDone()))
+        self.q2q.resumeProducing()
+        self.assertEqual(self.q2q.commands, [])
+
+
+    def test_pullProducer(self):
+        """
+        A producer which is not streaming, like L{basic.FileSender}, is asked
+        for more until it has sent everything.
+        """
+        self.transport.setTcpNoDelay(True)
+        contents = ''.join([chr(i % 256) for i in range(2 ** 20)])
+        sender = basic.FileSender()
+        d = sender.beginFileTransfer(StringIO(contents), self.transport)
+        def finished(ignored):
+            self.assertEqual(
+                ''.join([kw['body'] for kw in self.sent(Write)]), contents)
+        return d.addCallback(finished)
+
+
+
+class RecordingConnection(object):
+    """
+    A stand-in for L{q2q.VirtualTransport} which remembers what it is given.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+
+    def dataReceived(self, data):
+        self.calls.append(('data', data))
+
+
+    def windowUpdate(self, credit):
+        self.calls.append(('credit', credit))
+
+
+
+class DataFrameTests(unittest.TestCase):
+    """
+    Tests for L{DataFrame} and how L{q2q.Q2Q} sends and receives them.
+    """
+
+    def sender(self):
+        """
+        Make a L{q2q.Q2Q} which writes to a L{StringTransport}.
+        """
+        sender = q2q.Q2Q()
+        sender.service = service.Service()
+        sender.service.publicIP = '10.0.0.1'
+        sender.makeConnection(StringTransport())
+        return sender
+
+
+    def test_serialize(self):
+        """
+        A frame is the id of its connection and the length of its data, with
+        a few octets to tell it apart from a box, and then the data.
+        """
+        self.assertEqual(DataFrame(-2, 'hello').serialize(),
+                         '\x00\x05\x00\xff\xff\xff\xfe\x00\x05hello')
+
+
+    def test_roundTrip(self):
+        """
+        Frames and boxes sent over a L{q2q.Q2Q} are received in order, even
+        when they arrive a little at a time.
+        """
+        sender = self.sender()
+        sender.sendData(-3, 'hello')
+        sender.callRemote(WindowUpdate, id=-3, credit=5)
+        sender.sendData(-3, '')
+        sender.sendData(4, 'x' * MAX_VALUE_LENGTH)
+        receiver = self.sender()
+        receiver.connections = {-3: RecordingConnection(),
+                                4: RecordingConnection()}
+        wire = sender.transport.value()
+        for i in range(0, len(wire), 7):
+            receiver.dataReceived(wire[i:i + 7])
+        self.assertEqual(receiver.connections[-3].calls,
+                         [('data', 'hello'), ('credit', 5), ('data', '')])
+        self.assertEqual(receiver.connections[4].calls,
+                         [('data', 'x' * MAX_VALUE_LENGTH)])
+
+
+    def test_closed(self):
+        """
+        Frames for connections which have closed are ignored.
+        """
+        sender = self.sender()
+        sender.sendData(5, 'hello')
+        sender.callRemote(WindowUpdate, id=6, credit=5)
+        receiver = self.sender()
+        receiver.connections = {6: RecordingConnection()}
+        receiver.dataReceived(sender.transport.value())
+        self.assertEqual(receiver.connections[6].calls, [('credit', 5)])
+
+
+    def test_boxParser(self):
+        """
+        L{q2q._checkBoxParser} accepts the L{AMP} box parser which L{q2q.Q2Q}
+        receives frames by overriding, but not one whose private parts
+        differ from those it overrides.
+        """
+        q2q._checkBoxParser(AMP)
+        class Renamed(AMP):
+            _MAX_KEY_LENGTH = None
+        self.assertRaises(ImportError, q2q._checkBoxParser, Renamed)
+        class Unlimited(AMP):
+            MAX_LENGTH = 2 ** 16
+        self.assertRaises(ImportError, q2q._checkBoxParser, Unlimited)
+        class Stateless(AMP):
+            state = None
+        self.assertRaises(ImportError, q2q._checkBoxParser, Stateless)
+
+
+
 class UDPConnection(Q2QConnectionTestCase, ConnectionTestMixin):
     # skip = 'yep'
     inboundTCPPortnum = None
@@ -1,6 +1,9 @@
 
+from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.trial import unittest
 
+from vertex import subproducer
 from vertex.subproducer import SuperProducer, SubProducer
 
 class TestSuper(SuperProducer):
@@ -171,3 +174,240 @@ class SuperProducerTest(unittest.TestCase):
         sup.stopProducing()
         self.assertEquals(tp1.calls, ['stop'])
         self.assertEquals(tp2.calls, ['stop'])
+
+
+
+class SchedulingTests(unittest.TestCase):
+    """
+    Tests for how L{SuperProducer} shares its consumer between its
+    sub-producers.
+    """
+
+    def setUp(self):
+        self.sup = TestSuper()
+        self.sup.quantum = 10
+        self.sent = []
+
+
+    def schedule(self, sub, name, size=10):
+        """
+        Have C{sub} send something called C{name}.
+        """
+        self.sup.schedule(sub, size, lambda: self.sent.append(name))
+
+
+    def test_notPaused(self):
+        """
+        While the consumer is not paused, everything is sent at once.
+        """
+        sub = SubProducer(self.sup)
+        self.schedule(sub, 'a', 100)
+        self.assertEqual(self.sent, ['a'])
+
+
+    def test_paused(self):
+        """
+        While the consumer is paused, what is sent is queued, and sent in
+        order once it resumes.
+        """
+        sub = SubProducer(self.sup)
+        self.sup.pauseProducing()
+        self.schedule(sub, 'a1')
+        self.schedule(sub, 'a2')
+        self.assertEqual(self.sent, [])
+        self.sup.resumeProducing()
+        self.assertEqual(self.sent, ['a1', 'a2'])
+        self.schedule(sub, 'a3')
+        self.assertEqual(self.sent, ['a1', 'a2', 'a3'])
+
+
+    def test_roundRobin(self):
+        """
+        Sub-producers with the same weight take turns.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        self.sup.pauseProducing()
+        for i in range(3):
+            self.schedule(a, 'a')
+        for i in range(3):
+            self.schedule(b, 'b')
+        self.sup.resumeProducing()
+        self.assertEqual(''.join(self.sent), 'ababab')
+
+
+    def test_weights(self):
+        """
+        A sub-producer with a greater weight sends more in each turn.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        b.weight = 3
+        self.sup.pauseProducing()
+        for i in range(3):
+            self.schedule(a, 'a')
+        for i in range(6):
+            self.schedule(b, 'b')
+        self.sup.resumeProducing()
+        self.assertEqual(''.join(self.sent), 'abbbabbba')
+
+
+    def test_deficit(self):
+        """
+        Something larger than the quantum waits for enough turns to have
+        passed; smaller things from others are sent meanwhile.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        self.sup.pauseProducing()
+        self.schedule(a, 'A', 25)
+        for i in range(6):
+            self.schedule(b, 'b', 5)
+        self.sup.resumeProducing()
+        self.assertEqual(''.join(self.sent), 'bbbbAbb')
+
+
+    def test_pausedWhileSending(self):
+        """
+        If the consumer is paused again partway through a turn, that turn
+        carries on where it left off once it resumes.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        self.sup.pauseProducing()
+        self.schedule(a, 'a', 5)
+        self.sup.schedule(a, 0, self.sup.pauseProducing)
+        self.schedule(a, 'a', 5)
+        self.schedule(a, 'a', 5)
+        self.schedule(b, 'b')
+        self.sup.resumeProducing()
+        self.assertEqual(self.sent, ['a'])
+        self.sup.resumeProducing()
+        self.assertEqual(''.join(self.sent), 'aaba')
+
+
+    def test_unschedule(self):
+        """
+        L{SuperProducer.unscheduleFor} drops what a sub-producer has queued.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        self.sup.pauseProducing()
+        self.schedule(a, 'a')
+        self.schedule(b, 'b')
+        self.sup.unscheduleFor(a)
+        self.sup.resumeProducing()
+        self.assertEqual(self.sent, ['b'])
+
+
+    def test_unregister(self):
+        """
+        When the last sub-producer unregisters its producer, the
+        L{SuperProducer} stays registered with its consumer until what is
+        queued has been sent, and then unregisters.
+        """
+        sub = SubProducer(self.sup)
+        sub.registerProducer(TestProducer(), True)
+        self.assertIdentical(self.sup.producer, self.sup)
+        self.assertTrue(self.sup.streamingProducer)
+        self.sup.pauseProducing()
+        self.schedule(sub, 'a')
+        sub.unregisterProducer()
+        self.assertEqual(self.sent, [])
+        self.assertIdentical(self.sup.producer, self.sup)
+        self.sup.resumeProducing()
+        self.assertEqual(self.sent, ['a'])
+        self.assertIdentical(self.sup.producer, None)
+
+
+    def test_withoutProducers(self):
+        """
+        What is sent by sub-producers without producers of their own is
+        shared out by weight too: the L{SuperProducer} registers with its
+        consumer while it has anything to send, so that the consumer can
+        pause it when it is full.
+        """
+        a = SubProducer(self.sup)
+        b = SubProducer(self.sup)
+        b.weight = 2
+        def fill():
+            self.sent.append('a')
+            self.sup.producer.pauseProducing()
+        self.sup.schedule(a, 10, fill)
+        for i in range(3):
+            self.schedule(a, 'a')
+        for i in range(4):
+            self.schedule(b, 'b')
+        self.assertEqual(self.sent, ['a'])
+        self.sup.producer.resumeProducing()
+        self.assertEqual(''.join(self.sent), 'aabbabba')
+        self.assertIdentical(self.sup.producer, None)
+
+
+    def test_idle(self):
+        """
+        The L{SuperProducer} is only registered with its consumer while it
+        has something to send.
+        """
+        sub = SubProducer(self.sup)
+        self.sup.producer = None
+        self.schedule(sub, 'a')
+        self.assertEqual(self.sent, ['a'])
+        self.assertIdentical(self.sup.producer, None)
+
+
+    def test_disconnecting(self):
+        """
+        The L{SuperProducer} does not register with a consumer which has been
+        asked to close its connection.
+        """
+        sub = SubProducer(self.sup)
+        self.sup.producer = None
+        self.sup.disconnecting = True
+        self.schedule(sub, 'a')
+        self.assertEqual(self.sent, ['a'])
+        self.assertIdentical(self.sup.producer, None)
+
+
+    def test_pullProducer(self):
+        """
+        A sub-producer's producer which is not streaming is asked for more
+        each time the reactor comes round, since the consumer will not ask
+        the L{SuperProducer}, which is streaming, for more.
+        """
+        sub = SubProducer(self.sup)
+        producer = TestProducer()
+        d = defer.Deferred()
+        def resumeProducing():
+            producer.calls.append('resume')
+            if len(producer.calls) == 3:
+                sub.unregisterProducer()
+                d.callback(None)
+        producer.resumeProducing = resumeProducing
+        sub.registerProducer(producer, False)
+        self.assertEqual(producer.calls, ['resume'])
+        def finished(ignored):
+            self.assertEqual(producer.calls, ['resume', 'resume', 'resume'])
+            self.assertIdentical(self.sup._pullCall, None)
+            self.assertIdentical(self.sup.producer, None)
+        return d.addCallback(finished)
+
+
+    def test_pausedPullProducer(self):
+        """
+        A producer which is not streaming is not asked for more while the
+        L{SuperProducer} is paused.
+        """
+        clock = Clock()
+        self.patch(subproducer, 'reactor', clock)
+        sub = SubProducer(self.sup)
+        producer = TestProducer()
+        sub.registerProducer(producer, False)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        self.sup.pauseProducing()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.sup.resumeProducing()
+        self.assertEqual(producer.calls, ['resume', 'pause', 'resume'])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        sub.unregisterProducer()
+        self.assertEqual(clock.getDelayedCalls(), [])
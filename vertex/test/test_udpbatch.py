@@ -0,0 +1,200 @@
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+Tests for L{vertex.udpbatch}.
+"""
+
+from twisted.internet import protocol, defer, error
+from twisted.trial import unittest
+
+from vertex import udpbatch
+
+
+
+class CollectingProtocol(protocol.DatagramProtocol):
+    """
+    A protocol which remembers the datagrams it receives, and fires a
+    L{Deferred} once it has received a certain number of them.
+    """
+
+    def __init__(self, expected=0):
+        self.received = []
+        self.expected = expected
+        self.done = defer.Deferred()
+
+
+    def datagramReceived(self, data, addr):
+        self.received.append((data, addr))
+        if len(self.received) == self.expected:
+            self.done.callback(self.received)
+
+
+
+class BatchedPortTests(unittest.TestCase):
+    """
+    Tests for L{udpbatch.BatchedPort}, over the loopback interface.
+    """
+
+    def listen(self, proto):
+        port = udpbatch.listenUDP(0, proto, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port
+
+
+    def sendAndReceive(self, count):
+        """
+        Write C{count} datagrams in one batch from one L{udpbatch.BatchedPort}
+        to another, and check that they all arrive, in order.
+        """
+        receiver = CollectingProtocol(count)
+        sender = CollectingProtocol()
+        receivingPort = self.listen(receiver)
+        sendingPort = self.listen(sender)
+        self.assertIsInstance(sendingPort, udpbatch.BatchedPort)
+        destination = ('127.0.0.1', receivingPort.getHost().port)
+        datagrams = [('datagram %d' % (i,), destination)
+                     for i in range(count)]
+        sendingPort.writeBatch(datagrams)
+        source = ('127.0.0.1', sendingPort.getHost().port)
+        def received(result):
+            self.assertEqual(result, [(data, source)
+                                      for (data, addr) in datagrams])
+        return receiver.done.addCallback(received)
+
+
+    def test_batch(self):
+        """
+        Datagrams written with C{writeBatch} are received, in order, with the
+        address they were sent from.
+        """
+        return self.sendAndReceive(5)
+
+
+    def test_severalBatches(self):
+        """
+        More datagrams than fit in one system call are written in several.
+        """
+        return self.sendAndReceive(udpbatch.BatchedPort.batchSize * 3 + 1)
+
+
+    def test_unsupported(self):
+        """
+        Without C{sendmmsg} and C{recvmmsg}, datagrams are sent and received
+        one at a time.
+        """
+        self.patch(udpbatch, '_sendmmsg', None)
+        self.patch(udpbatch, '_recvmmsg', None)
+        return self.sendAndReceive(udpbatch.BatchedPort.batchSize + 1)
+
+
+    def test_badAddress(self):
+        """
+        A datagram which cannot be sent is logged and dropped, and the
+        datagrams after it are still sent.
+        """
+        receiver = CollectingProtocol(2)
+        receivingPort = self.listen(receiver)
+        sendingPort = self.listen(CollectingProtocol())
+        destination = ('127.0.0.1', receivingPort.getHost().port)
+        sendingPort.writeBatch([('one', destination),
+                                ('two', ('example.com', 1234)),
+                                ('three', destination)])
+        self.assertEqual(
+            len(self.flushLoggedErrors(error.InvalidAddressError)), 1)
+        def received(result):
+            self.assertEqual([data for (data, addr) in result],
+                             ['one', 'three'])
+        return receiver.done.addCallback(received)
+
+
+    def test_otherReactor(self):
+        """
+        L{udpbatch.listenUDP} falls back to the reactor's own C{listenUDP}
+        for reactors which cannot use L{udpbatch.BatchedPort}.
+        """
+        calls = []
+        class OtherReactor(object):
+            def listenUDP(self, *a):
+                calls.append(a)
+                return 'port'
+        proto = CollectingProtocol()
+        self.assertEqual(
+            udpbatch.listenUDP(1234, proto, 'iface', 100, OtherReactor()),
+            'port')
+        self.assertEqual(calls, [(1234, proto, 'iface', 100)])
+        self.assertRaises(
+            error.CannotListenError, udpbatch.listenUDP, 1234, proto,
+            'iface', 100, OtherReactor(), reusePort=True)
+
+
+    def test_reusePort(self):
+        """
+        Ports which set C{SO_REUSEPORT} may share a port number; others may
+        not.
+        """
+        if not udpbatch.reusePortSupported():
+            raise unittest.SkipTest("SO_REUSEPORT is not supported")
+        first = udpbatch.listenUDP(0, CollectingProtocol(),
+                                   interface='127.0.0.1', reusePort=True)
+        self.addCleanup(first.stopListening)
+        portNum = first.getHost().port
+        second = udpbatch.listenUDP(portNum, CollectingProtocol(),
+                                    interface='127.0.0.1', reusePort=True)
+        self.addCleanup(second.stopListening)
+        self.assertEqual(second.getHost().port, portNum)
+        self.assertRaises(error.CannotListenError, udpbatch.listenUDP,
+                          portNum, CollectingProtocol(),
+                          interface='127.0.0.1')
+
+
+    def test_reusePortUnsupported(self):
+        """
+        Asking to share a port on a platform which cannot fails.
+        """
+        self.patch(udpbatch, '_SO_REUSEPORT', None)
+        self.assertFalse(udpbatch.reusePortSupported())
+        self.assertRaises(error.CannotListenError, udpbatch.listenUDP, 0,
+                          CollectingProtocol(), interface='127.0.0.1',
+                          reusePort=True)
+
+
+
+class AddressTests(unittest.TestCase):
+    """
+    Tests for the encoding and decoding of socket addresses.
+    """
+
+    def test_ipv4(self):
+        encoded = udpbatch._encodeAddress(udpbatch.socket.AF_INET,
+                                          ('10.1.2.3', 4567))
+        self.assertEqual(len(encoded), 16)
+        self.assertEqual(udpbatch._decodeAddress(encoded),
+                         ('10.1.2.3', 4567))
+
+
+    def test_ipv6(self):
+        """
+        IPv6 addresses decode to the same four-tuple the socket module uses,
+        as a port which does not batch would give them.
+        """
+        encoded = udpbatch._encodeAddress(udpbatch.socket.AF_INET6,
+                                          ('::1', 4567))
+        self.assertEqual(len(encoded), 28)
+        self.assertEqual(udpbatch._decodeAddress(encoded),
+                         ('::1', 4567, 0, 0))
+        encoded = udpbatch._encodeAddress(udpbatch.socket.AF_INET6,
+                                          ('fe80::1', 4567, 3, 2))
+        self.assertEqual(udpbatch._decodeAddress(encoded),
+                         ('fe80::1', 4567, 3, 2))
+
+
+    def test_hostname(self):
+        """
+        Host names cannot be encoded.
+        """
+        self.assertIdentical(
+            udpbatch._encodeAddress(udpbatch.socket.AF_INET,
+                                    ('example.com', 1)),
+            None)
+
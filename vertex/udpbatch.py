@@ -0,0 +1,353 @@
+# -*- test-case-name: vertex.test.test_udpbatch -*-
+# Copyright (c) Twisted Matrix Laboratories.
+# See LICENSE for details.
+
+"""
+A UDP port which moves datagrams to and from the kernel in batches.
+
+A busy L{vertex.ptcp.PTCP} port sends and receives a great many small
+datagrams, and a plain UDP port makes one system call for each of them.  On
+Linux, L{BatchedPort} uses C{sendmmsg(2)} and C{recvmmsg(2)} to move up to
+L{BatchedPort.batchSize} datagrams per system call instead.  Everywhere else
+it behaves exactly like an ordinary UDP port, and L{listenUDP} returns an
+ordinary UDP port if the reactor cannot use L{BatchedPort} at all.
+
+A L{BatchedPort} may also share its port number with others, in this
+process or others, by setting C{SO_REUSEPORT}; see L{vertex.ptcpshard}.
+"""
+
+import socket
+import struct
+import sys
+
+from errno import EAGAIN, EINTR, EWOULDBLOCK, ECONNREFUSED
+
+from twisted.internet import udp, abstract, error
+from twisted.python import log
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# Errors from recvmmsg which mean there is nothing more to read right now,
+# and which mean an earlier datagram was refused, as for udp.Port.doRead.
+_readIgnore = (EAGAIN, EINTR, EWOULDBLOCK)
+_readRefuse = (ECONNREFUSED,)
+
+# Room for any socket address the kernel might hand back.
+_SOCKADDR_SIZE = 128
+
+_sendmmsg = _recvmmsg = None
+
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+if ctypes is not None and sys.platform.startswith('linux'):
+    class _iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p),
+                    ('iov_len', ctypes.c_size_t)]
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p),
+                    ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(_iovec)),
+                    ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p),
+                    ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', _msghdr),
+                    ('msg_len', ctypes.c_uint)]
+
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendmmsg = _libc.sendmmsg
+        _recvmmsg = _libc.recvmmsg
+    except (OSError, AttributeError):
+        _sendmmsg = _recvmmsg = None
+    else:
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+        _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        _recvmmsg.restype = ctypes.c_int
+
+
+
+def batchingSupported():
+    """
+    @return: L{True} if this platform can send and receive datagrams in
+    batches.
+    """
+    return _sendmmsg is not None
+
+
+
+def reusePortSupported():
+    """
+    @return: L{True} if this platform lets several UDP sockets bind the same
+    port and share the datagrams which arrive at it.
+    """
+    return _SO_REUSEPORT is not None
+
+
+
+def _encodeAddress(family, addr):
+    """
+    Encode an address as a C{struct sockaddr}.
+
+    @param family: C{socket.AF_INET} or C{socket.AF_INET6}.
+
+    @param addr: a (host, port) tuple, where host is an IP address of the
+    given family, or for IPv6 a (host, port, flowinfo, scope_id) tuple.
+
+    @return: the encoded address, or L{None} if it cannot be encoded (for
+    example, because it names a host rather than giving an address).
+    """
+    host, port = addr[:2]
+    if family == socket.AF_INET and abstract.isIPAddress(host):
+        return (struct.pack('=H', family) + struct.pack('!H', port)
+                + socket.inet_aton(host) + '\0' * 8)
+    if family == socket.AF_INET6 and abstract.isIPv6Address(host):
+        flowInfo, scopeID = addr[2:] or (0, 0)
+        return (struct.pack('=H', family) + struct.pack('!HL', port, flowInfo)
+                + socket.inet_pton(family, host) + struct.pack('=L', scopeID))
+    return None
+
+
+
+def _decodeAddress(encoded):
+    """
+    Decode a C{struct sockaddr} filled in by the kernel.
+
+    @return: the address in the form the socket module gives it, and so
+    the form L{udp.Port} passes to its protocol: a (host, port) tuple for
+    IPv4, or a (host, port, flowinfo, scope_id) tuple for IPv6.
+    """
+    [family] = struct.unpack('=H', encoded[:2])
+    [port] = struct.unpack('!H', encoded[2:4])
+    if family == socket.AF_INET6:
+        [flowInfo] = struct.unpack('!L', encoded[4:8])
+        [scopeID] = struct.unpack('=L', encoded[24:28])
+        return (socket.inet_ntop(family, encoded[8:24]), port, flowInfo,
+                scopeID)
+    return (socket.inet_ntoa(encoded[4:8]), port)
+
+
+
+class BatchedPort(udp.Port):
+    """
+    A UDP port which sends and receives datagrams in batches, where the
+    platform allows.
+
+    @ivar batchSize: the largest number of datagrams moved in a single system
+    call.
+    @type batchSize: L{int}
+
+    @ivar reusePort: whether to set C{SO_REUSEPORT}, so that other sockets
+    which also set it may bind the same port.  The kernel then gives each
+    datagram to one of them, choosing by a hash of its source and
+    destination addresses, so all the datagrams from one peer go to the same
+    socket for as long as the set of sockets stays the same.
+    @type reusePort: L{bool}
+    """
+
+    batchSize = 32
+
+    # The most socket addresses to remember the encoding of; a port talking
+    # to more peers than this re-encodes some of them.
+    _maxCachedAddresses = 1024
+
+    _receiveBuffers = None
+
+    reusePort = False
+
+    def __init__(self, *a, **kw):
+        udp.Port.__init__(self, *a, **kw)
+        self._addresses = {}
+
+
+    def createInternetSocket(self):
+        skt = udp.Port.createInternetSocket(self)
+        if self.reusePort:
+            skt.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        return skt
+
+
+    def _encodedAddress(self, addr):
+        encoded = self._addresses.get(addr)
+        if encoded is None:
+            encoded = _encodeAddress(self.addressFamily, addr)
+            if encoded is not None:
+                if len(self._addresses) >= self._maxCachedAddresses:
+                    self._addresses.clear()
+                self._addresses[addr] = encoded
+        return encoded
+
+
+    def writeBatch(self, datagrams):
+        """
+        Write some datagrams.
+
+        Unlike L{write}, errors are not raised: a datagram which cannot be
+        sent is logged and dropped, and the rest are sent anyway.
+
+        @param datagrams: a sequence of (datagram, address) pairs, as would be
+        passed to L{write}.
+        """
+        datagrams = list(datagrams)
+        if _sendmmsg is None or self._connectedAddr:
+            for datagram, addr in datagrams:
+                self._writeOne(datagram, addr)
+            return
+        start = 0
+        while start < len(datagrams):
+            batch = []
+            for datagram, addr in datagrams[start:start + self.batchSize]:
+                encoded = self._encodedAddress(addr)
+                if encoded is None:
+                    break
+                batch.append((datagram, encoded))
+            if not batch:
+                # Let write deal with whatever is wrong with this address.
+                self._writeOne(*datagrams[start])
+                start += 1
+                continue
+            sent = self._sendBatch(batch)
+            if sent <= 0:
+                # The first datagram failed; have write report why, and carry
+                # on with the rest.
+                self._writeOne(*datagrams[start])
+                sent = 1
+            start += sent
+
+
+    def _writeOne(self, datagram, addr):
+        try:
+            self.write(datagram, addr)
+        except Exception:
+            log.err(None, "Dropping datagram to %r" % (addr,))
+
+
+    def _sendBatch(self, batch):
+        """
+        Send a batch of datagrams with a single C{sendmmsg} call.
+
+        @param batch: a list of (datagram, encoded address) pairs.
+
+        @return: the number of datagrams sent, or -1 on error.
+        """
+        count = len(batch)
+        messages = (_mmsghdr * count)()
+        vectors = (_iovec * count)()
+        for i, (datagram, encoded) in enumerate(batch):
+            # Both strings are kept alive by batch for the duration of the
+            # call, so their buffers can be used in place.
+            vectors[i].iov_base = ctypes.cast(
+                ctypes.c_char_p(datagram), ctypes.c_void_p)
+            vectors[i].iov_len = len(datagram)
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.cast(
+                ctypes.c_char_p(encoded), ctypes.c_void_p)
+            header.msg_namelen = len(encoded)
+            header.msg_iov = ctypes.pointer(vectors[i])
+            header.msg_iovlen = 1
+        while True:
+            sent = _sendmmsg(self.socket.fileno(), messages, count, 0)
+            if sent < 0 and ctypes.get_errno() == EINTR:
+                continue
+            return sent
+
+
+    def _allocateReceiveBuffers(self):
+        count = self.batchSize
+        self._receiveBuffers = buffers = [
+            ctypes.create_string_buffer(self.maxPacketSize)
+            for i in range(count)]
+        self._receiveNames = names = [
+            ctypes.create_string_buffer(_SOCKADDR_SIZE)
+            for i in range(count)]
+        self._receiveVectors = vectors = (_iovec * count)()
+        self._receiveMessages = messages = (_mmsghdr * count)()
+        for i in range(count):
+            vectors[i].iov_base = ctypes.addressof(buffers[i])
+            vectors[i].iov_len = self.maxPacketSize
+            header = messages[i].msg_hdr
+            header.msg_name = ctypes.addressof(names[i])
+            header.msg_iov = ctypes.pointer(vectors[i])
+            header.msg_iovlen = 1
+
+
+    def doRead(self):
+        """
+        Called when my socket is ready for reading; read as many datagrams as
+        L{maxThroughput} allows, a batch at a time.
+        """
+        if _recvmmsg is None:
+            return udp.Port.doRead(self)
+        if self._receiveBuffers is None:
+            self._allocateReceiveBuffers()
+        messages = self._receiveMessages
+        read = 0
+        while read < self.maxThroughput:
+            for i in range(self.batchSize):
+                messages[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+            received = _recvmmsg(self.socket.fileno(), messages,
+                                 self.batchSize, 0, None)
+            if received < 0:
+                no = ctypes.get_errno()
+                if no in _readIgnore:
+                    return
+                if no in _readRefuse:
+                    if self._connectedAddr:
+                        self.protocol.connectionRefused()
+                    return
+                raise socket.error(no, 'recvmmsg failed')
+            for i in range(received):
+                length = messages[i].msg_len
+                data = ctypes.string_at(self._receiveBuffers[i], length)
+                addr = _decodeAddress(self._receiveNames[i].raw[
+                    :messages[i].msg_hdr.msg_namelen])
+                read += length
+                try:
+                    self.protocol.datagramReceived(data, addr)
+                except:
+                    log.err()
+            if received < self.batchSize:
+                # The socket has been drained.
+                return
+
+
+
+def listenUDP(port, protocol, interface='', maxPacketSize=8192,
+              reactor=None, reusePort=False):
+    """
+    Like C{IReactorUDP.listenUDP}, but listen with a L{BatchedPort} if the
+    reactor supports it.
+
+    @param reactor: the reactor to listen with; the global reactor by
+    default.
+
+    @param reusePort: see L{BatchedPort.reusePort}.
+
+    @raise error.CannotListenError: if C{reusePort} is given but neither the
+    platform nor the reactor can share ports.
+
+    @return: the listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    from twisted.internet.posixbase import PosixReactorBase
+    posix = isinstance(reactor, PosixReactorBase)
+    if reusePort and not (posix and reusePortSupported()):
+        raise error.CannotListenError(
+            interface, port, "SO_REUSEPORT is not supported")
+    if not posix:
+        return reactor.listenUDP(port, protocol, interface, maxPacketSize)
+    p = BatchedPort(port, protocol, interface, maxPacketSize, reactor)
+    p.reusePort = reusePort
+    p.startListening()
+    return p